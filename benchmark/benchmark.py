@@ -0,0 +1,178 @@
+import json
+import math
+
+from dir_comparison.manifest import save_manifest
+
+# Benchmark mode runs each test's command a number of times, and summarizes how long the runs took. A benchmark
+# file keeps the summaries, and the times of the individual runs, so two benchmark files (e.g. from before and after
+# a change) can be compared, to see which tests got significantly faster or slower.
+
+BENCHMARK_FILE_VERSION = 1
+
+# wall time, and CPU (user + system) time, of the command
+METRIC_WALL_TIME = 'wall_time'
+METRIC_CPU_TIME = 'cpu_time'
+
+BENCHMARK_METRICS = [METRIC_WALL_TIME, METRIC_CPU_TIME]
+
+
+def percentile(values, fraction):
+    """
+    The value below which the given fraction of the values fall, interpolating between the two nearest values:
+
+        >>> percentile([1, 2, 3, 4, 5], 0.5)
+        3
+        >>> percentile([1, 2, 3, 4, 5], 0.95)
+        4.8
+    """
+    values = sorted(values)
+    position = (len(values) - 1) * fraction
+    below = math.floor(position)
+    above = math.ceil(position)
+
+    if below == above:
+        return values[below]
+
+    return round(values[below] + (values[above] - values[below]) * (position - below), 12)
+
+
+def summarize(values):
+    """
+    Summary of the times of a benchmark's runs:
+
+        >>> summarize([3, 1, 2, 5, 4])
+        {'runs': 5, 'min': 1, 'median': 3, 'p95': 4.8, 'mean': 3, 'stdev': 1.5811388300841898, 'values': [3, 1, 2, 5, 4]}
+    """
+    # only imported when benchmarking, as it's slow to import
+    import statistics
+
+    return {
+        'runs': len(values),
+        'min': min(values),
+        'median': statistics.median(values),
+        'p95': percentile(values, 0.95),
+        'mean': statistics.mean(values),
+        'stdev': statistics.stdev(values) if len(values) > 1 else 0.0,
+        'values': list(values),
+    }
+
+
+# The summaries for a test's runs, given the resource usage of each run (see resource_usage.py)
+def summarize_runs(usages):
+    return {
+        METRIC_WALL_TIME: summarize([usage['wall_time'] for usage in usages]),
+        METRIC_CPU_TIME: summarize([usage['user_time'] + usage['system_time'] for usage in usages]),
+    }
+
+
+def save_benchmark_file(filename, suite_dir, warmup, runs, tests):
+    save_manifest({'version': BENCHMARK_FILE_VERSION, 'suite_dir': suite_dir, 'warmup': warmup, 'runs': runs,
+                   'tests': tests}, filename)
+
+
+def load_benchmark_file(filename):
+    with open(filename, 'r') as file:
+        benchmark = json.load(file)
+
+    if benchmark.get('version') != BENCHMARK_FILE_VERSION:
+        raise ValueError(f"{filename} isn't a benchmark file BBT can read")
+
+    return benchmark
+
+
+# Table of the summaries of the tests in a benchmark file's tests, for the given metric
+def benchmark_table(tests, metric):
+    lines = [f"{'test':40} {'min':>10} {'median':>10} {'p95':>10} {'stdev':>10}"]
+
+    for name, summaries in tests.items():
+        summary = summaries[metric]
+        lines.append(f"{name[:40]:40} {summary['min']:10.4f} {summary['median']:10.4f} {summary['p95']:10.4f} "
+                     f"{summary['stdev']:10.4f}")
+
+    return '\n'.join(lines)
+
+
+# Regularized incomplete beta function I_x(a, b), from its continued fraction (see Numerical Recipes, 6.4)
+def incomplete_beta(x, a, b):
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+
+    # the continued fraction converges quickly for x below this, so for x above it, use I_x(a, b) = 1 - I_1-x(b, a)
+    if x > (a + 1) / (a + b + 2):
+        return 1 - incomplete_beta(1 - x, b, a)
+
+    log_front = math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log(1 - x)
+
+    # modified Lentz's method
+    tiny = 1e-300
+    c = 1.0
+    d = 1 - (a + b) * x / (a + 1)
+    d = 1 / (d if abs(d) > tiny else tiny)
+    fraction = d
+
+    for m in range(1, 300):
+        for numerator in [m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+                          -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1))]:
+            d = 1 + numerator * d
+            d = 1 / (d if abs(d) > tiny else tiny)
+            c = 1 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            fraction *= c * d
+
+        if abs(c * d - 1) < 1e-12:
+            break
+
+    return math.exp(log_front) * fraction / a
+
+
+def welch_t_test(values1, values2):
+    """
+    The two-sided p-value of Welch's t-test: the chance of the means of the two samples being at least as far apart
+    as they are if the values came from distributions with the same mean (the variances needn't be the same).
+    Each sample needs at least two values.
+
+        >>> round(welch_t_test([1, 2, 3, 4, 5], [2, 3, 4, 5, 9]), 3)
+        0.294
+        >>> welch_t_test([1.0, 1.1, 0.9, 1.0, 1.05], [1.5, 1.6, 1.4, 1.5, 1.55]) < 0.001
+        True
+    """
+    import statistics
+
+    n1, n2 = len(values1), len(values2)
+    mean1, mean2 = statistics.mean(values1), statistics.mean(values2)
+    variance1, variance2 = statistics.variance(values1) / n1, statistics.variance(values2) / n2
+
+    if variance1 + variance2 == 0:
+        return 1.0 if mean1 == mean2 else 0.0
+
+    t = (mean1 - mean2) / math.sqrt(variance1 + variance2)
+    degrees_of_freedom = (variance1 + variance2) ** 2 / (variance1 ** 2 / (n1 - 1) + variance2 ** 2 / (n2 - 1))
+
+    return incomplete_beta(degrees_of_freedom / (degrees_of_freedom + t * t), degrees_of_freedom / 2, 0.5)
+
+
+# Compares the tests in two benchmark files, for the given metric. Returns (name, old median, new median, p-value,
+# verdict) for the tests in both, where verdict is 'slower' or 'faster' if the change is significant (p-value
+# below alpha), or '' if not. The p-value is None for tests without enough runs to tell.
+def compare_benchmarks(old, new, metric, alpha=0.05):
+    rows = []
+
+    for name, new_summaries in new['tests'].items():
+        if name not in old['tests']:
+            continue
+
+        old_summary = old['tests'][name][metric]
+        new_summary = new_summaries[metric]
+
+        p_value = None
+        verdict = ''
+        if old_summary['runs'] > 1 and new_summary['runs'] > 1:
+            p_value = welch_t_test(old_summary['values'], new_summary['values'])
+            if p_value < alpha:
+                verdict = 'slower' if new_summary['mean'] > old_summary['mean'] else 'faster'
+
+        rows.append((name, old_summary['median'], new_summary['median'], p_value, verdict))
+
+    return rows
@@ -0,0 +1,13 @@
+from benchmark.benchmark import METRIC_WALL_TIME, compare_benchmarks, summarize_runs
+
+
+def test_compare_benchmarks_flags_significant_changes():
+    old = {'tests': {'same': summarize_runs([{'wall_time': t, 'user_time': t, 'system_time': 0} for t in [1.0, 1.1, 0.9, 1.0]]),
+                     'slower': summarize_runs([{'wall_time': t, 'user_time': t, 'system_time': 0} for t in [1.0, 1.1, 0.9, 1.0]])}}
+    new = {'tests': {'same': summarize_runs([{'wall_time': t, 'user_time': t, 'system_time': 0} for t in [1.05, 0.95, 1.0, 1.0]]),
+                     'slower': summarize_runs([{'wall_time': t, 'user_time': t, 'system_time': 0} for t in [2.0, 2.1, 1.9, 2.0]]),
+                     'new_test': summarize_runs([{'wall_time': 1.0, 'user_time': 1.0, 'system_time': 0}])}}
+
+    rows = {name: verdict for name, _, _, _, verdict in compare_benchmarks(old, new, METRIC_WALL_TIME)}
+
+    assert rows == {'same': '', 'slower': 'slower'}
@@ -10,7 +10,7 @@
 # [ ] split source into files
 # [ ] optional translation of 'first/last checksum' diffs to just checksum diff - consumer of folder compare doesn't usually care
 # [ ] ? remove the 'variables' dict, let anything at global.yaml level be a variable for {var_name}.
-# [ ] take target tests in suite as a param -- for running only some of them
+# [x] take target tests in suite as a param -- for running only some of them
 # [ ] (maybe) do file timestamp comparison input v output
 # [ ] make existing CSV output option a param
 # [ ] require any test dir in a test suite to begin 'test_'. Sensible.
@@ -30,20 +30,50 @@
 # The issue with self-test: the auto-call to clean finds legit working/ folders *inside the input/output dirs in the test* that we don't
 # want to delete, and deletes those. Solution: Limit level we delete working/ folders to.
 
+import fnmatch
+import hashlib
+import json
 import os.path
 import sys
+import time
 import shutil
 import subprocess
+import tempfile
+import threading
+from dataclasses import asdict, dataclass, field, replace
 
 import click
-import yaml
 
-from dir_comparison.dir_comparison import *
+from dir_comparison.dir_comparison import COMPARISON_MODE_EXACT, COMPARISON_MODES, compare_folders
+from content_store.content_store import INPUT_MANIFEST_FILE, OUTPUT_MANIFEST_FILE, STORE_DIR, add_tree_to_store, \
+    is_link_to_blob, materialize_from_store, missing_blobs, save_tree_manifest, store_dir_for_test
+from dir_comparison.manifest import build_manifest, cached_manifest, compare_folder_to_manifest, load_manifest, \
+    save_manifest
+from benchmark.benchmark import BENCHMARK_METRICS, benchmark_table, save_benchmark_file, summarize_runs
+from resource_limits.resource_limits import RESULT_LIMIT, RESULT_TIMEOUT, ResourceLimits, kill_process_group, \
+    parse_size, read_stderr_tail
+from resource_usage.resource_usage import METRICS, load_baseline, parse_tolerance, regressions, save_baseline, \
+    wait_for_process, wait_for_process_async
+from result_cache.history import TestHistory, failed_first, shard_tests
+from result_cache.result_cache import ResultCache, fingerprint, tree_digest
+from result_cache.results_file import save_results_file
+from suite_archive.suite_archive import SuiteArchive, is_suite_archive
+from suite_plan.suite_plan import Definitions, PlanCache, load_yaml, path_stamp, resolve_config
+from suite_setup.suite_setup import SetupError, run_setup, run_teardown
+from timing.timing import PHASE_CLEANUP, PHASE_COMPARE, PHASE_CONFIG, PHASE_COPY, PHASE_STDOUT, PHASE_SUBPROCESS, \
+    PhaseTimings, chrome_trace, save_chrome_trace, save_timing_report, slowest_tests_table, make_timing_report
+from stdout_comparison.stdout_comparison import STDOUT_CHUNK_SIZE, StdoutComparison, StdoutPipeline, StdoutRecording
+from stdout_filters.stdout_filters import StdoutFilters
+from materialization.materialization import STRATEGIES, STRATEGY_AUTO, STRATEGY_HARDLINK, STRATEGY_REFLINK, \
+    InputBases, MaterializeStats, apply_overlay, changed_hard_links, materialize_tree
+
+# asyncio, concurrent.futures and yaml are slow to import, so they're only imported where they're used: BBT is started
+# once per test by its self-tests, and --help and --clean shouldn't wait for them (see test_blackbox_tester.py)
 
 
 YAML_CONFIG_FILE = "config.yaml"
 YAML_GLOBAL_CONFIG_FILE = "global.yaml"
-# definitions key for map in global.yaml for possible replacement text in config.yaml files
+# definitions key for map in global.yaml of names to text, which replaces {name} in config values (see suite_plan.py)
 DEFINITIONS_KEY = 'definitions'
 
 INPUT_DIR = "input"
@@ -51,11 +81,75 @@ EXPECTED_OUTPUT_DIR = "output"
 WORKING_DIR = "working"
 STDOUT_WORKING_COPY_FILE = 'stdout_working.txt'
 
+# global.yaml keys for the commands run once before and after the suite's tests, and the files or dirs (relative to the
+# suite dir) the setup depends on (see suite_setup.py)
+SETUP_KEY = 'setup'
+SETUP_INPUTS_KEY = 'setup_inputs'
+TEARDOWN_KEY = 'teardown'
+
+# global.yaml key for a dir to create working/ dirs in, instead of inside each test dir (e.g. /dev/shm)
+SCRATCH_ROOT_KEY = 'scratch_root'
+# each run gets its own dir inside the scratch root, named with this prefix
+SCRATCH_RUN_DIR_PREFIX = 'bbt_run_'
+# file in a run's scratch dir containing the path of the test suite, so --clean can tidy up after the right suite
+SCRATCH_SUITE_DIR_FILE = 'bbt_test_suite_dir.txt'
+
+# Things BBT keeps between runs (e.g. manifests of output/ dirs) are kept in a dir per test suite in here,
+# outside the test suite, unless --cache-dir is given.
+DEFAULT_CACHE_ROOT = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'blackbox_tester')
+MANIFESTS_CACHE_DIR = 'manifests'
+# manifests of input/ dirs, used to fingerprint tests for --changed-only
+INPUT_MANIFESTS_CACHE_DIR = 'input_manifests'
+# fingerprints of tests that passed, for --changed-only
+RESULTS_CACHE_FILE = 'results.json'
+# how long each test took last time and whether it passed, for --shard and --failed-first (unless --history-file is given)
+HISTORY_FILE = 'history.json'
+# the plans of the suite's tests (see suite_plan.py)
+PLAN_CACHE_FILE = 'plan.json'
+
+# config key for files (or dirs) a test depends on besides its own, e.g. the binary being tested. Relative
+# paths are relative to the test's dir. With --changed-only, a test is run again if any of them change.
+DEPENDS_ON_KEY = 'depends_on'
+
+# config keys for limits on what a test's command can use (see resource_limits.py). timeout and max_cpu_seconds
+# are in seconds, the others in bytes (with an optional K, M, G or T suffix).
+TIMEOUT_KEY = 'timeout'
+MAX_MEMORY_KEY = 'max_memory'
+MAX_CPU_SECONDS_KEY = 'max_cpu_seconds'
+MAX_FILE_SIZE_KEY = 'max_file_size'
+MAX_STDOUT_BYTES_KEY = 'max_stdout_bytes'
+
+# config key for a test's tags, which --select and --exclude can match with 'tag:<tag>'
+TAGS_KEY = 'tags'
+TAG_PATTERN_PREFIX = 'tag:'
+
+# config key for comparing working/ with a cached manifest of output/, rather than reading output/ each time
+OUTPUT_MANIFEST_KEY = 'output_manifest'
+
+# config key for the name of a tree in the suite's input bases dir that the test's input/ is an overlay on
+INPUT_BASE_KEY = 'input_base'
+INPUT_BASES_DIR = 'input_bases'
+
 STD_OUT_EXPECTED_CONTENT_FILENAME = "stdout.txt"
 
+# config key for a list of filters that normalize stdout before it's compared or recorded (see stdout_filters.py)
+STDOUT_FILTERS_KEY = 'stdout_filters'
+
+# what the command used when the test was recorded (see resource_usage.py)
+RESOURCE_BASELINE_FILE = "resource_baseline.yaml"
+# config keys for how much more than the baseline of a metric the command can use, e.g. max_wall_time_regression: 20%
+REGRESSION_KEY_FORMAT = 'max_{}_regression'
+
+# config key for how working/ files are compared with output/ files: exact (the default) or fast_sampling.
+# See dir_comparison.py.
+FILE_COMPARISON_KEY = 'file_comparison'
+
+# config key for how many threads compare the files in working/ with those in output/ (--compare-workers overrides it)
+COMPARE_WORKERS_KEY = 'compare_workers'
+
 BBT_IGNORE_FILE = '.bbt_ignore_this_file'
 
-ignore_dirs = ["ignore_contents", ".git"]
+ignore_dirs = ["ignore_contents", ".git", STORE_DIR, INPUT_BASES_DIR]
 ignore_files_for_comparison_scan = ['.DS_Store', BBT_IGNORE_FILE]
 ignore_files_for_empty_dir_detection = ['.DS_Store']
 
@@ -63,15 +157,165 @@ ignore_files_for_empty_dir_detection = ['.DS_Store']
 # ENCODING = 'ascii'
 ENCODING = 'utf-8'
 
+# engines for running the tests in a suite (see the --engine option)
+ENGINE_THREADS = 'threads'
+ENGINE_ASYNCIO = 'asyncio'
 
-def eprint(*args, **kwargs):
-    print(*args, file=sys.stderr, **kwargs)
+# status of a test whose command was killed as the run had reached --max-failures. It isn't counted as a result.
+RESULT_CANCELLED = 'CANCELLED'
 
 
-def pr_red(skk, end='\n'): print("\033[91m{}\033[00m".format(skk), end=end)
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
 
 
-def pr_yellow(skk): print("\033[93m{}\033[00m".format(skk))
+def red(skk): return "\033[91m{}\033[00m".format(skk)
+
+
+def yellow(skk): return "\033[93m{}\033[00m".format(skk)
+
+
+def pr_red(skk, end='\n'): print(red(skk), end=end)
+
+
+def pr_yellow(skk): print(yellow(skk))
+
+
+# options for a test suite run, as given on the command line
+@dataclass
+class RunOptions:
+    record: bool = False
+    report_failure_only: bool = False
+    # print stats about the run (e.g. how long it took, and what was copied to make working/ dirs) at the end
+    verbose: bool = False
+    summary_csv: bool = False
+    # number of tests to run at the same time. 1 means run them one after the other.
+    jobs: int = 1
+    # how tests are run: on a pool of jobs threads, or as asyncio tasks (at most jobs at once)
+    engine: str = ENGINE_THREADS
+    # how input/ is copied to working/ (see materialization.py)
+    materialize_strategy: str = STRATEGY_AUTO
+    # dir to create working/ dirs in. If None, they are created inside each test's dir.
+    scratch_root: str = None
+    # when using a scratch root: move the working/ dirs of failed tests back into the test suite
+    debug_artifacts: bool = False
+    # a unique dir inside scratch_root for the current run. Set by run_all_tests.
+    scratch_run_dir: str = None
+    # the dir the suite's setup wrote to, for {SHARED_PATH} in commands. Set by run_all_tests.
+    shared_dir: str = None
+    # the suite's input bases, for tests with an input_base. Set by run_all_tests.
+    input_bases: InputBases = None
+    # the archive the suite is in, if it's run from one (see suite_archive.py). Set by run_all_tests.
+    archive: SuiteArchive = None
+    # dir for things kept between runs. If None, run_all_tests uses a dir for the suite in DEFAULT_CACHE_ROOT.
+    cache_dir: str = None
+    # compare working/ with a cached manifest of output/ (can also be turned on per test with output_manifest: y)
+    output_manifest: bool = False
+    # threads used to compare files in working/ with output/. If None, compare_workers in the config is used (default 1).
+    compare_workers: int = None
+    # skip tests that passed last time and haven't changed since (see result_cache.py)
+    changed_only: bool = False
+    # patterns for the tests to run, and for tests not to run (see find_selected_tests)
+    select: tuple = ()
+    exclude: tuple = ()
+    # (shard index, shard count) to run only that shard of the selected tests (see shard_tests), or None
+    shard: tuple = None
+    # where test durations and results are kept between runs. If None, a file in the cache dir is used, and only
+    # written with failed_first.
+    history_file: str = None
+    # run the tests that failed last time (according to the history) first
+    failed_first: bool = False
+    # stop the run once this many tests have failed (see FailureLimit), or None to run them all
+    max_failures: int = None
+    # stop comparing a test's output at its first difference, rather than listing them all
+    exit_on_first_difference: bool = False
+    # stops the run at max_failures, for the tests in flight. Set by run_suite.
+    failure_limit: 'FailureLimit' = None
+    # file to write the results of the run to, as JSON (see results_file.py), or None
+    results_file: str = None
+    # file to write the per-phase timings of the tests to, as JSON (see timing.py), or None
+    timing_report: str = None
+    # number of slowest tests to list at the end of the run, with their phase timings
+    slowest: int = 0
+    # file to write a Chrome trace of the run to, or None
+    trace: str = None
+    # runs of each test's command to time, after it has passed (see benchmark_test). 0 for no benchmarking.
+    benchmark: int = 0
+    # runs of each test's command before the timed runs, to warm up caches
+    warmup: int = 1
+    # file to write the benchmark results to, as JSON (see benchmark.py), or None
+    benchmark_file: str = None
+
+
+# The outcome of running a single test. Nothing is printed while a test is running (tests can run in parallel);
+# instead the lines to print are gathered in report (stdout) and diagnostics (stderr), and printed in test index order.
+@dataclass
+class TestResult:
+    # stop pytest trying to collect this class
+    __test__ = False
+
+    test_index: int
+    target_folder: str
+    # False if there was a problem trying to run the test at all (e.g. missing input/ folder)
+    found_test_suite: bool = True
+    succeeded: bool = False
+    report: list = field(default_factory=list)
+    diagnostics: list = field(default_factory=list)
+    # what was copied and what was shared when copying input/ to working/
+    materialize_stats: MaterializeStats = None
+    # True if the test wasn't run, as it passed last time and hasn't changed since
+    cached: bool = False
+    # time taken to run the test, in seconds
+    duration: float = None
+    # SUCCESS, FAILED, or TIMEOUT or LIMIT if the command was stopped for going over one of its limits
+    status: str = None
+    # what the command used (see resource_usage.py)
+    resource_usage: dict = None
+    # how long each phase of the test took
+    timings: PhaseTimings = field(default_factory=PhaseTimings)
+
+
+# The outcome of running a test suite (see run_suite)
+@dataclass
+class SuiteResult:
+    root_dir: str
+    # the number of tests selected to run
+    test_count: int = 0
+    # a TestResult for each test run, in the order they were run: test index order, but with the tests that failed
+    # last time first if options.failed_first
+    results: list = field(default_factory=list)
+    # tests not run (or cancelled while they were running), as the run had reached options.max_failures
+    not_run_count: int = 0
+    # tests not run, as they passed last time and haven't changed since, and how long it took to find them
+    cached_count: int = 0
+    fingerprint_time: float = 0
+    # whether the suite's setup ran (rather than being skipped as its inputs hadn't changed), and how long it took.
+    # setup_time is None if the suite has no setup.
+    setup_ran: bool = False
+    setup_time: float = None
+    # time taken to run the tests
+    elapsed_time: float = None
+    # summaries of the benchmarked runs of each test that passed, by test name, with options.benchmark (see benchmark.py)
+    benchmarks: dict = None
+    # with options.timing_report or options.slowest, the phase timings of the tests (see timing.py)
+    timing_report: dict = None
+    # what was copied and what was shared making the tests' working/ dirs
+    materialize_stats: MaterializeStats = field(default_factory=MaterializeStats)
+    # messages about the run as a whole, e.g. a teardown that failed
+    diagnostics: list = field(default_factory=list)
+
+    @property
+    def failed_count(self):
+        return len([result for result in self.results if not result.succeeded])
+
+    @property
+    def succeeded(self):
+        return self.failed_count == 0
+
+
+# raised by run_suite when a suite can't be run at all, e.g. its setup failed
+class SuiteError(Exception):
+    pass
 
 
 def make_abs_path(rel_path):
@@ -79,59 +323,6 @@ def make_abs_path(rel_path):
     return os.path.normpath(os.path.join(script_dir, rel_path))
 
 
-# gets a value for key from yaml. Vars can be a dict of string replacements, or None.
-# returns None if a key not found
-def get_yaml_value_raw(yaml, global_yaml, key, vars=None, default_value=None):
-    raw_value = yaml.get(key, default_value)
-
-    value = raw_value
-
-    if not value:
-        value = global_yaml.get(key, default_value)
-
-    if vars and value:
-        # value is a string
-        for replace_key, replace_value in vars.items():
-            if isinstance(value, list):
-                value = [v.replace(replace_key, replace_value) for v in value]
-            else:
-                value = value.replace(replace_key, replace_value)
-
-    return value, raw_value
-
-
-def get_yaml_value(yaml, global_yaml, key, vars=None, default_value=None):
-    return get_yaml_value_raw(yaml, global_yaml, key, vars, default_value)[0]
-
-# Note that this method takes and returns a byte string, only converting internally
-# to list of ascii lines.
-def trim_lines_until_after_line_containing(lines_as_bytes, text_match):
-    if not text_match or not lines_as_bytes:
-        return lines_as_bytes
-
-    # print(f"lines_as_bytes = {lines_as_bytes}")
-
-    all_lines = lines_as_bytes.decode(ENCODING)
-    lines = all_lines.split('\n')
-
-    return_lines = []
-
-    append_lines = False
-
-    for line in lines:
-        if append_lines:
-            return_lines.append(line)
-
-        if text_match in line:
-            append_lines = True
-
-    # convert back to byte string
-    all_lines = '\n'.join(return_lines)
-
-    # print(f"trim lines: returning {return_lines}")
-    return all_lines.encode(ENCODING)
-
-
 def last_folder_components(path, component_count):
 
     comps = path.split(os.path.sep)
@@ -146,10 +337,23 @@ def last_folder_components(path, component_count):
 # print(last_folder_components("/a/b/c/d/e/f/g", 2))
 # sys.exit(0)
 
-# checks that config.yaml, input/ and output/ exist.
-def validate_folder_structure(single_test_target_folder):
+# True if there's a file or dir at path in the suite, which is in archive if it's given (see suite_archive.py)
+def suite_path_exists(path, archive=None):
+    return archive.exists(path) if archive else os.path.exists(path)
+
+
+# opens the file at path in the suite (or in archive, if it's given) for reading as bytes
+def open_suite_file(path, archive=None):
+    return archive.open(path) if archive else open(path, 'rb')
+
+
+# checks that config.yaml, input/ and output/ exist. Returns a list of errors (empty if the structure is ok).
+def validate_folder_structure(single_test_target_folder, archive=None):
     errors = []
 
+    def exists(path):
+        return suite_path_exists(path, archive)
+
     num_things_to_validate = 0
 
     # target_folder_abspath = os.path.abspath(single_test_target_folder)
@@ -158,301 +362,1404 @@ def validate_folder_structure(single_test_target_folder):
     input_folder_path = os.path.join(target_folder_abspath, INPUT_DIR)
     rel_path = last_folder_components(input_folder_path, 3)
 
-    if not os.path.exists(input_folder_path):
+    # input/ can be given as a manifest of files in the suite's content store (see content_store.py)
+    if not exists(input_folder_path) and not exists(os.path.join(target_folder_abspath, INPUT_MANIFEST_FILE)):
 
         errors.append(f"Error: Couldn't find the input/ folder for a test at {rel_path}")
         # errors.append(f"Error: Couldn't find the input/ folder for a test at {input_folder_path}, currdir = {os.getcwd()}")
 
     output_folder_path = os.path.join(single_test_target_folder, EXPECTED_OUTPUT_DIR)
-    if os.path.exists(output_folder_path):
+    if exists(output_folder_path) or exists(os.path.join(single_test_target_folder, OUTPUT_MANIFEST_FILE)):
         num_things_to_validate += 1
 
     expected_stdout_filename = os.path.join(single_test_target_folder, STD_OUT_EXPECTED_CONTENT_FILENAME)
-    if os.path.exists(expected_stdout_filename):
+    if exists(expected_stdout_filename):
         num_things_to_validate += 1
 
     config_file_path = os.path.join(single_test_target_folder, YAML_CONFIG_FILE)
-    if not os.path.exists(config_file_path):
+    if not exists(config_file_path):
         errors.append(f"Error: Couldn't find config.yaml for a test at {rel_path}")
 
     if num_things_to_validate == 0:
         errors.append(f"Error: You need to specify at least one of an 'output/' folder and 'stdout.txt'")
 
-    if errors:
-        print('\n'.join(errors))
-        return False
-
-    return True
+    return errors
+
+
+# The plan for a test (see suite_plan.py): what its config.yaml (with global.yaml) says, with definitions substituted,
+# and checked before any test is run. If errors isn't empty, the test can't be run. Plans are cached as JSON, so the
+# fields must be things JSON can hold (and PLAN_CACHE_VERSION changed when they change).
+@dataclass
+class TestPlan:
+    # stop pytest trying to collect this class
+    __test__ = False
+
+    errors: list = field(default_factory=list)
+    # every value in config.yaml and global.yaml (other than the definitions), with definitions substituted
+    values: dict = field(default_factory=dict)
+    # the command as given in config.yaml, before definitions are substituted
+    raw_command: str = None
+    tags: list = field(default_factory=list)
+    file_comparison_mode: str = COMPARISON_MODE_EXACT
+    compare_workers: int = 1
+    expected_return_code: int = 0
+    # limits on the command (see resource_limits.py)
+    timeout: float = None
+    max_memory: int = None
+    max_cpu_seconds: int = None
+    max_file_size: int = None
+    max_stdout_bytes: int = None
+    # how much more than its baseline the command can use, as fractions keyed by metric
+    regression_tolerances: dict = field(default_factory=dict)
+
+    # the value for key, or default if it's not given
+    def value(self, key, default=None):
+        value = self.values.get(key)
+        return default if value is None else value
+
+
+# gets a number from values with parse (e.g. int), or None if it's not given. Raises ValueError if it's not valid.
+def get_number_value(values, key, parse):
+    value = values.get(key)
+
+    if value is None:
+        return None
 
+    try:
+        number = parse(value)
+    except ValueError:
+        number = -1
+    if number < 0:
+        raise ValueError(f"{key} must be a number, 0 or more (not {value!r})")
 
-# run single in-out comparison test in this folder. Returns (bool, bool) for (problem was found trying to run tests
-# for this test suite dir, stdout problem status or comparison status (i.e. success/fail))
-def run_command_and_compare(global_config, target_folder, test_index, expected_stdout_filename=None, record=False, report_failure_only=False, summary_csv=False):
+    return number
 
-    if not validate_folder_structure(target_folder):
-        return False, False
 
-    definitions = global_config.get(DEFINITIONS_KEY, {})
+# Loads the config of the test in target_folder and works out its plan, with the global config and definitions
+# (see suite_plan.py). Anything wrong with the test is given in the plan's errors.
+def compile_test_plan(target_folder, global_config, definitions, archive=None):
+    plan = TestPlan()
 
-    config_file = os.path.join(target_folder, YAML_CONFIG_FILE)
+    if errors := validate_folder_structure(target_folder, archive):
+        plan.errors = errors
+        return plan
 
     try:
-        with open(config_file, 'r') as file:
-            config = yaml.safe_load(file)
-    except IOError as E:
-        print(f'\nCould not load config.yaml in {target_folder}')
-        return False, False
+        with open_suite_file(os.path.join(target_folder, YAML_CONFIG_FILE), archive) as file:
+            config = load_yaml(file) or {}
+    except (IOError, ValueError):
+        plan.errors.append(f"Error: Could not load config.yaml in {target_folder}")
+        return plan
 
-    # print(f"config: {config}")
+    if not isinstance(config, dict):
+        plan.errors.append(f"Error: config.yaml must be a map of keys to values, for a test at {target_folder}")
+        return plan
 
-    differences = []
-    stdout_differences = []
+    plan.values = resolve_config(config, global_config, definitions, ignore_keys=[DEFINITIONS_KEY])
+    plan.raw_command = config.get("command")
 
-    os.chdir(target_folder)
+    tags = plan.value(TAGS_KEY, [])
+    plan.tags = [tags] if isinstance(tags, str) else tags
 
-    shutil.rmtree(WORKING_DIR, ignore_errors=True)
-    shutil.copytree(INPUT_DIR, WORKING_DIR)
+    if not isinstance(plan.value("command"), str):
+        plan.errors.append(f"Error: a command must be given for a test at {target_folder}")
 
-    os.chdir(WORKING_DIR)
+    plan.file_comparison_mode = plan.value(FILE_COMPARISON_KEY, COMPARISON_MODE_EXACT)
+    if plan.file_comparison_mode not in COMPARISON_MODES:
+        plan.errors.append(f"Error: {FILE_COMPARISON_KEY} must be one of {COMPARISON_MODES} for a test at {target_folder}")
 
-    stdout_mismatch_found = False
+    try:
+        plan.compare_workers = int(plan.value(COMPARE_WORKERS_KEY, 1))
+    except ValueError:
+        plan.compare_workers = 0
+    if plan.compare_workers < 1:
+        plan.errors.append(f"Error: {COMPARE_WORKERS_KEY} must be a whole number, 1 or more, for a test at {target_folder}")
 
-    expected_stdout_content = None
+    try:
+        plan.expected_return_code = int(plan.value("expected_return_code", 0))
+    except ValueError:
+        plan.errors.append(f"Error: expected_return_code must be a whole number for a test at {target_folder}")
 
-    if not record and os.path.exists(expected_stdout_filename):
-        with open(expected_stdout_filename, 'rb') as f:
-            expected_stdout_content = f.read()
+    try:
+        plan.timeout = get_number_value(plan.values, TIMEOUT_KEY, float)
+        plan.max_memory = get_number_value(plan.values, MAX_MEMORY_KEY, parse_size)
+        plan.max_cpu_seconds = get_number_value(plan.values, MAX_CPU_SECONDS_KEY, int)
+        plan.max_file_size = get_number_value(plan.values, MAX_FILE_SIZE_KEY, parse_size)
+        plan.max_stdout_bytes = get_number_value(plan.values, MAX_STDOUT_BYTES_KEY, parse_size)
+    except ValueError as error:
+        plan.errors.append(f"Error: {error} for a test at {target_folder}")
 
-    # copy input to working folder
+    try:
+        for metric in METRICS:
+            key = REGRESSION_KEY_FORMAT.format(metric)
+            if (tolerance := plan.value(key)) is not None:
+                plan.regression_tolerances[metric] = parse_tolerance(tolerance)
+    except ValueError as error:
+        plan.errors.append(f"Error: {key} must be a percentage ({error}) for a test at {target_folder}")
 
-    command, raw_command = get_yaml_value_raw(config, global_config, "command", definitions)
+    try:
+        StdoutFilters(plan.value(STDOUT_FILTERS_KEY, []), ENCODING)
+    except ValueError as error:
+        plan.errors.append(f"Error: {error}, for a test at {target_folder}")
+
+    return plan
+
+
+# The stamp of the test in target_folder for the plan cache: that of its config.yaml, and which of the things
+# validate_folder_structure looks for it has. (Its dir's mtime would do for the latter, but running the test changes it.)
+def test_plan_stamp(target_folder):
+    return [path_stamp(os.path.join(target_folder, YAML_CONFIG_FILE))] + \
+        [os.path.exists(os.path.join(target_folder, name)) for name in
+         [INPUT_DIR, INPUT_MANIFEST_FILE, EXPECTED_OUTPUT_DIR, OUTPUT_MANIFEST_FILE, STD_OUT_EXPECTED_CONTENT_FILENAME]]
+
+
+# The plan for a test suite (see suite_plan.py)
+@dataclass
+class SuitePlan:
+    # the values in global.yaml (other than the definitions), with definitions substituted
+    global_values: dict = field(default_factory=dict)
+    # test dir -> TestPlan, for every test in the suite
+    tests: dict = field(default_factory=dict)
+    # test dir -> its compiled stdout filters (see stdout_filters.py), for the tests that can be run
+    stdout_filters: dict = field(default_factory=dict)
+
+    # the tests in test_dirs (a dict of test index to test dir) that can't be run, with what's wrong with them
+    def errors(self, test_dirs):
+        return [error for test_dir in test_dirs.values() for error in self.tests[test_dir].errors]
+
+
+# Loads global.yaml and the config.yaml of each test in the suite in root_dir (which is archive, if it's given), and
+# works out their plans. Plans cached in cache_dir (if it's given) are used for tests that haven't changed since, and
+# the cache is brought up to date. Returns None if global.yaml couldn't be loaded.
+def compile_suite_plan(root_dir, archive=None, cache_dir=None):
+    global_config = load_global_config(root_dir, archive)
+    if global_config is None:
+        return None
+
+    definitions = Definitions(global_config.get(DEFINITIONS_KEY))
+    suite_plan = SuitePlan(resolve_config({}, global_config, definitions, ignore_keys=[DEFINITIONS_KEY]))
+
+    plan_cache = None
+    if cache_dir:
+        # an archive can only be changed by writing it again, so its stamp stands for those of everything in it
+        global_stamp = path_stamp(archive.filename if archive else os.path.join(root_dir, YAML_GLOBAL_CONFIG_FILE))
+        plan_cache = PlanCache(os.path.join(cache_dir, PLAN_CACHE_FILE), global_stamp)
+
+    for test_dir in find_test_dirs(root_dir, archive):
+        test_name = os.path.basename(test_dir)
+        stamp = None if archive else test_plan_stamp(test_dir)
+
+        if plan_cache and (cached_plan := plan_cache.plan(test_name, stamp)) is not None:
+            suite_plan.tests[test_dir] = TestPlan(**cached_plan)
+            continue
+
+        suite_plan.tests[test_dir] = compile_test_plan(test_dir, global_config, definitions, archive)
+        if plan_cache:
+            plan_cache.add(test_name, stamp, asdict(suite_plan.tests[test_dir]))
+
+    if plan_cache:
+        plan_cache.save()
+
+    # each different list of stdout filters is only compiled once (most tests have global.yaml's, if any)
+    compiled_filters = {}
+    for test_dir, plan in suite_plan.tests.items():
+        if not plan.errors:
+            specs = plan.value(STDOUT_FILTERS_KEY, [])
+            key = json.dumps(specs, sort_keys=True, default=str)
+            if key not in compiled_filters:
+                compiled_filters[key] = StdoutFilters(specs, ENCODING)
+            suite_plan.stdout_filters[test_dir] = compiled_filters[key]
+
+    return suite_plan
+
+
+# The state of a single test as it passes through its phases: prepare_test (load config, copy input/ to working/),
+# then execute_command or execute_command_async (run the command), then finish_test (compare and report).
+@dataclass
+class TestRun:
+    # stop pytest trying to collect this class
+    __test__ = False
+
+    result: TestResult
+    options: RunOptions
+    plan: TestPlan = None
+    command: str = None
+    raw_command: str = None
+    input_strings_binary: bytes = None
+    always_delete_working_artifacts: bool = False
+    use_output_manifest: bool = False
+    compare_workers: int = 1
+    # limits on the command (see resource_limits.py)
+    resource_limits: ResourceLimits = field(default_factory=ResourceLimits)
+    # set if the command was stopped for going over one of its limits: RESULT_TIMEOUT or RESULT_LIMIT, and what happened
+    limit_status: str = None
+    limit_message: str = None
+    # set (with process_lock held) once the command has exited, after which it mustn't be killed, as its process group
+    # id could be reused as soon as it's reaped
+    reaped: bool = False
+    process_lock: threading.Lock = field(default_factory=threading.Lock)
+    # takes the command's stdout as it's read (see stdout_comparison.py)
+    stdout_pipeline: StdoutPipeline = None
+    # the dir containing working/: the test's dir, or a dir for the test inside the run's scratch dir
+    working_parent_dir: str = None
+    # set once the command has run
+    returncode: int = None
+    # the end of the command's stderr, if it was kept (see ResourceLimits.open_stderr)
+    stderr_tail: bytes = b''
+
+    @property
+    def target_folder(self):
+        return self.result.target_folder
+
+    @property
+    def working_dir(self):
+        return os.path.join(self.working_parent_dir or self.target_folder, WORKING_DIR)
+
+
+# Stops a run once options.max_failures of its tests have failed: tests that haven't started aren't run, and the
+# commands of those in flight are killed, so they finish as RESULT_CANCELLED. Shared by all the tests of a run, which
+# can be on many threads.
+class FailureLimit:
+    def __init__(self, max_failures):
+        self.max_failures = max_failures
+        self.failure_count = 0
+        self.stopped = False
+        # id of the test run -> (test run, process id), for the commands running now
+        self.running = {}
+        self.lock = threading.Lock()
+
+    def cancel(self, run, process_id):
+        stop_command(run, process_id, RESULT_CANCELLED, f"* Cancelled, as {self.max_failures} tests had failed")
+
+    # called as a test's command starts. If the run has been stopped, the command is killed straight away.
+    def command_started(self, run, process_id):
+        with self.lock:
+            if self.stopped:
+                self.cancel(run, process_id)
+            else:
+                self.running[id(run)] = (run, process_id)
+
+    # called before the command's process is waited for, so its id can't have been reused when it's killed
+    def command_finished(self, run):
+        with self.lock:
+            self.running.pop(id(run), None)
 
-    input_strings = get_yaml_value(config, global_config, "text_input", definitions)
+    def add_result(self, result):
+        if result.succeeded or result.status == RESULT_CANCELLED:
+            return
+
+        with self.lock:
+            self.failure_count += 1
+            if self.failure_count < self.max_failures or self.stopped:
+                return
+
+            self.stopped = True
+            for run, process_id in self.running.values():
+                self.cancel(run, process_id)
+            self.running.clear()
+
+
+# First phase of running a test: copies input/ to working/, and works out the command from the test's plan (see
+# compile_suite_plan), which must have no errors. If there was a problem, run.result.found_test_suite is False and the
+# test shouldn't be run any further.
+# This doesn't change the current dir (so tests can run in parallel): all paths are based on target_folder,
+# which must be an absolute path.
+def prepare_test(suite_plan, target_folder, test_index, options, check_stdout=True):
+
+    plan = suite_plan.tests[target_folder]
+    run = TestRun(TestResult(test_index, target_folder), options, plan)
+    result = run.result
+    result.timings.start(PHASE_CONFIG)
+
+    run.compare_workers = options.compare_workers or plan.compare_workers
+    run.resource_limits = ResourceLimits(max_memory=plan.max_memory, max_cpu_seconds=plan.max_cpu_seconds,
+                                         max_file_size=plan.max_file_size)
+    run.use_output_manifest = options.output_manifest or str(plan.value(OUTPUT_MANIFEST_KEY, '')).lower() == 'y'
+
+    if options.scratch_run_dir:
+        run.working_parent_dir = os.path.join(options.scratch_run_dir, f"{test_index}_{os.path.basename(target_folder)}")
+        # it's already there when the test is run again in the same run, by --benchmark
+        os.makedirs(run.working_parent_dir, exist_ok=True)
+
+    input_dir = os.path.join(target_folder, INPUT_DIR)
+    working_dir = run.working_dir
+    expected_stdout_filename = os.path.join(target_folder, STD_OUT_EXPECTED_CONTENT_FILENAME)
+
+    # copy input to working folder. Files the test declares read-only can be hard linked rather than copied,
+    # except when recording: working/ becomes output/, which mustn't share files with input/.
+    readonly_input_files = plan.value("readonly_input_files", [])
+    strategy = options.materialize_strategy
+    if options.record and strategy == STRATEGY_AUTO:
+        strategy = STRATEGY_REFLINK
+    elif options.record and strategy == STRATEGY_HARDLINK:
+        readonly_input_files = []
+
+    result.timings.start(PHASE_COPY)
+    shutil.rmtree(working_dir, ignore_errors=True)
+    input_manifest_filename = os.path.join(target_folder, INPUT_MANIFEST_FILE)
+    input_base = plan.value(INPUT_BASE_KEY)
+    if options.archive:
+        # only what's in the archive can be used: not the input bases or content store, which are dirs of the suite
+        if input_base or options.archive.exists(input_manifest_filename) or \
+                options.archive.exists(os.path.join(target_folder, OUTPUT_MANIFEST_FILE)):
+            result.found_test_suite = False
+            result.report.append(f"Error: {INPUT_BASE_KEY} and the content store can't be used when running from an "
+                                 f"archive (unpack it with blackbox_tools.py unpack), for a test at {target_folder}")
+            return run
+        result.materialize_stats = options.archive.extract_tree(input_dir, working_dir)
+    elif input_base:
+        # the base, then the test's input/ over it
+        try:
+            base_dir = options.input_bases.base_dir(input_base)
+        except ValueError as error:
+            result.found_test_suite = False
+            result.report.append(f"Error: {error}, for a test at {target_folder}")
+            return run
+        result.materialize_stats = materialize_tree(base_dir, working_dir, strategy, readonly_input_files)
+        if os.path.isdir(input_dir):
+            apply_overlay(input_dir, working_dir, strategy, readonly_input_files, result.materialize_stats)
+    elif os.path.exists(input_manifest_filename):
+        store_dir = store_dir_for_test(target_folder)
+        input_manifest = load_manifest(input_manifest_filename)
+        if input_manifest is None or missing_blobs(input_manifest, store_dir):
+            result.found_test_suite = False
+            result.report.append(f"Error: {INPUT_MANIFEST_FILE} can't be read, or the content store is missing some "
+                                 f"of its files, for a test at {target_folder}")
+            return run
+        result.materialize_stats = materialize_from_store(input_manifest, store_dir, working_dir, strategy,
+                                                          readonly_input_files)
+    else:
+        result.materialize_stats = materialize_tree(input_dir, working_dir, strategy, readonly_input_files)
+    result.timings.start(PHASE_CONFIG)
+
+    command = plan.value("command")
+    run.raw_command = plan.raw_command
+
+    input_strings = plan.value("text_input")
 
     # always del working artifacts, even if differences found
-    always_delete_working_artifacts = False
-    if always_delete_working_artifacts_str := get_yaml_value(config, global_config, "always_delete_working_artifacts", definitions):
-        if always_delete_working_artifacts_str.lower() == 'y':
-            always_delete_working_artifacts = True
+    if always_delete_working_artifacts_str := plan.value("always_delete_working_artifacts"):
+        if str(always_delete_working_artifacts_str).lower() == 'y':
+            run.always_delete_working_artifacts = True
 
     if input_strings is not None:
         input_strings = '%s\n' % '\n'.join(input_strings)
-        input_strings_binary = input_strings.encode(ENCODING)
-    else:
-        input_strings_binary = None
+        run.input_strings_binary = input_strings.encode(ENCODING)
 
     # we need to do this in-script replacement AFTER any yaml variable replacements above
-    command = command.replace("{WORKING_PATH}", make_abs_path(os.path.join(target_folder, WORKING_DIR)))
+    run.command = command.replace("{WORKING_PATH}", make_abs_path(working_dir))
+    if options.shared_dir:
+        run.command = run.command.replace("{SHARED_PATH}", options.shared_dir)
 
     # print(f'found command: {command}')
 
-    completed_process = subprocess.run(command, input=input_strings_binary, shell=True, capture_output=True)
+    # stdout is compared with stdout.txt (or recorded) as it's read, so it's never all in memory at once.
+    # If it doesn't match, what the command actually output is written to stdout_working.txt.
+    stdout_sink = None
+    if not check_stdout:
+        # benchmarking a test that's already been checked: stdout is read and thrown away
+        pass
+    elif options.record:
+        stdout_sink = StdoutRecording(expected_stdout_filename)
+    elif suite_path_exists(expected_stdout_filename, options.archive):
+        # nothing can be written to an archive, so for a test in one, stdout_working.txt goes with its working/
+        spill_dir = run.working_parent_dir if options.archive else target_folder
+        spill_filename = None if run.always_delete_working_artifacts else os.path.join(spill_dir, STDOUT_WORKING_COPY_FILE)
+        stdout_sink = StdoutComparison(open_suite_file(expected_stdout_filename, options.archive), spill_filename)
+
+    ignore_stdout_until_after_line_containing = plan.value("ignore_stdout_until_after_line_containing")
+    run.stdout_pipeline = StdoutPipeline(stdout_sink, ignore_stdout_until_after_line_containing, ENCODING,
+                                         suite_plan.stdout_filters.get(target_folder))
+
+    result.timings.stop()
+
+    return run
+
+
+# Stops the command (and anything it started) for going over one of its limits, unless it's already finished
+def stop_command(run, process_id, limit_status, limit_message):
+    with run.process_lock:
+        if run.reaped:
+            return
+
+        if run.limit_status is None:
+            run.limit_status = limit_status
+            run.limit_message = limit_message
 
-    expected_return_code = int(get_yaml_value(config, global_config, "expected_return_code", definitions, default_value=0))
+        kill_process_group(process_id)
 
-    ignore_stdout_until_after_line_containing = get_yaml_value(config, global_config, "ignore_stdout_until_after_line_containing", definitions)
 
-    # print(f"before trim len: {len(stdout_expected)} after trim: {len(expected_stdout_content)} trim to {ignore_stdout_until_after_line_containing}")
-    #
-    # print(f"Code: {completed_process.returncode} expected code: {expected_return_code}")
+# called once the command has exited, before it's reaped (see wait_for_process)
+def command_exited(run):
+    with run.process_lock:
+        run.reaped = True
 
-    response = None
 
-    if completed_process.returncode != expected_return_code:
-        differences.append(
-            f"Running the command returned status code: {completed_process.returncode} when expected: {expected_return_code}")
-    else:
-        # if record = False, the latter can still be None, if no stdout.txt file specified.
-        if record or expected_stdout_content is not None:
+# called as each chunk of stdout is read: stops the command if it's written more than max_stdout_bytes
+def check_stdout_limit(run, process_id):
+    if run.plan.max_stdout_bytes is not None and run.stdout_pipeline.bytes_read > run.plan.max_stdout_bytes:
+        stop_command(run, process_id, RESULT_LIMIT,
+                     f"* Wrote more than max_stdout_bytes ({run.plan.max_stdout_bytes} bytes) to standard out, so was killed")
+        return True
 
-            raw_response = completed_process.stdout
-            response = trim_lines_until_after_line_containing(raw_response, ignore_stdout_until_after_line_containing)
+    return False
+
+
+def write_stdin(stdin, input_strings_binary):
+    try:
+        stdin.write(input_strings_binary)
+    except BrokenPipeError:
+        # the command didn't read all its input
+        pass
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
 
-            if record:
-                # we are recording standard out to file
-                # print(f"Curr dir: {os.getcwd()}")
-                with open(expected_stdout_filename, 'wb') as stdout_file:
-                    stdout_file.write(response)
-            else:
-                if response != expected_stdout_content:
-                    stdout_differences.append(f"* standard out didn't match the output given in stdout.txt.")
-                    # print(f"Len found: {len(response)}, len expected: {len(expected_stdout_content)}")
-                    # differences.append(f"* standard out didn't match the output given in stdout.txt.
-                    # Expected:\n===8<===\n{expected_stdout_content}\n=== but I got:\n{response}\n===8<===")
-                    stdout_mismatch_found = True
 
+# Second phase of running a test: runs the command, with working/ as its cwd.
+# stdout is passed to the test's stdout pipeline a chunk at a time, while stdin is written on another thread.
+def execute_command(run):
+    run.result.timings.start(PHASE_SUBPROCESS)
 
-        # come up out of working/ folder, back to target_folder (root of this single test)
-        os.chdir("..")
+    start_time = time.perf_counter()
+    stderr_file = run.resource_limits.open_stderr()
+    # in a new session (so process group) of its own, so it can be killed along with anything it starts
+    process = subprocess.Popen(run.resource_limits.shell_prefix() + run.command, shell=True,
+                               stdin=subprocess.PIPE if run.input_strings_binary is not None else None,
+                               stdout=subprocess.PIPE, stderr=stderr_file or subprocess.DEVNULL, cwd=run.working_dir,
+                               start_new_session=True)
 
-        output_dir_provided = os.path.exists(EXPECTED_OUTPUT_DIR)
+    failure_limit = run.options.failure_limit
+    if failure_limit:
+        failure_limit.command_started(run, process.pid)
 
-        if record:
-            shutil.rmtree(EXPECTED_OUTPUT_DIR, ignore_errors=True)
-            os.rename(WORKING_DIR, EXPECTED_OUTPUT_DIR)
+    timer = None
+    if run.plan.timeout is not None:
+        timer = threading.Timer(run.plan.timeout, stop_command,
+                                args=(run, process.pid, RESULT_TIMEOUT, f"* Timed out after {run.plan.timeout}s, so was killed"))
+        timer.start()
+
+    stdin_thread = None
+    if run.input_strings_binary is not None:
+        stdin_thread = threading.Thread(target=write_stdin, args=(process.stdin, run.input_strings_binary))
+        stdin_thread.start()
+
+    with process.stdout:
+        while chunk := process.stdout.read(STDOUT_CHUNK_SIZE):
+            run.stdout_pipeline.feed(chunk)
+            if check_stdout_limit(run, process.pid):
+                break
+
+    if stdin_thread:
+        stdin_thread.join()
+
+    if failure_limit:
+        failure_limit.command_finished(run)
+
+    # rather than process.wait(), to get the command's resource usage
+    run.returncode, run.result.resource_usage = wait_for_process(process, start_time, lambda: command_exited(run))
+
+    if timer:
+        timer.cancel()
+
+    if stderr_file:
+        run.stderr_tail = read_stderr_tail(stderr_file)
+
+    run.stdout_pipeline.finish()
+
+    run.result.timings.stop()
+    run.result.timings.add_nested(PHASE_STDOUT, run.stdout_pipeline.time_spent, PHASE_SUBPROCESS)
+
+
+# As execute_command, but doesn't block the event loop while the command runs. The command is started with Popen
+# rather than asyncio's subprocess functions, so BBT (not asyncio) waits for it, and gets its resource usage.
+async def execute_command_async(run):
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+
+    run.result.timings.start(PHASE_SUBPROCESS)
+
+    start_time = time.perf_counter()
+    stderr_file = run.resource_limits.open_stderr()
+    process = subprocess.Popen(run.resource_limits.shell_prefix() + run.command, shell=True,
+                               stdin=subprocess.PIPE if run.input_strings_binary is not None else None,
+                               stdout=subprocess.PIPE, stderr=stderr_file or subprocess.DEVNULL, cwd=run.working_dir,
+                               start_new_session=True)
+
+    failure_limit = run.options.failure_limit
+    if failure_limit:
+        failure_limit.command_started(run, process.pid)
+
+    stdout_reader = asyncio.StreamReader()
+    stdout_transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(stdout_reader), process.stdout)
+
+    async def read_stdout_async():
+        while chunk := await stdout_reader.read(STDOUT_CHUNK_SIZE):
+            run.stdout_pipeline.feed(chunk)
+            if check_stdout_limit(run, process.pid):
+                break
+
+    async def communicate_async():
+        if run.input_strings_binary is not None:
+            # the input is usually small enough to go straight into the pipe, so this rarely holds up a thread for long
+            await asyncio.gather(loop.run_in_executor(None, write_stdin, process.stdin, run.input_strings_binary),
+                                 read_stdout_async())
+        else:
+            await read_stdout_async()
+
+        if failure_limit:
+            failure_limit.command_finished(run)
+
+        return await wait_for_process_async(process, start_time, lambda: command_exited(run))
+
+    try:
+        try:
+            run.returncode, run.result.resource_usage = await asyncio.wait_for(communicate_async(), run.plan.timeout)
+        except asyncio.TimeoutError:
+            stop_command(run, process.pid, RESULT_TIMEOUT, f"* Timed out after {run.plan.timeout}s, so was killed")
+            if failure_limit:
+                failure_limit.command_finished(run)
+            run.returncode, run.result.resource_usage = await wait_for_process_async(process, start_time,
+                                                                                     lambda: command_exited(run))
+    finally:
+        stdout_transport.close()
+
+        if stderr_file:
+            run.stderr_tail = read_stderr_tail(stderr_file)
+
+    run.stdout_pipeline.finish()
+
+    run.result.timings.stop()
+    run.result.timings.add_nested(PHASE_STDOUT, run.stdout_pipeline.time_spent, PHASE_SUBPROCESS)
+
+
+# Last phase of running a test: compares stdout and working/ with what's expected, and builds the report.
+# Returns a TestResult: found_test_suite is False if a problem was found trying to run tests for this test
+# suite dir, and succeeded gives the stdout problem status or comparison status (i.e. success/fail).
+def finish_test(run):
+    result = run.result
+
+    if not result.found_test_suite:
+        return result
+
+    result.timings.start(PHASE_COMPARE)
+
+    options = run.options
+    plan = run.plan
+    target_folder = run.target_folder
+    working_dir = run.working_dir
+    expected_output_dir = os.path.join(target_folder, EXPECTED_OUTPUT_DIR)
+    expected_stdout_filename = os.path.join(target_folder, STD_OUT_EXPECTED_CONTENT_FILENAME)
+    always_delete_working_artifacts = run.always_delete_working_artifacts
+    stdout_sink = run.stdout_pipeline.sink
+    exit_on_first_difference = options.exit_on_first_difference
+
+    differences = []
+    stdout_differences = []
+
+    stdout_mismatch_found = False
+
+    expected_return_code = plan.expected_return_code
+
+    # print(f"Code: {run.returncode} expected code: {expected_return_code}")
+
+    # the command went over a limit set with ulimit (those stopped by BBT are already noted)
+    if run.limit_status is None and \
+            (limit_message := run.resource_limits.exceeded_message(run.returncode, expected_return_code,
+                                                                   run.stderr_tail)):
+        run.limit_status = RESULT_LIMIT
+        run.limit_message = limit_message
+
+    if run.limit_status:
+        differences.append(run.limit_message)
+
+        # stdout isn't of interest (or recorded) if the command was stopped
+        run.stdout_pipeline.discard()
+    elif run.returncode != expected_return_code:
+        differences.append(f"Running the command returned status code: {run.returncode} when expected: {expected_return_code}")
+        if hint := run.resource_limits.failure_hint():
+            differences.append(hint)
+
+        # stdout isn't of interest (or recorded) if the command failed
+        run.stdout_pipeline.discard()
+    else:
+        # if record = False, the sink can still be None, if no stdout.txt file specified.
+        if options.record:
+            # we are recording standard out to file
+            stdout_sink.keep()
+        elif stdout_sink and not stdout_sink.matched:
+            stdout_differences.append(f"* standard out didn't match the output given in stdout.txt. "
+                                      f"First difference at byte {stdout_sink.mismatch_offset} "
+                                      f"(line {stdout_sink.mismatch_line})")
+            stdout_mismatch_found = True
+
+        output_dir_provided = suite_path_exists(expected_output_dir, options.archive)
+        # output/ given as a manifest of files in the suite's content store (see content_store.py)
+        output_manifest_filename = os.path.join(target_folder, OUTPUT_MANIFEST_FILE)
+        uses_store = not output_dir_provided and (os.path.exists(output_manifest_filename) or
+                                                  os.path.exists(os.path.join(target_folder, INPUT_MANIFEST_FILE)))
+
+        if options.record and uses_store:
+            save_tree_manifest(add_tree_to_store(working_dir, store_dir_for_test(target_folder),
+                                                 ignore_files_for_comparison_scan), output_manifest_filename)
+            shutil.rmtree(working_dir, ignore_errors=True)
+        elif options.record:
+            shutil.rmtree(expected_output_dir, ignore_errors=True)
+            # working/ might be in a scratch dir on another filesystem
+            shutil.move(working_dir, expected_output_dir)
+
+            if options.cache_dir:
+                save_manifest(build_manifest(expected_output_dir, ignore_files_for_comparison_scan),
+                              output_manifest_cache_filename(options.cache_dir, target_folder))
+        elif stdout_mismatch_found and exit_on_first_difference:
+            # the test has already failed, so working/ isn't compared with output/
+            pass
+        elif output_dir_provided and options.archive:
+            # output/'s files are read from the archive as they're compared, without extracting them
+            compare_folder_to_manifest(WORKING_DIR, options.archive.tree_manifest(expected_output_dir), EXPECTED_OUTPUT_DIR,
+                                       differences, exit_on_first_difference=exit_on_first_difference,
+                                       ignore_files=ignore_files_for_comparison_scan, base_dir=os.path.dirname(working_dir),
+                                       compare_file=options.archive.file_comparison(expected_output_dir))
+        elif output_dir_provided and run.use_output_manifest and options.cache_dir:
+            # only working/ has to be read: output/ is described by its manifest, which is only updated
+            # for files that have changed since it was cached
+            manifest = cached_manifest(expected_output_dir, output_manifest_cache_filename(options.cache_dir, target_folder),
+                                       ignore_files_for_comparison_scan)
+            compare_folder_to_manifest(WORKING_DIR, manifest, EXPECTED_OUTPUT_DIR, differences,
+                                       exit_on_first_difference=exit_on_first_difference,
+                                       ignore_files=ignore_files_for_comparison_scan, base_dir=os.path.dirname(working_dir))
+        elif uses_store and os.path.exists(output_manifest_filename):
+            # the manifest has the hash of each output file, so only working/ is read, apart from files hard
+            # linked from the store, which are known to match
+            manifest = load_manifest(output_manifest_filename)
+            if manifest is None:
+                differences.append(f"* {OUTPUT_MANIFEST_FILE} isn't a manifest BBT can read")
+            else:
+                compare_folder_to_manifest(WORKING_DIR, manifest, EXPECTED_OUTPUT_DIR, differences,
+                                           exit_on_first_difference=exit_on_first_difference,
+                                           ignore_files=ignore_files_for_comparison_scan,
+                                           base_dir=os.path.dirname(working_dir),
+                                           is_known_match=is_link_to_blob(store_dir_for_test(target_folder)))
         elif output_dir_provided:
-            if os.path.exists(EXPECTED_OUTPUT_DIR):
-                compare_folders(WORKING_DIR, EXPECTED_OUTPUT_DIR, differences, exit_on_first_difference=False,
-                                section_size=1024 * 64, ignore_files=ignore_files_for_comparison_scan)
+            # paths are given relative to their parent dirs so the differences read e.g. 'Between working and output'
+            compare_folders(WORKING_DIR, EXPECTED_OUTPUT_DIR, differences, exit_on_first_difference=exit_on_first_difference,
+                            section_size=1024 * 64, ignore_files=ignore_files_for_comparison_scan,
+                            base_dir1=os.path.dirname(working_dir), base_dir2=target_folder,
+                            comparison_mode=plan.file_comparison_mode, workers=run.compare_workers)
 
     file_tree_diffs_found = True if len(differences) else False
     differences = stdout_differences + differences
 
-    test_description = get_yaml_value(config, global_config, 'test_description', definitions)
+    # a hard linked file is the same file as the one in input/ (or the content store), so writing to it changed that
+    if result.materialize_stats:
+        differences += [f"* Wrote to {os.path.relpath(path, target_folder)}, which is in readonly_input_files, so was "
+                        f"hard linked into working/ and has been changed too"
+                        for path in changed_hard_links(result.materialize_stats)]
+
+    # the command's resource usage, against the baseline saved when the test was recorded. Only for a command
+    # that ran to the end as expected, as one that didn't has nothing to compare.
+    command_completed = not run.limit_status and run.returncode == expected_return_code
+    if command_completed and result.resource_usage is not None:
+        baseline_filename = os.path.join(target_folder, RESOURCE_BASELINE_FILE)
+
+        if options.record:
+            save_baseline(baseline_filename, result.resource_usage)
+        elif plan.regression_tolerances:
+            baseline = load_baseline(baseline_filename, lambda path: open_suite_file(path, options.archive))
+            if baseline is None:
+                result.diagnostics.append(f"No {RESOURCE_BASELINE_FILE} to check the command's resource usage against")
+            else:
+                differences += regressions(result.resource_usage, baseline, plan.regression_tolerances)
+
+    test_description = plan.value('test_description')
 
     test_failed = (len(differences) > 0)
 
-    if not file_tree_diffs_found or always_delete_working_artifacts:
-        # print(f" =========== no stdout difference, so deleting dir {WORKING_DIR}")
+    result.timings.start(PHASE_CLEANUP)
+
+    # a cancelled test's working/ isn't of any use, as the command didn't get to finish
+    if not file_tree_diffs_found or always_delete_working_artifacts or run.limit_status == RESULT_CANCELLED:
+        # print(f" =========== no stdout difference, so deleting dir {working_dir}")
         # we want to keep working dir for comparisons when input/output comparison fails.
-        shutil.rmtree(WORKING_DIR, ignore_errors=True)
+        shutil.rmtree(working_dir, ignore_errors=True)
     else:
-        eprint(f"Found diffs!  {differences} always_del = {always_delete_working_artifacts}")
-    # else:
-    #     print(f" =========== found stdout difference, so not deleting dir {WORKING_DIR}, stdout diff = {stdout_differences}")
+        result.diagnostics.append(f"Found diffs!  {differences} always_del = {always_delete_working_artifacts}")
 
-    result = f"FAILED" if test_failed else f"SUCCESS"
+        # a working/ dir in the scratch dir is deleted at the end of the run, unless it's wanted for debugging.
+        # For a suite in an archive, the scratch dir is kept instead (see run_all_tests).
+        if run.working_parent_dir and options.debug_artifacts and not options.archive:
+            suite_working_dir = os.path.join(target_folder, WORKING_DIR)
+            shutil.rmtree(suite_working_dir, ignore_errors=True)
+            shutil.move(working_dir, suite_working_dir)
 
-    if not report_failure_only or test_failed:
-        if summary_csv:
-            output = f'{test_index},{result},"{test_description}","{os.path.basename(target_folder)}",{raw_command}'
-        else:
-            output = f"\nTest {test_index} {result}: \"{test_description}\" in dir \"{os.path.basename(target_folder)}\""
+    result.timings.stop()
+
+    result_text = run.limit_status or (f"FAILED" if test_failed else f"SUCCESS")
+    result.status = result_text
+
+    if not options.report_failure_only or test_failed:
+        output = test_report_line(options, result.test_index, result_text, test_description, target_folder, run.raw_command)
 
         if test_failed:
-            pr_red(output)
+            result.report.append(red(output))
         else:
-            print(output)
+            result.report.append(output)
 
         if test_failed:
             indent = '   '
             indent_newline = f"\n{indent}"
-            pr_yellow("%s%s" % (indent, indent_newline.join(differences)))
+            result.report.append(yellow("%s%s" % (indent, indent_newline.join(differences))))
+
+    result.succeeded = (not stdout_mismatch_found) and len(differences) == 0
+
+    return result
+
+
+def test_report_line(options, test_index, result_text, test_description, target_folder, raw_command):
+    if options.summary_csv:
+        return f'{test_index},{result_text},"{test_description}","{os.path.basename(target_folder)}",{raw_command}'
+
+    return f"\nTest {test_index} {result_text}: \"{test_description}\" in dir \"{os.path.basename(target_folder)}\""
+
+
+# The fingerprint of the test in target_folder (see result_cache.py), or None if the test isn't valid.
+def fingerprint_test(suite_plan, target_folder, options, result_cache):
+    plan = suite_plan.tests[target_folder]
+    if plan.errors:
+        return None
+
+    test_name = os.path.basename(target_folder)
+
+    # the config as the test sees it, with global.yaml values and definitions applied (so including the command)
+    resolved_config = plan.values
+
+    # a tree in the content store is described by its manifest, which has the hashes of all its files
+    input_manifest_filename = os.path.join(target_folder, INPUT_MANIFEST_FILE)
+    if os.path.exists(input_manifest_filename):
+        input_digest = result_cache.file_digest(input_manifest_filename)
+    else:
+        input_digest = tree_digest(cached_manifest(os.path.join(target_folder, INPUT_DIR),
+                                                   os.path.join(options.cache_dir, INPUT_MANIFESTS_CACHE_DIR, f"{test_name}.json"),
+                                                   ignore_files_for_comparison_scan))
+
+    input_base_digest = None
+    if input_base := resolved_config.get(INPUT_BASE_KEY):
+        base_dir = os.path.join(os.path.dirname(target_folder), INPUT_BASES_DIR, str(input_base))
+        if not os.path.isdir(base_dir):
+            return None
+        input_base_digest = tree_digest(cached_manifest(base_dir, os.path.join(options.cache_dir, INPUT_MANIFESTS_CACHE_DIR,
+                                                                               INPUT_BASES_DIR, f"{input_base}.json"),
+                                                        ignore_files_for_comparison_scan))
+
+    expected_output_dir = os.path.join(target_folder, EXPECTED_OUTPUT_DIR)
+    output_manifest_filename = os.path.join(target_folder, OUTPUT_MANIFEST_FILE)
+    output_digest = None
+    if os.path.exists(expected_output_dir):
+        output_digest = tree_digest(cached_manifest(expected_output_dir,
+                                                    output_manifest_cache_filename(options.cache_dir, target_folder),
+                                                    ignore_files_for_comparison_scan))
+    elif os.path.exists(output_manifest_filename):
+        output_digest = result_cache.file_digest(output_manifest_filename)
+
+    depends_on = resolved_config.get(DEPENDS_ON_KEY) or []
+    if isinstance(depends_on, str):
+        depends_on = [depends_on]
+
+    return fingerprint({
+        'config': resolved_config,
+        'input': input_digest,
+        'input_base': input_base_digest,
+        'output': output_digest,
+        'stdout': result_cache.file_digest(os.path.join(target_folder, STD_OUT_EXPECTED_CONTENT_FILENAME)),
+        'resource_baseline': result_cache.file_digest(os.path.join(target_folder, RESOURCE_BASELINE_FILE)),
+        'depends_on': {path: result_cache.file_digest(os.path.join(target_folder, path)) for path in depends_on},
+        # named by a hash of the setup and its inputs (see suite_setup.py)
+        'shared_dir': options.shared_dir,
+    })
+
 
-    if stdout_mismatch_found and not always_delete_working_artifacts:
+# For --benchmark: runs the test's command options.warmup times, then options.benchmark times, each time in a fresh
+# working/. The output isn't checked, as the test has already passed. Returns the resource usage of the timed runs,
+# or None if a run failed.
+def benchmark_test(suite_plan, target_folder, test_index, options):
+    usages = []
 
-        with open(STDOUT_WORKING_COPY_FILE, 'wb') as stdout_found:
-            # print(f"Writing len {len(response)} to file because not matched")
-            stdout_found.write(response)
+    for iteration in range(options.warmup + options.benchmark):
+        run = prepare_test(suite_plan, target_folder, test_index, options, check_stdout=False)
+        if not run.result.found_test_suite:
+            return None
 
-    # print('\n')
-    # back to root of test suite (where all test folders are based)
-    os.chdir("../..")
+        execute_command(run)
+        shutil.rmtree(run.working_dir, ignore_errors=True)
 
-    test_succeeded = (not stdout_mismatch_found) and len(differences) == 0
+        if run.limit_status or run.returncode != run.plan.expected_return_code:
+            return None
 
-    return True, test_succeeded
+        if iteration >= options.warmup:
+            usages.append(run.result.resource_usage)
 
+    return usages
 
-def process_empty_dirs(root_dir, create_empty_dir_droppings=False):
+
+# Benchmarks the tests that passed, writing the results to options.benchmark_file. Returns the summary of each test's
+# runs, by test name. Tests that couldn't be benchmarked are noted in diagnostics.
+def run_benchmarks(suite_plan, root_dir, results, options, diagnostics):
+    tests = {}
+
+    for result in results:
+        if not result.succeeded:
+            continue
+
+        test_name = os.path.basename(result.target_folder)
+        usages = benchmark_test(suite_plan, result.target_folder, result.test_index, options)
+        if usages is None:
+            diagnostics.append(f"Couldn't benchmark {test_name}, as one of its runs failed")
+            continue
+
+        tests[test_name] = summarize_runs(usages)
+
+    if options.benchmark_file:
+        save_benchmark_file(options.benchmark_file, root_dir, options.warmup, options.benchmark, tests)
+
+    return tests
+
+
+# the result for a test that wasn't run as it passed last time, and hasn't changed since
+def cached_test_result(suite_plan, target_folder, test_index, options):
+    result = TestResult(test_index, target_folder, succeeded=True, cached=True, status="SUCCESS")
+
+    if not options.report_failure_only:
+        plan = suite_plan.tests[target_folder]
+        result_text = "SUCCESS" if options.summary_csv else "SUCCESS (cached)"
+        result.report.append(test_report_line(options, test_index, result_text, plan.value('test_description'),
+                                              target_folder, plan.raw_command))
+
+    return result
+
+
+# run single in-out comparison test in this folder. Returns a TestResult (see finish_test), or None if the run had
+# reached options.max_failures before the test started (see FailureLimit).
+def run_command_and_compare(suite_plan, target_folder, test_index, options):
+    if options.failure_limit and options.failure_limit.stopped:
+        return None
+
+    start_time = time.perf_counter()
+
+    run = prepare_test(suite_plan, target_folder, test_index, options)
+
+    if run.result.found_test_suite:
+        execute_command(run)
+
+    result = finish_test(run)
+    result.duration = time.perf_counter() - start_time
+
+    if options.failure_limit:
+        options.failure_limit.add_result(result)
+
+    return result
+
+
+# As run_command_and_compare, for the asyncio engine. The copying and comparing are done on the loop's
+# default thread pool, so they overlap with other tests' commands; the semaphore limits how many tests are in flight.
+async def run_command_and_compare_async(suite_plan, target_folder, test_index, options, semaphore):
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+
+    async with semaphore:
+        if options.failure_limit and options.failure_limit.stopped:
+            return None
+
+        start_time = time.perf_counter()
+
+        run = await loop.run_in_executor(None, prepare_test, suite_plan, target_folder, test_index, options)
+
+        if run.result.found_test_suite:
+            await execute_command_async(run)
+
+        result = await loop.run_in_executor(None, finish_test, run)
+        result.duration = time.perf_counter() - start_time
+
+        if options.failure_limit:
+            options.failure_limit.add_result(result)
+
+        return result
+
+
+# runs all tests with the asyncio engine, calling report_result with each result in the order of test_dirs (a dict
+# of test index to test dir). Tests with a result in cached_results aren't run.
+async def run_tests_async(suite_plan, test_dirs, options, report_result, cached_results={}):
+    import asyncio
+
+    semaphore = asyncio.Semaphore(options.jobs)
+
+    tasks = {test_index: None if test_index in cached_results else
+             asyncio.create_task(run_command_and_compare_async(suite_plan, test_dir, test_index, options, semaphore))
+             for test_index, test_dir in test_dirs.items()}
+
+    for test_index, task in tasks.items():
+        report_result(cached_results[test_index] if task is None else await task)
+
+
+# Looks for empty dirs in the test suite, or only in the given test dirs
+def process_empty_dirs(root_dir, create_empty_dir_droppings=False, test_dirs=None):
     empty_dirs = []
 
-    for root, dirs, files in os.walk(root_dir, topdown=True):
-        #eprint(f"root: {root} files: {files} dirs: {dirs}")
-        filtered_files = [f for f in files if f not in ignore_files_for_empty_dir_detection]
-        if not filtered_files and not dirs:
-            empty_dirs.append(root)
-            if create_empty_dir_droppings:
-                dropping_file = os.path.join(root, BBT_IGNORE_FILE)
-                eprint(f"Creating dropping: {dropping_file}")
-                with open(dropping_file, 'w'):
-                    pass
+    for dir_to_walk in test_dirs if test_dirs is not None else [root_dir]:
+        for root, dirs, files in os.walk(dir_to_walk, topdown=True):
+            #eprint(f"root: {root} files: {files} dirs: {dirs}")
+            filtered_files = [f for f in files if f not in ignore_files_for_empty_dir_detection]
+            if not filtered_files and not dirs:
+                empty_dirs.append(root)
+                if create_empty_dir_droppings:
+                    dropping_file = os.path.join(root, BBT_IGNORE_FILE)
+                    eprint(f"Creating dropping: {dropping_file}")
+                    with open(dropping_file, 'w'):
+                        pass
 
     if empty_dirs:
         eprint(f"Empty dirs: {empty_dirs}")
 
 
-def run_all_tests(root_dir, record=False, report_failure_only=False, summary_csv=False):
-    root_dir = os.path.abspath(root_dir)
+# returns the sorted absolute paths of the test dirs in a test suite (i.e. the top level dirs in root_dir, which
+# is the suite's archive if archive is given)
+def find_test_dirs(root_dir, archive=None):
+    if archive:
+        dirs = [name for name in archive.list_dirs(root_dir) if name not in ignore_dirs]
+    else:
+        dirs = [x.name for x in os.scandir(root_dir) if x.is_dir() and x.name not in ignore_dirs]
+    dirs.sort()
 
-    if not os.path.exists(root_dir):
-        print(f"Couldn't find test suite directory: {root_dir}.\nExiting.\n\n")
+    return [os.path.join(root_dir, dir) for dir in dirs]
+
+
+# True if the test dir matches any of the patterns: globs for the test dir's name, or 'tag:<tag>' for tests
+# with that tag in their config.yaml (tags)
+def test_matches_any(test_dir, patterns, tags):
+    for pattern in patterns:
+        if pattern.startswith(TAG_PATTERN_PREFIX):
+            if pattern[len(TAG_PATTERN_PREFIX):] in tags:
+                return True
+        elif fnmatch.fnmatch(os.path.basename(test_dir), pattern):
+            return True
+
+    return False
+
+
+def history_filename(root_dir, options):
+    return options.history_file or os.path.join(get_cache_dir(root_dir, options.cache_dir), HISTORY_FILE)
+
+
+# returns a dict of test index to test dir for the tests to run: all the tests in the suite, less any not
+# matching options.select (if given) or matching options.exclude. Test indexes are the same as in a full run.
+# Tags are taken from the suite's plan (see compile_suite_plan), for the suite in root_dir.
+# With options.shard, only the tests in that shard of the selected tests are returned.
+def find_selected_tests(root_dir, options, suite_plan):
+    test_dirs = {}
+
+    for test_index, (test_dir, plan) in enumerate(suite_plan.tests.items()):
+        if options.select and not test_matches_any(test_dir, options.select, plan.tags):
+            continue
+        if options.exclude and test_matches_any(test_dir, options.exclude, plan.tags):
+            continue
+
+        test_dirs[test_index] = test_dir
+
+    if options.shard:
+        shard_index, shard_count = options.shard
+        durations = TestHistory(history_filename(root_dir, options)).durations()
+
+        test_names = [os.path.basename(test_dir) for test_dir in test_dirs.values()]
+        shard_test_names = set(shard_tests(test_names, shard_index, shard_count, durations))
+        test_dirs = {test_index: test_dir for test_index, test_dir in test_dirs.items()
+                     if os.path.basename(test_dir) in shard_test_names}
+
+    return test_dirs
+
+
+# prints the result of a single test. Exits if the test couldn't be run at all.
+def report_test_result(result):
+    for line in result.diagnostics:
+        eprint(line)
+
+    for line in result.report:
+        print(line)
+
+    if not result.found_test_suite:
+        print(
+            '\nError when running test suite, giving up. Did you specify the correct folder?\nTypically you '
+            'want to specify a folder two directories up from the input/ and output/ folders.\n')
         sys.exit(1)
 
+
+# loads global.yaml from the test suite dir, if there is one. Returns None if it couldn't be loaded.
+def load_global_config(root_dir, archive=None):
     global_config = {}
 
     yaml_global_config_path = f'{root_dir}/{YAML_GLOBAL_CONFIG_FILE}'
 
-    if os.path.exists(yaml_global_config_path):
+    if suite_path_exists(yaml_global_config_path, archive):
         try:
-            with open(yaml_global_config_path, 'r') as file:
-                global_config = yaml.safe_load(file)
-        except IOError:
+            with open_suite_file(yaml_global_config_path, archive) as file:
+                global_config = load_yaml(file) or {}
+        except (IOError, ValueError):
+            return None
 
-            print(f"\nCouldn't open global.yaml found in {root_dir}")
-            return False, False
+    return global_config if isinstance(global_config, dict) else None
 
-    # remap all vars to {var} in the global config
-    if global_config:
-        vars = global_config.get(DEFINITIONS_KEY, {})
 
-        vars = dict((f"{{{key}}}", val) for key, val in vars.items())
+# The values in the suite's global.yaml, with definitions substituted, or None if it can't be loaded. For when the
+# suite's plan isn't needed (see compile_suite_plan), as no test's config.yaml is loaded.
+def load_global_values(root_dir, archive=None):
+    global_config = load_global_config(root_dir, archive)
+    if global_config is None:
+        return None
 
-        global_config[DEFINITIONS_KEY] = vars
+    return resolve_config({}, global_config, Definitions(global_config.get(DEFINITIONS_KEY)),
+                          ignore_keys=[DEFINITIONS_KEY])
 
-    for root, dirs, files in os.walk(root_dir, topdown=True):
 
-        test_index = 0
-        succeeded_test_count = 0
-        failed_test_count = 0
+# the scratch root to use: the one given on the command line, or else the one in global.yaml (or None).
+# global_values are the suite's (see SuitePlan).
+def get_scratch_root(global_values, scratch_root_option=None):
+    if scratch_root_option:
+        return scratch_root_option
 
-        dirs_filt = [x for x in dirs if not x in ignore_dirs]
-        dirs_filt.sort()
+    return global_values.get(SCRATCH_ROOT_KEY)
 
-        for dir in dirs_filt:
 
-            target_dir = os.path.join(root_dir, dir)
+# the dir for things kept between runs of the test suite
+def get_cache_dir(root_dir, cache_dir_option=None):
+    if cache_dir_option:
+        return os.path.abspath(cache_dir_option)
 
-            # expected_stdout_filename = os.path.join(target_dir, STD_OUT_EXPECTED_CONTENT_FILENAME)
-            expected_stdout_filename = os.path.join("..", STD_OUT_EXPECTED_CONTENT_FILENAME)
+    root_dir = os.path.abspath(root_dir)
+    root_dir_hash = hashlib.sha1(root_dir.encode(ENCODING)).hexdigest()[:12]
 
-            # print(f"running test in target_dir = {target_dir}")
-            (found_test_suite, test_status) = run_command_and_compare(global_config, target_dir, test_index,
-                                                                      expected_stdout_filename, record, report_failure_only, summary_csv=summary_csv)
+    return os.path.join(DEFAULT_CACHE_ROOT, f"{os.path.basename(root_dir)}-{root_dir_hash}")
 
-            if not found_test_suite:
-                print(
-                    '\nError when running test suite, giving up. Did you specify the correct folder?\nTypically you '
-                    'want to specify a folder two directories up from the input/ and output/ folders.\n')
-                sys.exit(1)
 
-            if test_status:
-                succeeded_test_count += 1
-            else:
-                failed_test_count += 1
+def output_manifest_cache_filename(cache_dir, target_folder):
+    return os.path.join(cache_dir, MANIFESTS_CACHE_DIR, f"{os.path.basename(target_folder)}.json")
 
-            test_index += 1
 
-        # replace dirs list in-place to stop any descending further in the tree
-        dirs[:] = []
+# makes a unique dir for this run inside the scratch root, recording which test suite it's for
+def make_scratch_run_dir(scratch_root, root_dir):
+    os.makedirs(scratch_root, exist_ok=True)
+    scratch_run_dir = tempfile.mkdtemp(prefix=SCRATCH_RUN_DIR_PREFIX, dir=scratch_root)
 
-    print(f"\n{failed_test_count} failures in {test_index} tests.\n")
+    with open(os.path.join(scratch_run_dir, SCRATCH_SUITE_DIR_FILE), 'w') as file:
+        file.write(root_dir)
 
+    return scratch_run_dir
 
-# removes diagnostic files from test suite, i.e. working/ dirs and stdout_working.txt files.
+
+# Runs the tests in the suite in root_dir (a suite dir, or a suite archive), and returns a SuiteResult. Nothing is
+# printed: report_result, if given, is called with each TestResult as soon as it (and those before it) are done, in
+# test index order. Raises SuiteError if the suite can't be run at all.
+def run_suite(root_dir, options, report_result=None):
+    root_dir = os.path.abspath(root_dir)
+
+    if not os.path.exists(root_dir):
+        raise SuiteError(f"Couldn't find test suite directory: {root_dir}")
+
+    # a suite can be run straight from its archive, without unpacking it (see suite_archive.py)
+    try:
+        archive = SuiteArchive(root_dir) if is_suite_archive(root_dir) else None
+    except ValueError as error:
+        raise SuiteError(str(error))
+    options = replace(options, archive=archive)
+
+    options = replace(options, cache_dir=get_cache_dir(root_dir, options.cache_dir))
+
+    # every test's config is loaded and checked before any test is run
+    suite_plan = compile_suite_plan(root_dir, archive, options.cache_dir)
+
+    if suite_plan is None:
+        raise SuiteError(f"Couldn't load global.yaml found in {root_dir}")
+
+    test_dirs = find_selected_tests(root_dir, options, suite_plan)
+
+    if errors := suite_plan.errors(test_dirs):
+        raise SuiteError('\n'.join(errors) + "\n\nError when running test suite, giving up. Did you specify the "
+                         "correct folder?\nTypically you want to specify a folder two directories up from the input/ "
+                         "and output/ folders.")
+
+    # the tests that failed last time are run (and reported) first, so a fix can be checked without waiting for the rest
+    if options.failed_first:
+        failed = TestHistory(history_filename(root_dir, options)).failed()
+        failed_tests = {test_index for test_index, test_dir in test_dirs.items() if os.path.basename(test_dir) in failed}
+        test_dirs = {test_index: test_dirs[test_index] for test_index in failed_first(list(test_dirs), failed_tests)}
+
+    if options.max_failures:
+        options = replace(options, failure_limit=FailureLimit(options.max_failures))
+
+    suite_result = SuiteResult(root_dir, test_count=len(test_dirs))
+
+    # nothing can be written to an archive, so the working/ dirs of its tests go in the scratch root, or a temp dir
+    if scratch_root := get_scratch_root(suite_plan.global_values, options.scratch_root) or \
+            (tempfile.gettempdir() if archive else None):
+        options = replace(options, scratch_run_dir=make_scratch_run_dir(scratch_root, root_dir))
+
+    # with a scratch root, each input base the tests use is copied into it once, so the working/ dirs can be made
+    # from a copy on the same filesystem
+    options = replace(options, input_bases=InputBases(
+        os.path.join(root_dir, INPUT_BASES_DIR),
+        os.path.join(options.scratch_run_dir, INPUT_BASES_DIR) if options.scratch_run_dir else None))
+
+    teardown_command = suite_plan.global_values.get(TEARDOWN_KEY)
+    # the setup and teardown run in the suite dir, or for an archive, the dir it's in
+    suite_command_dir = os.path.dirname(root_dir) if archive else root_dir
+
+    if setup_command := suite_plan.global_values.get(SETUP_KEY):
+        setup_inputs = suite_plan.global_values.get(SETUP_INPUTS_KEY) or []
+        if isinstance(setup_inputs, str):
+            setup_inputs = [setup_inputs]
+
+        setup_start_time = time.perf_counter()
+        try:
+            shared_dir, suite_result.setup_ran = run_setup(setup_command, setup_inputs, suite_command_dir,
+                                                           options.cache_dir)
+        except (SetupError, OSError) as error:
+            if options.scratch_run_dir:
+                shutil.rmtree(options.scratch_run_dir, ignore_errors=True)
+            raise SuiteError(f"The suite's setup failed, so no tests were run.\n{error}")
+
+        suite_result.setup_time = time.perf_counter() - setup_start_time
+        options = replace(options, shared_dir=shared_dir)
+
+    # with --changed-only, tests that passed last time and haven't changed since aren't run
+    result_cache = None
+    fingerprints = {}
+    cached_results = {}
+
+    if options.changed_only and not options.record:
+        fingerprint_start_time = time.perf_counter()
+        result_cache = ResultCache(os.path.join(options.cache_dir, RESULTS_CACHE_FILE))
+
+        for test_index, test_dir in test_dirs.items():
+            fingerprints[test_index] = fingerprint_test(suite_plan, test_dir, options, result_cache)
+            if result_cache.passed(os.path.basename(test_dir), fingerprints[test_index]):
+                cached_results[test_index] = cached_test_result(suite_plan, test_dir, test_index, options)
+
+        suite_result.cached_count = len(cached_results)
+        suite_result.fingerprint_time = time.perf_counter() - fingerprint_start_time
+
+    results = suite_result.results
+
+    def add_result(result):
+        # not run, or cancelled while running, as the run had reached options.max_failures
+        if result is None or result.status == RESULT_CANCELLED:
+            suite_result.not_run_count += 1
+            return
+
+        results.append(result)
+        if report_result:
+            report_result(result)
+
+    def run_test(test_index):
+        if test_index in cached_results:
+            return cached_results[test_index]
+
+        return run_command_and_compare(suite_plan, test_dirs[test_index], test_index, options)
+
+    start_time = time.perf_counter()
+
+    try:
+        if options.engine == ENGINE_ASYNCIO:
+            import asyncio
+            asyncio.run(run_tests_async(suite_plan, test_dirs, options, add_result, cached_results))
+        elif options.jobs > 1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            # results are reported in the order of test_dirs, whatever order the tests finish in
+            executor = ThreadPoolExecutor(max_workers=options.jobs)
+            try:
+                for future in [executor.submit(run_test, i) for i in test_dirs]:
+                    add_result(future.result())
+            finally:
+                executor.shutdown(cancel_futures=True)
+        else:
+            for test_index in test_dirs:
+                add_result(run_test(test_index))
+
+        suite_result.elapsed_time = time.perf_counter() - start_time
+
+        # one test at a time, whatever --jobs is, so the runs don't slow each other down
+        if options.benchmark:
+            suite_result.benchmarks = run_benchmarks(suite_plan, root_dir, results, replace(options, failure_limit=None),
+                                                     suite_result.diagnostics)
+    finally:
+        # the working/ dirs of an archive's failed tests can't be moved into the suite, so they're left where they are
+        if options.scratch_run_dir and archive and options.debug_artifacts and \
+                any(not result.succeeded for result in results):
+            suite_result.diagnostics.append(f"The working dirs of failed tests are in {options.scratch_run_dir}")
+        elif options.scratch_run_dir:
+            shutil.rmtree(options.scratch_run_dir, ignore_errors=True)
+
+        if teardown_command:
+            try:
+                run_teardown(teardown_command, suite_command_dir, options.shared_dir)
+            except (SetupError, OSError) as error:
+                suite_result.diagnostics.append(f"\n{error}\n")
+
+        if archive:
+            archive.close()
+
+    if result_cache:
+        for result in results:
+            if not result.cached:
+                result_cache.record(os.path.basename(result.target_folder), fingerprints[result.test_index], result.succeeded)
+        result_cache.save()
+
+    # durations and results of the tests that were run, for balancing shards and --failed-first next time. Only kept
+    # when they're wanted (with --history-file or --failed-first), so a plain run doesn't write outside the suite.
+    # Not when running a shard, as all the shards of a run must split the tests using the same history
+    # (blackbox_tools.py merge can write the new one).
+    if (options.history_file or options.failed_first) and not options.shard:
+        history = TestHistory(history_filename(root_dir, options))
+        for result in results:
+            if result.duration is not None:
+                history.record(os.path.basename(result.target_folder), result.duration, result.succeeded)
+        try:
+            history.save()
+        except OSError as error:
+            suite_result.diagnostics.append(f"Couldn't save test durations: {error}")
+
+    if options.timing_report or options.slowest:
+        suite_result.timing_report = make_timing_report([(os.path.basename(result.target_folder), result.duration,
+                                                          result.timings) for result in results if not result.cached],
+                                                        suite_result.elapsed_time)
+        if options.timing_report:
+            save_timing_report(options.timing_report, suite_result.timing_report)
+
+    if options.trace:
+        save_chrome_trace(options.trace, chrome_trace([(os.path.basename(result.target_folder), result.timings)
+                                                       for result in results], start_time))
+
+    if options.results_file:
+        shard = f"{options.shard[0]}/{options.shard[1]}" if options.shard else None
+        save_results_file(options.results_file, root_dir, shard,
+                          [{'index': result.test_index, 'name': os.path.basename(result.target_folder),
+                            'succeeded': result.succeeded, 'status': result.status, 'cached': result.cached,
+                            'duration': result.duration, 'resource_usage': result.resource_usage,
+                            'report': result.report} for result in results])
+
+    for result in results:
+        if result.materialize_stats:
+            suite_result.materialize_stats.add(result.materialize_stats)
+
+    return suite_result
+
+
+# Runs the suite for the command line: prints each test's report as it's done, then a summary. Exits if the suite
+# can't be run.
+def run_all_tests(root_dir, options):
+    try:
+        suite_result = run_suite(root_dir, options, report_test_result)
+    except SuiteError as error:
+        print(f"\n{error}\nExiting.\n\n")
+        sys.exit(1)
+
+    if suite_result.setup_ran:
+        eprint(f"Ran the suite's setup in {suite_result.setup_time:.2f}s")
+    elif suite_result.setup_time is not None:
+        eprint(f"Skipped the suite's setup, as its inputs haven't changed since it last ran")
+
+    for line in suite_result.diagnostics:
+        eprint(line)
+
+    if suite_result.benchmarks is not None:
+        for metric in BENCHMARK_METRICS:
+            print(f"\nBenchmark {metric} (seconds):\n{benchmark_table(suite_result.benchmarks, metric)}")
+        print()
+
+    print(f"\n{suite_result.failed_count} failures in {suite_result.test_count} tests.\n")
+
+    if suite_result.not_run_count:
+        print(f"Stopped after {suite_result.failed_count} failures: {suite_result.not_run_count} tests not run "
+              f"(--max-failures {options.max_failures}).\n")
+
+    if options.changed_only and not options.record:
+        print(f"{suite_result.cached_count} unchanged tests skipped, as they passed last time "
+              f"(fingerprinting took {suite_result.fingerprint_time:.2f}s).\n")
+
+    if options.slowest:
+        # on stderr, like the other stats
+        eprint(f"\nSlowest tests (seconds):\n{slowest_tests_table(suite_result.timing_report, options.slowest)}\n")
+
+    # on stderr, so they don't get in the way of the test output. Useful for comparing engines, --jobs and
+    # --materialize, but only printed when asked for, so a run's output stays quiet.
+    if options.verbose or options.timing_report:
+        eprint(f"Materialized working dirs ({options.materialize_strategy}): {suite_result.materialize_stats}")
+        eprint(f"Ran {suite_result.test_count} tests in {suite_result.elapsed_time:.2f}s "
+               f"(engine: {options.engine}, jobs: {options.jobs})")
+
+    return suite_result
+
+
+# removes any run dirs for the given test suite left behind in the scratch root (e.g. by an interrupted run)
+def clean_scratch_root(scratch_root, root_dir):
+    if not os.path.isdir(scratch_root):
+        return
+
+    root_dir = os.path.abspath(root_dir)
+
+    for entry in os.scandir(scratch_root):
+        if not entry.name.startswith(SCRATCH_RUN_DIR_PREFIX) or not entry.is_dir():
+            continue
+
+        try:
+            with open(os.path.join(entry.path, SCRATCH_SUITE_DIR_FILE), 'r') as file:
+                run_root_dir = file.read().strip()
+        except IOError:
+            continue
+
+        if run_root_dir == root_dir:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+# removes diagnostic files from test suite, i.e. working/ dirs and stdout_working.txt files,
+# and any of the suite's working dirs left in the scratch root.
 # this function doesn't remove such files that are deeper than 2 dirs in the hierarchy,
 # as they would be part of test case data, and not result of direct running of a test case (v meta).
-def clean_test_suite(root_dir):
-    for root, dirs, files in os.walk(root_dir, topdown=True):
+# removes working artifacts from the test dirs (all those in the test suite, unless test_dirs is given)
+def clean_test_suite(root_dir, scratch_root=None, test_dirs=None):
+    if scratch_root:
+        clean_scratch_root(scratch_root, root_dir)
 
-        num_path_components = len(root.split('/'))
-        # print(f"num_comps = {num_path_components} root={root} dirs={dirs} files={files}")
+    if test_dirs is None:
+        test_dirs = find_test_dirs(root_dir) if os.path.isdir(root_dir) else []
 
-        # NB: if you return from os.walk, it seems to quit the entire walk!
-        # So we must not return if num_path_components is 1
-        if num_path_components > 2:
-            return
-        elif num_path_components == 2:
-            # Only target files/dir names at this level are legitimately things to delete for these tests.
-            # Any deeper instances are part of test input or output!
+    for test_dir in test_dirs:
+        # Only target files/dir names at the top level of a test are legitimately things to delete for these tests.
+        # Any deeper instances are part of test input or output!
+        file_to_remove = os.path.join(test_dir, STDOUT_WORKING_COPY_FILE)
+        if os.path.isfile(file_to_remove):
+            os.remove(file_to_remove)
+
+        dir_to_remove = os.path.join(test_dir, WORKING_DIR)
+        if os.path.isdir(dir_to_remove):
+            shutil.rmtree(dir_to_remove)
 
-            if STDOUT_WORKING_COPY_FILE in files:
-                file_to_remove = os.path.join(root, STDOUT_WORKING_COPY_FILE)
-                os.remove(file_to_remove)
 
-            if WORKING_DIR in dirs:
-                dir_to_remove = os.path.join(root, WORKING_DIR)
-                shutil.rmtree(dir_to_remove)
+# click callback for --shard: turns 'i/n' into (i, n)
+def parse_shard(ctx, param, value):
+    if value is None:
+        return None
+
+    try:
+        shard_index, shard_count = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise click.BadParameter("must be i/n, e.g. 2/4")
+
+    if not 1 <= shard_index <= shard_count:
+        raise click.BadParameter("i must be from 1 to n")
+
+    return shard_index, shard_count
 
 
 @click.command(no_args_is_help=False)
@@ -460,22 +1767,127 @@ def clean_test_suite(root_dir):
 @click.option('--clean', is_flag=True, help='Clean the test suite dir of output fragments')
 @click.option('--record', is_flag=True, help='Record standard out from tests as the expected content')
 @click.option('--report-failure-only', is_flag=True, help='Only report details for failed tests')
-def run(test_suite_dir, clean, record, report_failure_only):
+@click.option('--verbose', '-v', is_flag=True,
+              help='At the end of the run, print how long it took and what was copied to make working dirs (to stderr)')
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=1), help='Number of tests to run in parallel (default 1)')
+@click.option('--engine', type=click.Choice([ENGINE_THREADS, ENGINE_ASYNCIO]), default=ENGINE_THREADS,
+              help='Run tests on a thread pool (default), or as asyncio subprocesses (good for many short, I/O bound commands)')
+@click.option('--materialize', type=click.Choice(STRATEGIES), default=STRATEGY_AUTO,
+              help='How input/ is copied to working/: reflink (copy-on-write, where supported), hardlink '
+                   '(files listed in readonly_input_files only), copy, or auto (default: all that apply)')
+@click.option('--scratch-root', type=click.Path(file_okay=False),
+              help='Create working dirs in this dir (e.g. /dev/shm) rather than in the test suite. '
+                   'Overrides scratch_root in global.yaml')
+@click.option('--debug-artifacts', is_flag=True,
+              help='When using a scratch root, move the working dirs of failed tests back into the test suite')
+@click.option('--cache-dir', type=click.Path(file_okay=False),
+              help='Dir for things kept between runs, such as manifests of output/ dirs (default: a dir for the suite in '
+                   f'{DEFAULT_CACHE_ROOT})')
+@click.option('--output-manifest', is_flag=True,
+              help='Compare working/ with a cached manifest of output/ (with hashes of its files), so output/ '
+                   'is only read when it changes')
+@click.option('--compare-workers', type=click.IntRange(min=1),
+              help='Number of threads comparing files in working/ with output/, per test (default: compare_workers '
+                   'in the config, or 1)')
+@click.option('--changed-only', is_flag=True,
+              help='Skip tests that passed last time and whose config, input/, output/, stdout.txt and '
+                   f'{DEPENDS_ON_KEY} files haven\'t changed since')
+@click.option('--select', multiple=True,
+              help='Only run tests whose dir name matches this glob, or with this tag if given as tag:<tag>. Can be repeated')
+@click.option('--exclude', multiple=True,
+              help='Don\'t run tests whose dir name matches this glob, or with this tag if given as tag:<tag>. Can be repeated')
+@click.option('--shard', callback=parse_shard, metavar='I/N',
+              help='Only run shard I of N of the tests (e.g. 2/4 on the second of four CI machines). Shards are '
+                   'balanced using the test durations from previous runs, if any')
+@click.option('--history-file', type=click.Path(dir_okay=False),
+              help='File for test durations and failures, used to balance shards and for --failed-first. All shards '
+                   'must use the same one (default: a file in the cache dir)')
+@click.option('--failed-first', is_flag=True,
+              help='Run the tests that failed last time first (they\'re also reported first)')
+@click.option('--max-failures', type=click.IntRange(min=1), metavar='N',
+              help='Stop the run once N tests have failed: tests not yet started aren\'t run, and those running '
+                   'are cancelled')
+@click.option('--exit-on-first-difference', is_flag=True,
+              help='Stop comparing a test\'s output at its first difference (e.g. the first file in working/ that '
+                   'doesn\'t match output/), rather than listing every difference')
+@click.option('--results-file', type=click.Path(dir_okay=False),
+              help='Write the results to this file as JSON (see blackbox_tools.py merge)')
+@click.option('--timing-report', type=click.Path(dir_okay=False),
+              help='Write how long each phase of each test took (config, copy, subprocess, stdout, compare, cleanup) '
+                   'to this file as JSON')
+@click.option('--slowest', default=0, type=click.IntRange(min=0), metavar='N',
+              help='List the N slowest tests at the end of the run, with how long each phase took')
+@click.option('--trace', type=click.Path(dir_okay=False),
+              help='Write a timeline of the run to this file, for chrome://tracing or https://ui.perfetto.dev')
+@click.option('--benchmark', default=0, type=click.IntRange(min=0), metavar='K',
+              help='After the tests have run, time K more runs of the command of each test that passed, and '
+                   'summarize them (min, median, p95 and standard deviation of wall and CPU time)')
+@click.option('--warmup', default=1, type=click.IntRange(min=0), metavar='W',
+              help='With --benchmark, runs of each command before the timed ones, which aren\'t counted (default 1)')
+@click.option('--benchmark-file', type=click.Path(dir_okay=False),
+              help='Write the benchmark results to this file as JSON (see blackbox_tools.py compare)')
+def run(test_suite_dir, clean, record, report_failure_only, verbose, jobs, engine, materialize, scratch_root,
+        debug_artifacts, cache_dir, output_manifest, compare_workers, changed_only, select, exclude, shard, history_file, failed_first,
+        max_failures, exit_on_first_difference, results_file, timing_report, slowest, trace, benchmark, warmup,
+        benchmark_file):
     # print("TEST SUITE DIR: ", test_suite_dir) DE
 
     # print(f"Running test at {os.getcwd()}")
 
+    options = RunOptions(record=record, report_failure_only=report_failure_only, verbose=verbose, jobs=jobs,
+                         engine=engine, materialize_strategy=materialize, scratch_root=scratch_root,
+                         debug_artifacts=debug_artifacts, cache_dir=cache_dir,
+                         output_manifest=output_manifest, compare_workers=compare_workers,
+                         changed_only=changed_only, select=select, exclude=exclude, shard=shard,
+                         history_file=history_file, failed_first=failed_first, max_failures=max_failures,
+                         exit_on_first_difference=exit_on_first_difference, results_file=results_file,
+                         timing_report=timing_report, slowest=slowest, trace=trace, benchmark=benchmark, warmup=warmup,
+                         benchmark_file=benchmark_file)
+
+    if benchmark and record:
+        raise click.UsageError("--benchmark can't be used with --record")
+    if benchmark_file and not benchmark:
+        raise click.UsageError("--benchmark-file needs --benchmark")
+
+    if is_suite_archive(test_suite_dir):
+        # an archive is only read: there's nothing in it to clean, and nowhere to record to (see suite_archive.py)
+        if clean or record or changed_only:
+            raise click.UsageError("--clean, --record and --changed-only can't be used with a suite archive "
+                                   "(see blackbox_tools.py unpack)")
+
+        print(f"Running test suite in archive: {test_suite_dir}\n\n")
+        run_all_tests(test_suite_dir, options)
+
+        print("Done.\n\n")
+        return
+
+    # The plan is only compiled when tests are to be selected or run (it's cached, so it's quick to compile again when
+    # the suite is run). --clean on its own only needs global.yaml's scratch root, so stays quick, and works whatever
+    # is in the tests' configs.
+    suite_plan = None
+    if os.path.isdir(test_suite_dir) and (select or exclude or shard or not clean):
+        suite_plan = compile_suite_plan(os.path.abspath(test_suite_dir), cache_dir=get_cache_dir(test_suite_dir, cache_dir))
+
+    global_values = suite_plan.global_values if suite_plan else {}
+    if not suite_plan and not scratch_root and os.path.isdir(test_suite_dir):
+        global_values = load_global_values(test_suite_dir) or {}
+
+    # with --select, --exclude or --shard, only the chosen tests are cleaned and checked for empty dirs
+    selected_test_dirs = None
+    if (select or exclude or shard) and suite_plan:
+        selected_test_dirs = list(find_selected_tests(test_suite_dir, options, suite_plan).values())
+
     print(f"Cleaning artifacts from test suite dir: {test_suite_dir}\n")
-    clean_test_suite(test_suite_dir)
+    clean_test_suite(test_suite_dir, get_scratch_root(global_values, scratch_root), selected_test_dirs)
     # print("Done.\n\n")
 
     if clean:
         sys.exit(0)
 
-    process_empty_dirs(test_suite_dir, create_empty_dir_droppings=True)
+    process_empty_dirs(test_suite_dir, create_empty_dir_droppings=True, test_dirs=selected_test_dirs)
 
     print(f"Running test suite in dir: {test_suite_dir}\n\n")
-    run_all_tests(test_suite_dir, record, report_failure_only)
+    run_all_tests(test_suite_dir, options)
 
     print("Done.\n\n")
 
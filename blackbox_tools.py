@@ -0,0 +1,173 @@
+# blackbox_tools.py
+#
+# Tools for working with the results of blackbox_tester.py runs.
+#
+#   merge: combines the results files from the shards of a run (see --shard and --results-file) into one report
+#   compare: compares two benchmark files (see --benchmark and --benchmark-file), flagging significant changes
+#   to-store, from-store: convert a suite's input/ and output/ trees to manifests of files in a content store, and back
+#   pack, unpack: convert a suite dir to a single archive file that blackbox_tester.py can run, and back
+
+import os
+import shutil
+import sys
+
+import click
+
+from blackbox_tester import clean_test_suite, find_test_dirs, ignore_files_for_comparison_scan
+from content_store.content_store import STORE_DIR, convert_test_from_store, convert_test_to_store, remove_unused_blobs
+from benchmark.benchmark import BENCHMARK_METRICS, METRIC_WALL_TIME, compare_benchmarks, load_benchmark_file
+from result_cache.history import TestHistory
+from result_cache.results_file import load_results_file, merge_results
+from suite_archive.suite_archive import pack_suite, unpack_suite
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+@click.group()
+def tools():
+    pass
+
+
+@tools.command()
+@click.argument('results_files', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--history-file', type=click.Path(dir_okay=False),
+              help='Also write the durations of all the tests to this file, to balance the shards of the next run')
+def merge(results_files, history_file):
+    """Prints the combined report for the results files from the shards of a run."""
+    results_list = [load_results_file(filename) for filename in results_files]
+
+    try:
+        tests = merge_results(results_list)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+
+    # warn if a shard seems to be missing, as its tests won't be counted
+    shards = [results['shard'] for results in results_list if results['shard']]
+    shard_counts = set(int(shard.split('/')[1]) for shard in shards)
+    if len(shard_counts) > 1:
+        eprint(f"Warning: the results files are from runs split into different numbers of shards: {sorted(shard_counts)}")
+    elif shard_counts and len(set(shards)) < shard_counts.pop():
+        eprint(f"Warning: only have results for shards {sorted(set(shards))}")
+
+    for test in tests:
+        for line in test['report']:
+            print(line)
+
+    failed_test_count = len([test for test in tests if not test['succeeded']])
+
+    print(f"\n{failed_test_count} failures in {len(tests)} tests.\n")
+
+    if history_file:
+        history = TestHistory()
+        for test in tests:
+            if test['duration'] is not None:
+                history.record(test['name'], test['duration'], test['succeeded'])
+        history.save(history_file)
+
+
+@tools.command()
+@click.argument('old_file', type=click.Path(exists=True, dir_okay=False))
+@click.argument('new_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--metric', type=click.Choice(BENCHMARK_METRICS), default=METRIC_WALL_TIME,
+              help='What to compare (default wall_time)')
+@click.option('--alpha', default=0.05, type=click.FloatRange(min=0, max=1, min_open=True),
+              help='Changes with a p-value (from Welch\'s t-test) below this are flagged (default 0.05)')
+def compare(old_file, new_file, metric, alpha):
+    """Compares two benchmark files, e.g. from before and after a change. Exits with status 1 if any test got
+    significantly slower."""
+    try:
+        old, new = load_benchmark_file(old_file), load_benchmark_file(new_file)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+
+    rows = compare_benchmarks(old, new, metric, alpha)
+
+    print(f"{'test':40} {'old median':>12} {'new median':>12} {'change':>8} {'p-value':>8}")
+    for name, old_median, new_median, p_value, verdict in rows:
+        change = f"{(new_median - old_median) / old_median:+.1%}" if old_median else ''
+        p_value_text = f"{p_value:.3f}" if p_value is not None else '-'
+        print(f"{name[:40]:40} {old_median:12.4f} {new_median:12.4f} {change:>8} {p_value_text:>8}  {verdict}")
+
+    slower_count = len([row for row in rows if row[4] == 'slower'])
+    faster_count = len([row for row in rows if row[4] == 'faster'])
+    print(f"\n{slower_count} significantly slower, {faster_count} significantly faster, of {len(rows)} tests in both files.\n")
+
+    if slower_count:
+        sys.exit(1)
+
+
+@tools.command('to-store')
+@click.argument('suite_dir', type=click.Path(exists=True, file_okay=False))
+def to_store(suite_dir):
+    """Replaces the input/ and output/ trees of the suite's tests with manifests of their files, which are kept once
+    each in the suite's content store."""
+    test_dirs = find_test_dirs(suite_dir)
+
+    for test_dir in test_dirs:
+        if converted := convert_test_to_store(test_dir, ignore_files_for_comparison_scan):
+            print(f"{os.path.basename(test_dir)}: {', '.join(converted)}")
+
+    removed = remove_unused_blobs(suite_dir, test_dirs)
+    blob_count, blob_bytes = store_size(os.path.join(suite_dir, STORE_DIR))
+    print(f"\nThe store has {blob_count} files ({blob_bytes} bytes). {removed} unused files were removed.\n")
+
+
+@tools.command('from-store')
+@click.argument('suite_dir', type=click.Path(exists=True, file_okay=False))
+def from_store(suite_dir):
+    """Replaces the manifests of the suite's tests with the input/ and output/ trees they describe, and removes the
+    content store."""
+    for test_dir in find_test_dirs(suite_dir):
+        try:
+            if converted := convert_test_from_store(test_dir):
+                print(f"{os.path.basename(test_dir)}: {', '.join(converted)}")
+        except ValueError as error:
+            raise click.ClickException(str(error))
+
+    # read-only blobs can be removed, as their dirs aren't read-only
+    shutil.rmtree(os.path.join(suite_dir, STORE_DIR), ignore_errors=True)
+
+
+@tools.command()
+@click.argument('suite_dir', type=click.Path(exists=True, file_okay=False))
+@click.argument('archive', type=click.Path(dir_okay=False))
+@click.option('--no-compression', is_flag=True,
+              help='Store the files uncompressed: the archive is bigger, but quicker to run')
+def pack(suite_dir, archive, no_compression):
+    """Packs the suite into an archive file, which blackbox_tester.py can run without unpacking it."""
+    if os.path.exists(archive):
+        raise click.ClickException(f"{archive} already exists")
+
+    # the working/ dirs and stdout_working.txt files of the last run aren't part of the suite
+    clean_test_suite(suite_dir)
+
+    file_count = pack_suite(suite_dir, archive, compress=not no_compression)
+    print(f"Packed {file_count} files into {archive} ({os.path.getsize(archive)} bytes).")
+
+
+@tools.command()
+@click.argument('archive', type=click.Path(exists=True, dir_okay=False))
+@click.argument('suite_dir', type=click.Path(file_okay=False))
+def unpack(archive, suite_dir):
+    """Unpacks a suite archive into a suite dir, e.g. to record its tests again."""
+    if os.path.exists(suite_dir):
+        raise click.ClickException(f"{suite_dir} already exists")
+
+    try:
+        stats = unpack_suite(archive, suite_dir)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    print(f"Unpacked {stats.files_copied} files ({stats.bytes_copied} bytes) into {suite_dir}.")
+
+
+# the number of files in the store, and their total size
+def store_size(store_dir):
+    sizes = [os.path.getsize(os.path.join(dir_path, file_name))
+             for dir_path, _, file_names in os.walk(store_dir) for file_name in file_names]
+    return len(sizes), sum(sizes)
+
+
+if __name__ == '__main__':
+    tools()
@@ -0,0 +1,205 @@
+import json
+import os
+import shutil
+import stat
+
+from dir_comparison.manifest import ENTRY_TYPE_DIR, ENTRY_TYPE_FILE, MANIFEST_VERSION, build_manifest, load_manifest
+from materialization.materialization import STRATEGY_AUTO, STRATEGY_COPY, STRATEGY_HARDLINK, STRATEGY_REFLINK, \
+    MaterializeStats, matches_any, try_reflink_file
+
+# A content store keeps the files of a test suite's input/ and output/ trees once each, however many tests have
+# them, as blobs named by the hash of their contents. A test using the store has a manifest of each tree
+# (input.manifest.json, output.manifest.json) in place of the tree itself. The manifests are in the same format as
+# manifest.py's, without the mtimes and inodes.
+#
+# working/ is materialized from the blobs by reflinking or hard linking them where it can, as from input/ (see
+# materialization.py). As an output manifest gives the hash of every file, comparing working/ with it only needs
+# working/'s files to be read, and not even those that are hard links to the blob they should match.
+#
+# The store is in the suite dir, in STORE_DIR, with blobs at blobs/<first 2 chars of hash>/<rest of hash>. Blobs are
+# read-only, as they can be hard linked into working/ dirs.
+
+STORE_DIR = '.bbt_store'
+BLOBS_DIR = 'blobs'
+
+INPUT_MANIFEST_FILE = 'input.manifest.json'
+OUTPUT_MANIFEST_FILE = 'output.manifest.json'
+
+BLOB_MODE = 0o444
+
+
+def store_dir_for_test(test_dir):
+    return os.path.join(os.path.dirname(os.path.abspath(test_dir)), STORE_DIR)
+
+
+def blob_path(store_dir, content_hash):
+    return os.path.join(store_dir, BLOBS_DIR, content_hash[:2], content_hash[2:])
+
+
+# Adds filename to the store as the blob for content_hash, if it's not already there
+def add_blob(store_dir, filename, content_hash):
+    path = blob_path(store_dir, content_hash)
+    if os.path.exists(path):
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # written under a temporary name, so a blob is never seen half written
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    if not try_reflink_file(filename, temp_path):
+        shutil.copyfile(filename, temp_path)
+    os.chmod(temp_path, BLOB_MODE)
+    os.replace(temp_path, path)
+
+
+# The manifest of the tree at folder (as kept with a test), adding its files to the store
+def add_tree_to_store(folder, store_dir, ignore_files=[]):
+    manifest = build_manifest(folder, ignore_files)
+    entries = {}
+
+    for rel_path, entry in manifest['entries'].items():
+        if entry['type'] == ENTRY_TYPE_FILE:
+            add_blob(store_dir, os.path.join(folder, rel_path), entry['hash'])
+            entries[rel_path] = {'type': ENTRY_TYPE_FILE, 'size': entry['size'], 'mode': entry['mode'], 'hash': entry['hash']}
+        else:
+            entries[rel_path] = {'type': ENTRY_TYPE_DIR, 'mode': entry['mode']}
+
+    return {'version': MANIFEST_VERSION, 'entries': entries}
+
+
+# sorted and indented, so changes to a manifest are easy to read in a diff
+def save_tree_manifest(manifest, filename):
+    with open(filename, 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+        file.write('\n')
+
+
+# the blobs a manifest needs that aren't in the store
+def missing_blobs(manifest, store_dir):
+    return sorted(set(entry['hash'] for entry in manifest['entries'].values()
+                      if entry['type'] == ENTRY_TYPE_FILE and not os.path.exists(blob_path(store_dir, entry['hash']))))
+
+
+# Creates the tree described by manifest at dst_dir, from the store's blobs. As materialize_tree: files whose paths
+# match readonly_patterns can be hard linked (to the blobs), and other files reflinked or copied.
+def materialize_from_store(manifest, store_dir, dst_dir, strategy=STRATEGY_AUTO, readonly_patterns=(), stats=None):
+    if stats is None:
+        stats = MaterializeStats()
+
+    use_reflinks = strategy in (STRATEGY_AUTO, STRATEGY_REFLINK)
+    use_hardlinks = strategy in (STRATEGY_AUTO, STRATEGY_HARDLINK) and readonly_patterns
+
+    os.makedirs(dst_dir)
+
+    # sorted, so a dir comes before what's in it
+    for rel_path, entry in sorted(manifest['entries'].items()):
+        dst = os.path.join(dst_dir, rel_path)
+
+        if entry['type'] == ENTRY_TYPE_DIR:
+            os.mkdir(dst)
+            continue
+
+        blob = blob_path(store_dir, entry['hash'])
+
+        if use_hardlinks and matches_any(rel_path, readonly_patterns):
+            try:
+                os.link(blob, dst)
+                stats.add_hard_link(blob, entry['size'])
+                continue
+            except OSError:
+                pass
+
+        if use_reflinks and try_reflink_file(blob, dst):
+            stats.files_reflinked += 1
+            stats.bytes_shared += entry['size']
+        else:
+            shutil.copyfile(blob, dst)
+            stats.files_copied += 1
+            stats.bytes_copied += entry['size']
+
+        os.chmod(dst, stat.S_IMODE(entry['mode']))
+
+    # dirs last, as a read-only dir couldn't be filled
+    for rel_path, entry in manifest['entries'].items():
+        if entry['type'] == ENTRY_TYPE_DIR:
+            os.chmod(os.path.join(dst_dir, rel_path), stat.S_IMODE(entry['mode']))
+
+    return stats
+
+
+# For compare_folder_to_manifest: True if filename is a hard link to the blob for the entry, so it needn't be read
+def is_link_to_blob(store_dir):
+    def is_link(filename, entry):
+        try:
+            file_stat = os.stat(filename)
+            blob_stat = os.stat(blob_path(store_dir, entry['hash']))
+        except OSError:
+            return False
+
+        return (file_stat.st_ino, file_stat.st_dev) == (blob_stat.st_ino, blob_stat.st_dev)
+
+    return is_link
+
+
+# Replaces the test's input/ and output/ trees with manifests, adding their files to the suite's store.
+# Returns the names of the trees converted.
+def convert_test_to_store(test_dir, ignore_files=[]):
+    store_dir = store_dir_for_test(test_dir)
+    converted = []
+
+    for tree_name, manifest_file in [('input', INPUT_MANIFEST_FILE), ('output', OUTPUT_MANIFEST_FILE)]:
+        folder = os.path.join(test_dir, tree_name)
+        if not os.path.isdir(folder):
+            continue
+
+        save_tree_manifest(add_tree_to_store(folder, store_dir, ignore_files), os.path.join(test_dir, manifest_file))
+        shutil.rmtree(folder)
+        converted.append(tree_name)
+
+    return converted
+
+
+# Replaces the test's manifests with the input/ and output/ trees they describe.
+# Returns the names of the trees converted. Raises ValueError if the store is missing any of their files.
+def convert_test_from_store(test_dir):
+    store_dir = store_dir_for_test(test_dir)
+    converted = []
+
+    for tree_name, manifest_file in [('input', INPUT_MANIFEST_FILE), ('output', OUTPUT_MANIFEST_FILE)]:
+        manifest_filename = os.path.join(test_dir, manifest_file)
+        if not os.path.isfile(manifest_filename):
+            continue
+
+        manifest = load_manifest(manifest_filename)
+        if manifest is None:
+            raise ValueError(f"{manifest_filename} isn't a manifest BBT can read")
+        if missing := missing_blobs(manifest, store_dir):
+            raise ValueError(f"The store is missing {len(missing)} files for {manifest_filename}, e.g. {missing[0]}")
+
+        folder = os.path.join(test_dir, tree_name)
+        shutil.rmtree(folder, ignore_errors=True)
+        materialize_from_store(manifest, store_dir, folder, STRATEGY_COPY)
+        os.remove(manifest_filename)
+        converted.append(tree_name)
+
+    return converted
+
+
+# Removes the blobs that none of the manifests in the suite use. Returns the number removed.
+def remove_unused_blobs(suite_dir, test_dirs):
+    store_dir = os.path.join(suite_dir, STORE_DIR)
+    used = set()
+
+    for test_dir in test_dirs:
+        for manifest_file in [INPUT_MANIFEST_FILE, OUTPUT_MANIFEST_FILE]:
+            if manifest := load_manifest(os.path.join(test_dir, manifest_file)):
+                used.update(entry['hash'] for entry in manifest['entries'].values() if entry['type'] == ENTRY_TYPE_FILE)
+
+    removed = 0
+    for dir_path, _, file_names in os.walk(os.path.join(store_dir, BLOBS_DIR)):
+        for file_name in file_names:
+            if os.path.basename(dir_path) + file_name not in used:
+                os.remove(os.path.join(dir_path, file_name))
+                removed += 1
+
+    return removed
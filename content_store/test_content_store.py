@@ -0,0 +1,44 @@
+import os
+import stat
+
+from content_store.content_store import INPUT_MANIFEST_FILE, STORE_DIR, convert_test_from_store, convert_test_to_store, \
+    is_link_to_blob, materialize_from_store, remove_unused_blobs
+from dir_comparison.manifest import load_manifest
+from materialization.materialization import STRATEGY_HARDLINK
+
+
+def test_trees_are_stored_once_and_restored(tmp_path):
+    for test_name in ['test_a', 'test_b']:
+        input_dir = tmp_path / test_name / 'input'
+        (input_dir / 'empty_dir').mkdir(parents=True)
+        (input_dir / 'data.txt').write_text("shared fixture")
+        (input_dir / 'script.sh').write_text("echo hi")
+        (input_dir / 'script.sh').chmod(0o755)
+
+    for test_name in ['test_a', 'test_b']:
+        assert convert_test_to_store(tmp_path / test_name) == ['input']
+        assert not (tmp_path / test_name / 'input').exists()
+
+    blobs = [path for path in (tmp_path / STORE_DIR).rglob('*') if path.is_file()]
+    assert len(blobs) == 2
+
+    assert convert_test_from_store(tmp_path / 'test_a') == ['input']
+    assert (tmp_path / 'test_a' / 'input' / 'data.txt').read_text() == "shared fixture"
+    assert (tmp_path / 'test_a' / 'input' / 'empty_dir').is_dir()
+    assert stat.S_IMODE((tmp_path / 'test_a' / 'input' / 'script.sh').stat().st_mode) == 0o755
+
+    assert remove_unused_blobs(tmp_path, [tmp_path / 'test_a', tmp_path / 'test_b']) == 0
+    os.remove(tmp_path / 'test_b' / INPUT_MANIFEST_FILE)
+    assert remove_unused_blobs(tmp_path, [tmp_path / 'test_a', tmp_path / 'test_b']) == 2
+
+
+def test_hard_linked_files_are_known_to_match(tmp_path):
+    (tmp_path / 'test' / 'input').mkdir(parents=True)
+    (tmp_path / 'test' / 'input' / 'big.bin').write_bytes(b"x" * 1000)
+    convert_test_to_store(tmp_path / 'test')
+
+    manifest = load_manifest(tmp_path / 'test' / INPUT_MANIFEST_FILE)
+    store_dir = tmp_path / STORE_DIR
+    materialize_from_store(manifest, store_dir, tmp_path / 'working', STRATEGY_HARDLINK, ['*.bin'])
+
+    assert is_link_to_blob(store_dir)(tmp_path / 'working' / 'big.bin', manifest['entries']['big.bin'])
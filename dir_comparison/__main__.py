@@ -0,0 +1,41 @@
+import time
+
+import click
+
+from dir_comparison.dir_comparison import COMPARISON_MODE_EXACT, COMPARISON_MODES, compare_folders
+
+# Times compare_folders on a pair of trees with different numbers of workers, to see what suits a suite's output/
+# dirs (and the disk they're on), e.g.
+#
+#     python -m dir_comparison my_suite/some_test/output my_copy_of_output --workers 1,2,4,8
+#
+# Note the first run also pays for reading the files into the OS cache, so --repeat is worth using.
+
+
+@click.command()
+@click.argument('folder1', type=click.Path(exists=True, file_okay=False))
+@click.argument('folder2', type=click.Path(exists=True, file_okay=False))
+@click.option('--workers', default='1,2,4,8', show_default=True, help='Comma separated worker counts to time')
+@click.option('--repeat', default=3, show_default=True, type=click.IntRange(min=1),
+              help='Times to compare with each worker count (the fastest is reported)')
+@click.option('--mode', type=click.Choice(COMPARISON_MODES), default=COMPARISON_MODE_EXACT, show_default=True)
+def time_comparison(folder1, folder2, workers, repeat, mode):
+    worker_counts = [int(x) for x in workers.split(',')]
+    baseline_time = None
+
+    for worker_count in worker_counts:
+        times = []
+        for _ in range(repeat):
+            differences = []
+            start_time = time.perf_counter()
+            compare_folders(folder1, folder2, differences, section_size=1024 * 64, comparison_mode=mode,
+                            workers=worker_count)
+            times.append(time.perf_counter() - start_time)
+
+        best_time = min(times)
+        baseline_time = baseline_time or best_time
+        print(f"workers {worker_count:3}: {best_time:8.3f}s (x{baseline_time / best_time:.2f}), {len(differences)} differences")
+
+
+if __name__ == '__main__':
+    time_comparison()
@@ -1,21 +1,24 @@
 import os
 import hashlib
 import io
-import pytest
-
-
-def func(x):
-    return x + 1
-
-
-def test_answer():
-    assert func(3) == 4
+import threading
 
 
 # SECTION_SIZE_DEFAULT = 1024
 # the doctests require start/end section size that is v small, 4 is good.
 SECTION_SIZE_DEFAULT = 4
 
+# How files are compared.
+# fast_sampling: files under 3 * section_size are checksummed in full; larger files only have their first and last
+#   section_size bytes checksummed, so a difference in the middle of a large file isn't found.
+# exact: files are compared byte for byte, a chunk at a time, stopping at the first difference.
+COMPARISON_MODE_FAST_SAMPLING = 'fast_sampling'
+COMPARISON_MODE_EXACT = 'exact'
+
+COMPARISON_MODES = [COMPARISON_MODE_EXACT, COMPARISON_MODE_FAST_SAMPLING]
+
+EXACT_COMPARISON_CHUNK_SIZE = 1024 * 64
+
 
 # seek and tell to return the current file position after seek.
 # Doing this because pyfakefs returns None from Seek, like python2 does - backwards compatability thing?
@@ -33,15 +36,68 @@ def hash_file(filename):
         return hash_data(file.read())
 
 
-def compare_files(filename1, filename2, section_size=1024):
+def compare_files(filename1, filename2, section_size=1024, base_dir1='', base_dir2='',
+                  comparison_mode=COMPARISON_MODE_FAST_SAMPLING):
     # with open_provider.open(filename1, "rb") as f1, open_provider.open(filename2, "rb") as f2:
     #     return compare_files_f(filename1, filename2, f1, f2, section_size)
 
-    with open(filename1, "rb") as f1, open(filename2, "rb") as f2:
-        return compare_files_f(filename1, filename2, f1, f2, section_size)
+    with open(os.path.join(base_dir1, filename1), "rb") as f1, open(os.path.join(base_dir2, filename2), "rb") as f2:
+        return compare_files_f(filename1, filename2, f1, f2, section_size, comparison_mode)
+
+
+# index of the first byte that differs in two byte strings (which must differ)
+def first_difference_index(data1, data2):
+    """
+        >>> first_difference_index(b"abcdef", b"abcXef")
+        3
+        >>> first_difference_index(b"abc", b"abcdef")
+        3
+    """
+    for index, (byte1, byte2) in enumerate(zip(data1, data2)):
+        if byte1 != byte2:
+            return index
+
+    return min(len(data1), len(data2))
+
 
+# compares two open files of the same size a chunk at a time, stopping at the first difference.
+def compare_files_exact_f(file1, file2, f1, f2, chunk_size=EXACT_COMPARISON_CHUNK_SIZE):
+    """
+    Files are the same:
+        >>> compare_files_exact_f("A", \
+                                  "B", \
+                                  io.BytesIO(b"\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01"), \
+                                  io.BytesIO(b"\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01"), \
+                                  4)
+        >>>
 
-def compare_files_f(file1, file2, f1, f2, section_size=1024):
+    Files differ in a middle chunk:
+        >>> compare_files_exact_f("A", \
+                                  "B", \
+                                  io.BytesIO(b"\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01"), \
+                                  io.BytesIO(b"\x01\x01\x01\x01\x01\x02\x01\x01\x01\x01"), \
+                                  4)
+        '* Content differs at byte 5: A != B'
+    """
+    f1.seek(0)
+    f2.seek(0)
+
+    offset = 0
+
+    while True:
+        chunk1 = f1.read(chunk_size)
+        chunk2 = f2.read(chunk_size)
+
+        if chunk1 != chunk2:
+            return f"* Content differs at byte {offset + first_difference_index(chunk1, chunk2)}: {file1} != {file2}"
+
+        if not chunk1:
+            return None
+
+        offset += len(chunk1)
+
+
+def compare_files_f(file1, file2, f1, f2, section_size=1024, comparison_mode=COMPARISON_MODE_FAST_SAMPLING):
     """
     None is returned when two empty files given:
         >>> compare_files_f("A", \
@@ -125,6 +181,23 @@ def compare_files_f(file1, file2, f1, f2, section_size=1024):
                             io.BytesIO(b"\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x02"), \
                             4)
         '* Last part checksum mismatch: A and B'
+
+    Files differ in the middle and are large enough to be checksummed at start and end (so no difference is found):
+        >>> compare_files_f("A", \
+                            "B", \
+                            io.BytesIO(b"\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01"), \
+                            io.BytesIO(b"\x01\x01\x01\x01\x01\x01\x01\x02\x01\x01\x01\x01\x01\x01\x01\x01"), \
+                            4)
+        >>>
+
+    ... unless exact comparison is asked for:
+        >>> compare_files_f("A", \
+                            "B", \
+                            io.BytesIO(b"\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01"), \
+                            io.BytesIO(b"\x01\x01\x01\x01\x01\x01\x01\x02\x01\x01\x01\x01\x01\x01\x01\x01"), \
+                            4, \
+                            COMPARISON_MODE_EXACT)
+        '* Content differs at byte 7: A != B'
     """
 
     # print(f"*** compare files called with {file1} {file2}")
@@ -136,6 +209,9 @@ def compare_files_f(file1, file2, f1, f2, section_size=1024):
     if size1 != size2:
         return f"* Size differs: {file1} != {file2}: {file1} = {size1}, {file2} = {size2}"
 
+    if comparison_mode == COMPARISON_MODE_EXACT:
+        return compare_files_exact_f(file1, file2, f1, f2)
+
     # If the files are small enough, compute the MD5 checksum of the entire contents
     # of both files and compare the checksums
     # print(f"comp sizes: {size1} {section_size}")
@@ -182,188 +258,137 @@ def compare_files_f(file1, file2, f1, f2, section_size=1024):
     return None if last_checksum1 == last_checksum2 else f"* Last part checksum mismatch: {file1} and {file2}"
 
 
-def filepath_with_slashes_added_to_dirs(filename, dir1, dir2):
-    if os.path.isdir(os.path.join(dir1, filename)) or os.path.isdir(os.path.join(dir2, filename)):
-        return f"{filename}/"
-
-    return filename
-
-
 def set_to_sorted_list(s):
     arr = list(s)
     arr.sort()
     return arr
 
 
-def pretty_print_differences(diffs):
-    print(len(diffs))
-    for difference in diffs:
-        print(difference)
-
-
-@pytest.fixture()
-def comparison_of_folder_differences(fake_dirs_with_diffs):
-    # we return an anonymous method -- this is how we can provide arg
-    # to a fixture -- see https://stackoverflow.com/a/44701916
-    def _method(exit_on_first_differences=False):
-        differences = []
-        compare_folders("0/", "1/", differences, exit_on_first_differences)
-        return differences
-
-    return _method
-
-
-# note the param is a fixture defined in conftest.py
-def test_same_contents(fake_dirs_same_contents):
-    differences = []
-    compare_folders("0/", "1/", differences, False)
-    assert not differences, "Expected to find no differences 1"
-
-
-# we just take an empty fs fixture directly
-def test_no_diffs_when_no_contents(fake_dirs_empty):
-    # print("compare_files result: (None = same) ", compare_files(f1, f2))
-    differences = []
-    compare_folders("0/", "1/", differences, False)
-    assert not differences, "Expected to find no differences 2"
-
-
-# differences returned in list are the strings:
-#
-# Between 0/dir1/dir1.1 and 1/dir1/dir1.1, found orphan files/folders: ['file_orphan_1.1.1.txt', 'file_orphan_1.1.1b.txt']
-# * Size differs: 0/dir1/file1.2.txt != 1/dir1/file1.2.txt: 0/dir1/file1.2.txt = 20, 1/dir1/file1.2.txt = 25
-# * One file, one folder: file-dir-same-name-A in dirs 0/ and 1/
-# * One file, one folder: file-dir-same-name-B in dirs 0/ and 1/
-# * Last part checksum mismatch: 0/file1_long_diff_end.txt and 1/file1_long_diff_end.txt
-# * First part checksum mismatch: 0/file1_long_diff_start.txt and 1/file1_long_diff_start.txt
-# * Full file checksum differs: 0/file1_short_diff.txt != 1/file1_short_diff.txt
-
-
-def test_when_diffs_detect_seven_issues(comparison_of_folder_differences):
-    assert len(comparison_of_folder_differences()) == 7
-    # pprint(differences)
-
-
-def test_when_diffs_detect_orhpans(comparison_of_folder_differences):
-    assert "Between 0/dir1/dir1.1 and 1/dir1/dir1.1, found orphan files/folders: ['file_orphan_1.1.1.txt', 'file_orphan_1.1.1b.txt']" in comparison_of_folder_differences()
-    # pprint(differences)
-
-
-def test_when_diffs_detect_size_difference(comparison_of_folder_differences):
-    assert "* Size differs: 0/dir1/file1.2.txt != 1/dir1/file1.2.txt: 0/dir1/file1.2.txt = 20, 1/dir1/file1.2.txt = 25" in comparison_of_folder_differences()
+# returns a set
+def filter_files(files, ignore_files):
+    return set([x for x in files if x not in ignore_files])
 
 
-def test_when_diffs_one_file_one_folder_difference_a(comparison_of_folder_differences):
-    assert "* One file, one folder: file-dir-same-name-A in dirs 0/ and 1/" in comparison_of_folder_differences()
+# returns a dict of the names in the dir at path (less ignore_files) to whether each is a dir. The types come
+# from the dir scan itself, so usually no extra stat is needed.
+def scan_dir(path, ignore_files):
+    with os.scandir(path) as scanned_entries:
+        return {x.name: x.is_dir() for x in scanned_entries if x.name not in ignore_files}
 
 
-def test_when_diffs_one_file_one_folder_difference_b(comparison_of_folder_differences):
-    assert "* One file, one folder: file-dir-same-name-B in dirs 0/ and 1/" in comparison_of_folder_differences()
+# Walks folder1 and folder2 together, depth first and in name order, using a stack rather than recursion so deep
+# trees are fine. Yields (difference, None) for each difference in the trees' structure, and (None, (file1, file2))
+# for each pair of files to be compared, in the order they'd be reported.
+def walk_folder_pairs(folder1, folder2, ignore_files=[], base_dir1='', base_dir2=''):
+    # a frame for each pair of dirs being compared: (their paths, their entries, and the common names
+    # still to look at, in reverse order)
+    stack = []
 
+    def enter_dirs(dir1, dir2):
+        entries1 = scan_dir(os.path.join(base_dir1, dir1), ignore_files)
+        entries2 = scan_dir(os.path.join(base_dir2, dir2), ignore_files)
 
-def test_when_diffs_first_part_checksum_difference_detected(comparison_of_folder_differences):
-    assert "* First part checksum mismatch: 0/file1_long_diff_start.txt and 1/file1_long_diff_start.txt" in comparison_of_folder_differences()
+        common_files = set_to_sorted_list(entries1.keys() & entries2.keys())
+        common_files.reverse()
+        stack.append((dir1, dir2, entries1, entries2, common_files))
 
+        orphan_files = entries1.keys() ^ entries2.keys()
 
-def test_when_diffs_last_part_checksum_difference_detected(comparison_of_folder_differences):
-    assert "* Last part checksum mismatch: 0/file1_long_diff_end.txt and 1/file1_long_diff_end.txt" in comparison_of_folder_differences()
+        if len(orphan_files):
+            # make it obvious which is a folder by appending '/'
+            files_with_slashes_end_dirs = [f"{f}/" if entries1.get(f) or entries2.get(f) else f for f in orphan_files]
+            files_with_slashes_end_dirs.sort()
 
+            return f"Between {dir1} and {dir2}, found orphan files/folders: {files_with_slashes_end_dirs}"
 
-def test_when_diffs_full_checksum_difference_detected(comparison_of_folder_differences):
-    assert "* Full file checksum differs: 0/file1_short_diff.txt != 1/file1_short_diff.txt" in comparison_of_folder_differences()
+        return None
 
+    if difference := enter_dirs(folder1, folder2):
+        yield difference, None
 
-def test_exit_on_first_difference(comparison_of_folder_differences):
-    assert "Between 0/dir1/dir1.1 and 1/dir1/dir1.1, found orphan files/folders: ['file_orphan_1.1.1.txt', 'file_orphan_1.1.1b.txt']" in comparison_of_folder_differences(True)
+    while stack:
+        dir1, dir2, entries1, entries2, remaining = stack[-1]
 
-# def test_it_exit_on_first_issue_with_diffs():
-#     """
-# >>> test_it_exit_on_first_issue_with_diffs()
-# 3
-# Between 0/dir1/dir1.1 and 1/dir1/dir1.1, found orphan files/folders: ['file_orphan_1.1.1.txt', 'file_orphan_1.1.1b.txt']
-# * Size differs: 0/dir1/file1.2.txt != 1/dir1/file1.2.txt: 0/dir1/file1.2.txt = 20, 1/dir1/file1.2.txt = 25
-# * One file, one folder: file-dir-same-name-A in dirs 0/ and 1/
-# >>>
-#     """
-#     with Patcher() as patcher:
-#         fs = fake_file_system.make_fake_dirs_with_diff(patcher.fs)
-#         # fs = fake_file_system.make_fake_dirs_with_diff(patcher.fs)
-#         # print("compare_files result: (None = same) ", compare_files(f1, f2))
-#         differences = []
-#         compare_folders("0/", "1/", differences, True)
-#         pretty_print_differences(differences)
+        if not remaining:
+            stack.pop()
+            continue
 
+        file = remaining.pop()
+        num_dirs = (1 if entries1[file] else 0) + (1 if entries2[file] else 0)
 
-# returns a set
-def filter_files(files, ignore_files):
-    return set([x for x in files if x not in ignore_files])
+        if num_dirs == 2:
+            if difference := enter_dirs(os.path.join(dir1, file), os.path.join(dir2, file)):
+                yield difference, None
+        elif num_dirs == 1:
+            yield f"* One file, one folder: {file} in dirs {dir1} and {dir2}", None
+        else:  # it's two files
+            yield None, (os.path.join(dir1, file), os.path.join(dir2, file))
 
 
-# TODO use walkdir instead of listdir (which requires us to isdir())
 # returns True if the scan was aborted due to first difference found.
 # Only that first difference is returned in differences.
-def compare_folders(folder1, folder2, differences, exit_on_first_difference=False, section_size=SECTION_SIZE_DEFAULT, ignore_files=[]):
-    files1 = filter_files(os.listdir(folder1), ignore_files)
-    files2 = filter_files(os.listdir(folder2), ignore_files)
-
-    # files1 = filter_files(files1)
-    # files2 = filter_files(files2)
-
-    # make debugging easier!
-    # files1.sort()
-    # files2.sort()
-
-    all_files = files1.union(files2)
-    common_files = files1.intersection(files2)
-    orphan_files = all_files - common_files
-
-    if len(orphan_files):
-        # make it obvious which is a folder by appending '/'
-        files_with_slashes_end_dirs = [filepath_with_slashes_added_to_dirs(f, folder1, folder2) for f in orphan_files]
-        files_with_slashes_end_dirs.sort()
-
-        differences.append(f"Between {folder1} and {folder2}, found orphan files/folders: {files_with_slashes_end_dirs}")
-        if exit_on_first_difference:
-            return True
-
-    # Compare the files in each folder
-    for file in set_to_sorted_list(common_files):
-        # print(f"        processing {file}")
+# If base_dir1/base_dir2 are given, folder1/folder2 are relative to them (rather than the cwd); the
+# differences still mention the relative paths.
+# With workers > 1, pairs of files are compared on a pool of that many threads (hashing releases the GIL, so this
+# helps on fast disks). The differences are the same, in the same order, as when they're compared one at a time.
+def compare_folders(folder1, folder2, differences, exit_on_first_difference=False, section_size=SECTION_SIZE_DEFAULT, ignore_files=[],
+                    base_dir1='', base_dir2='', comparison_mode=COMPARISON_MODE_FAST_SAMPLING, workers=1):
+    def compare_file_pair(file_pair):
+        return compare_files(*file_pair, section_size=section_size, base_dir1=base_dir1, base_dir2=base_dir2,
+                             comparison_mode=comparison_mode)
+
+    pairs = walk_folder_pairs(folder1, folder2, ignore_files, base_dir1, base_dir2)
+
+    if workers <= 1:
+        for difference, file_pair in pairs:
+            if file_pair:
+                difference = compare_file_pair(file_pair)
+
+            if difference is not None:
+                differences.append(difference)
+                if exit_on_first_difference:
+                    return True
 
-        num_dirs = (1 if os.path.isdir(os.path.join(folder1, file)) else 0) \
-                   + (1 if os.path.isdir(os.path.join(folder2, file)) else 0)
+        return False
+
+    # only imported when there are workers, as it's slow to import
+    from concurrent.futures import ThreadPoolExecutor
+
+    # each difference or file comparison, in the order they'd be reported
+    results = []
+    # set as soon as any file comparison finds a difference, so the walk can stop early if exit_on_first_difference
+    file_difference_found = threading.Event()
+
+    def note_file_difference(future):
+        if not future.cancelled() and future.result() is not None:
+            file_difference_found.set()
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for difference, file_pair in pairs:
+            if file_pair:
+                future = executor.submit(compare_file_pair, file_pair)
+                future.add_done_callback(note_file_difference)
+                results.append(future)
+            else:
+                results.append(difference)
+                if exit_on_first_difference:
+                    break
 
-        # print(f"|||||||| numDir = {num_dirs}")
+            if exit_on_first_difference and file_difference_found.is_set():
+                break
 
-        if num_dirs == 2:
-            abort_status = compare_folders(
-                os.path.join(folder1, file),
-                os.path.join(folder2, file),
-                differences,
-                exit_on_first_difference,
-                section_size=section_size,
-                ignore_files=ignore_files
-            )
-            if abort_status:
-                return True
+        for i, result in enumerate(results):
+            difference = result if isinstance(result, str) else result.result()
 
-            continue
-        elif num_dirs == 1:
-            differences.append(f"* One file, one folder: {file} in dirs {folder1} and {folder2}")
-            if exit_on_first_difference:
-                return True
-            continue
-        else:  # it's two files
-            # Check if the file exists in the other folder
-            # If the file exists, compare the contents of the files
-            result_differences = compare_files(
-                os.path.join(folder1, file),
-                os.path.join(folder2, file),
-                section_size=section_size
-            )
-            if result_differences is not None:
-                differences.append(result_differences)
+            if difference is not None:
+                differences.append(difference)
                 if exit_on_first_difference:
+                    for outstanding in results[i + 1:]:
+                        if not isinstance(outstanding, str):
+                            outstanding.cancel()
                     return True
+    finally:
+        executor.shutdown(cancel_futures=True)
 
     return False
@@ -0,0 +1,224 @@
+import os
+import hashlib
+import json
+
+from dir_comparison.dir_comparison import filter_files, scan_dir, set_to_sorted_list
+
+# A manifest describes a file tree: for each entry (keyed by its path relative to the root of the tree, using '/'),
+# its type, size, mode and, for files, a hash of the full contents. The file's mtime and inode are also kept, so
+# that a manifest saved to disk can be brought up to date without re-hashing files that haven't changed.
+#
+# Comparing a folder against a manifest means only the folder's files have to be read.
+
+MANIFEST_VERSION = 1
+
+ENTRY_TYPE_FILE = 'file'
+ENTRY_TYPE_DIR = 'dir'
+
+HASH_CHUNK_SIZE = 1024 * 64
+
+
+def hash_file_contents(filename):
+    hash = hashlib.sha256()
+
+    with open(filename, 'rb') as file:
+        while chunk := file.read(HASH_CHUNK_SIZE):
+            hash.update(chunk)
+
+    return hash.hexdigest()
+
+
+def join_rel_path(rel_dir, name):
+    return f"{rel_dir}/{name}" if rel_dir else name
+
+
+# True if the manifest entry is for the same file as stat_result (so the hash in the entry can be used)
+def entry_is_current(entry, stat_result):
+    return (entry.get('hash') is not None
+            and entry.get('size') == stat_result.st_size
+            and entry.get('mtime_ns') == stat_result.st_mtime_ns
+            and entry.get('ino') == stat_result.st_ino)
+
+
+# Builds a manifest for the tree at folder. Hashes are taken from previous_manifest for files that haven't
+# changed (same size, mtime and inode), so only new or changed files are read.
+def build_manifest(folder, ignore_files=[], previous_manifest=None):
+    previous_entries = previous_manifest['entries'] if previous_manifest else {}
+    entries = {}
+
+    dirs_to_scan = ['']
+
+    while dirs_to_scan:
+        rel_dir = dirs_to_scan.pop()
+
+        with os.scandir(os.path.join(folder, rel_dir)) as scanned_entries:
+            for dir_entry in scanned_entries:
+                if dir_entry.name in ignore_files:
+                    continue
+
+                rel_path = join_rel_path(rel_dir, dir_entry.name)
+                stat_result = dir_entry.stat()
+
+                if dir_entry.is_dir():
+                    entries[rel_path] = {'type': ENTRY_TYPE_DIR, 'mode': stat_result.st_mode}
+                    dirs_to_scan.append(rel_path)
+                    continue
+
+                previous_entry = previous_entries.get(rel_path)
+                if previous_entry and entry_is_current(previous_entry, stat_result):
+                    content_hash = previous_entry['hash']
+                else:
+                    content_hash = hash_file_contents(dir_entry.path)
+
+                entries[rel_path] = {
+                    'type': ENTRY_TYPE_FILE,
+                    'size': stat_result.st_size,
+                    'mode': stat_result.st_mode,
+                    'hash': content_hash,
+                    'mtime_ns': stat_result.st_mtime_ns,
+                    'ino': stat_result.st_ino,
+                }
+
+    return {'version': MANIFEST_VERSION, 'entries': entries}
+
+
+def load_manifest(filename):
+    try:
+        with open(filename, 'r') as file:
+            manifest = json.load(file)
+    except (IOError, ValueError):
+        return None
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+
+    return manifest
+
+
+def save_manifest(manifest, filename):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    # write then rename, so a reader never sees a half written manifest
+    temp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(temp_filename, 'w') as file:
+        json.dump(manifest, file)
+    os.replace(temp_filename, filename)
+
+
+# Returns an up to date manifest for folder, using (and updating) the manifest cached in cache_filename.
+# Only files whose size, mtime or inode have changed since the cached manifest was made are hashed.
+def cached_manifest(folder, cache_filename, ignore_files=[]):
+    previous_manifest = load_manifest(cache_filename)
+    manifest = build_manifest(folder, ignore_files, previous_manifest)
+
+    if manifest != previous_manifest:
+        save_manifest(manifest, cache_filename)
+
+    return manifest
+
+
+# For each dir in the manifest ('' being the root), a dict of the names in it to their entries
+def manifest_children(manifest):
+    children = {'': {}}
+
+    for rel_path, entry in manifest['entries'].items():
+        rel_dir, _, name = rel_path.rpartition('/')
+        children.setdefault(rel_dir, {})[name] = entry
+        if entry['type'] == ENTRY_TYPE_DIR:
+            children.setdefault(rel_path, {})
+
+    return children
+
+
+# Compares the tree at folder with a manifest of the expected tree, which is described in differences as
+# expected_folder. The differences are the same as compare_folders would find between folder and the expected
+# tree, except that files that differ in content are found by comparing a hash of the whole file.
+# If base_dir is given, folder is relative to it (rather than the cwd). If is_known_match is given, it's called
+# with (filename, entry) for each file of the right size, and returns True if the file is known to have the entry's
+# contents without reading it (e.g. it's a hard link to a copy of the expected file). If compare_file is given, it's
+# used instead of the hash, for manifests without hashes: it's called with (filename, the file's path relative to
+# folder, and the two names to use in differences), and returns a difference or None.
+# Returns True if the scan was aborted due to first difference found.
+def compare_folder_to_manifest(folder, manifest, expected_folder, differences, exit_on_first_difference=False,
+                               ignore_files=[], base_dir='', is_known_match=None, compare_file=None):
+    children = manifest_children(manifest)
+
+    # a frame for each dir being compared: (its path relative to folder, its paths as described in differences,
+    # its entries on each side, and the common names still to look at, in reverse order)
+    stack = []
+
+    def enter_dir(rel_dir):
+        folder1 = os.path.join(folder, rel_dir) if rel_dir else folder
+        folder2 = os.path.join(expected_folder, rel_dir) if rel_dir else expected_folder
+
+        entries1 = scan_dir(os.path.join(base_dir, folder1), ignore_files)
+        names1 = set(entries1)
+        entries2 = children.get(rel_dir, {})
+        names2 = filter_files(entries2, ignore_files)
+
+        orphan_files = names1.symmetric_difference(names2)
+
+        if len(orphan_files):
+            # make it obvious which is a folder by appending '/'
+            files_with_slashes_end_dirs = [
+                f"{f}/" if entries1.get(f) or (f in entries2 and entries2[f]['type'] == ENTRY_TYPE_DIR) else f
+                for f in orphan_files]
+            files_with_slashes_end_dirs.sort()
+
+            differences.append(f"Between {folder1} and {folder2}, found orphan files/folders: {files_with_slashes_end_dirs}")
+            if exit_on_first_difference:
+                return True
+
+        common = set_to_sorted_list(names1.intersection(names2))
+        common.reverse()
+        stack.append((rel_dir, folder1, folder2, entries1, entries2, common))
+        return False
+
+    if enter_dir(''):
+        return True
+
+    while stack:
+        rel_dir, folder1, folder2, entries1, entries2, remaining = stack[-1]
+
+        if not remaining:
+            stack.pop()
+            continue
+
+        file = remaining.pop()
+        is_dir1 = entries1[file]
+        is_dir2 = entries2[file]['type'] == ENTRY_TYPE_DIR
+
+        if is_dir1 and is_dir2:
+            if enter_dir(join_rel_path(rel_dir, file)):
+                return True
+            continue
+
+        if is_dir1 or is_dir2:
+            differences.append(f"* One file, one folder: {file} in dirs {folder1} and {folder2}")
+            if exit_on_first_difference:
+                return True
+            continue
+
+        # it's two files
+        filename1 = os.path.join(folder1, file)
+        filename2 = os.path.join(folder2, file)
+        entry = entries2[file]
+
+        size1 = os.path.getsize(os.path.join(base_dir, filename1))
+        if size1 != entry['size']:
+            difference = f"* Size differs: {filename1} != {filename2}: {filename1} = {size1}, {filename2} = {entry['size']}"
+        elif is_known_match and is_known_match(os.path.join(base_dir, filename1), entry):
+            difference = None
+        elif compare_file:
+            difference = compare_file(os.path.join(base_dir, filename1), join_rel_path(rel_dir, file), filename1, filename2)
+        elif hash_file_contents(os.path.join(base_dir, filename1)) != entry['hash']:
+            difference = f"* Full file checksum differs: {filename1} != {filename2}"
+        else:
+            difference = None
+
+        if difference:
+            differences.append(difference)
+            if exit_on_first_difference:
+                return True
+
+    return False
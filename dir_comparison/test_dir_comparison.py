@@ -0,0 +1,167 @@
+import os
+import pytest
+
+from dir_comparison.dir_comparison import COMPARISON_MODE_EXACT, compare_folders
+
+
+def func(x):
+    return x + 1
+
+
+def test_answer():
+    assert func(3) == 4
+
+
+def pretty_print_differences(diffs):
+    print(len(diffs))
+    for difference in diffs:
+        print(difference)
+
+
+@pytest.fixture()
+def comparison_of_folder_differences(fake_dirs_with_diffs):
+    # we return an anonymous method -- this is how we can provide arg
+    # to a fixture -- see https://stackoverflow.com/a/44701916
+    def _method(exit_on_first_differences=False):
+        differences = []
+        compare_folders("0/", "1/", differences, exit_on_first_differences)
+        return differences
+
+    return _method
+
+
+# note the param is a fixture defined in conftest.py
+def test_same_contents(fake_dirs_same_contents):
+    differences = []
+    compare_folders("0/", "1/", differences, False)
+    assert not differences, "Expected to find no differences 1"
+
+
+# we just take an empty fs fixture directly
+def test_no_diffs_when_no_contents(fake_dirs_empty):
+    # print("compare_files result: (None = same) ", compare_files(f1, f2))
+    differences = []
+    compare_folders("0/", "1/", differences, False)
+    assert not differences, "Expected to find no differences 2"
+
+
+# differences returned in list are the strings:
+#
+# Between 0/dir1/dir1.1 and 1/dir1/dir1.1, found orphan files/folders: ['file_orphan_1.1.1.txt', 'file_orphan_1.1.1b.txt']
+# * Size differs: 0/dir1/file1.2.txt != 1/dir1/file1.2.txt: 0/dir1/file1.2.txt = 20, 1/dir1/file1.2.txt = 25
+# * One file, one folder: file-dir-same-name-A in dirs 0/ and 1/
+# * One file, one folder: file-dir-same-name-B in dirs 0/ and 1/
+# * Last part checksum mismatch: 0/file1_long_diff_end.txt and 1/file1_long_diff_end.txt
+# * First part checksum mismatch: 0/file1_long_diff_start.txt and 1/file1_long_diff_start.txt
+# * Full file checksum differs: 0/file1_short_diff.txt != 1/file1_short_diff.txt
+
+
+def test_when_diffs_detect_seven_issues(comparison_of_folder_differences):
+    assert len(comparison_of_folder_differences()) == 7
+    # pprint(differences)
+
+
+def test_when_diffs_detect_orhpans(comparison_of_folder_differences):
+    assert "Between 0/dir1/dir1.1 and 1/dir1/dir1.1, found orphan files/folders: ['file_orphan_1.1.1.txt', 'file_orphan_1.1.1b.txt']" in comparison_of_folder_differences()
+    # pprint(differences)
+
+
+def test_when_diffs_detect_size_difference(comparison_of_folder_differences):
+    assert "* Size differs: 0/dir1/file1.2.txt != 1/dir1/file1.2.txt: 0/dir1/file1.2.txt = 20, 1/dir1/file1.2.txt = 25" in comparison_of_folder_differences()
+
+
+def test_when_diffs_one_file_one_folder_difference_a(comparison_of_folder_differences):
+    assert "* One file, one folder: file-dir-same-name-A in dirs 0/ and 1/" in comparison_of_folder_differences()
+
+
+def test_when_diffs_one_file_one_folder_difference_b(comparison_of_folder_differences):
+    assert "* One file, one folder: file-dir-same-name-B in dirs 0/ and 1/" in comparison_of_folder_differences()
+
+
+def test_when_diffs_first_part_checksum_difference_detected(comparison_of_folder_differences):
+    assert "* First part checksum mismatch: 0/file1_long_diff_start.txt and 1/file1_long_diff_start.txt" in comparison_of_folder_differences()
+
+
+def test_when_diffs_last_part_checksum_difference_detected(comparison_of_folder_differences):
+    assert "* Last part checksum mismatch: 0/file1_long_diff_end.txt and 1/file1_long_diff_end.txt" in comparison_of_folder_differences()
+
+
+def test_when_diffs_full_checksum_difference_detected(comparison_of_folder_differences):
+    assert "* Full file checksum differs: 0/file1_short_diff.txt != 1/file1_short_diff.txt" in comparison_of_folder_differences()
+
+
+def test_exact_comparison_detects_differences_in_middle_of_long_files(fake_dirs_with_diffs):
+    fake_dirs_with_diffs.create_file("/0/file1_long_diff_middle.txt", contents="Hello! And why not, my friend. Kitten!\n")
+    fake_dirs_with_diffs.create_file("/1/file1_long_diff_middle.txt", contents="Hello! And why_not, my friend. Kitten!\n")
+
+    differences = []
+    compare_folders("0/", "1/", differences, False, comparison_mode=COMPARISON_MODE_EXACT)
+
+    assert "* Content differs at byte 14: 0/file1_long_diff_middle.txt != 1/file1_long_diff_middle.txt" in differences
+    assert "* Content differs at byte 36: 0/file1_long_diff_end.txt != 1/file1_long_diff_end.txt" in differences
+
+
+# deeper than the default recursion limit (on the real file system, as deep trees are slow to make with pyfakefs)
+def test_deep_trees_compared(tmp_path):
+    depth = 1100
+    deep_path = os.path.join(*["d"] * depth)
+    for folder, contents in [("0", "Hello!\n"), ("1", "_ello!\n")]:
+        # os.makedirs is recursive too
+        path = tmp_path / folder
+        path.mkdir()
+        for _ in range(depth):
+            path = path / "d"
+            path.mkdir()
+        (path / "file.txt").write_text(contents)
+
+    try:
+        differences = []
+        compare_folders("0", "1", differences, base_dir1=tmp_path, base_dir2=tmp_path)
+        assert differences == [f"* Full file checksum differs: 0/{deep_path}/file.txt != 1/{deep_path}/file.txt"]
+    finally:
+        # as is shutil.rmtree, which pytest uses to tidy up tmp_path
+        for folder in ["0", "1"]:
+            path = tmp_path / folder / deep_path
+            (path / "file.txt").unlink()
+            for _ in range(depth + 1):
+                path.rmdir()
+                path = path.parent
+
+
+def test_parallel_comparison_finds_same_differences_in_same_order(fake_dirs_with_diffs):
+    differences = []
+    compare_folders("0", "1", differences)
+    parallel_differences = []
+    compare_folders("0", "1", parallel_differences, workers=4)
+
+    assert parallel_differences == differences
+
+
+def test_parallel_comparison_exit_on_first_difference(fake_dirs_with_diffs):
+    fake_dirs_with_diffs.remove_object("/1/dir1/dir1.1/file_orphan_1.1.1b.txt")
+    fake_dirs_with_diffs.remove_object("/0/dir1/dir1.1/file_orphan_1.1.1.txt")
+
+    differences = []
+    assert compare_folders("0", "1", differences, exit_on_first_difference=True, workers=4)
+    assert differences == ["* Size differs: 0/dir1/file1.2.txt != 1/dir1/file1.2.txt: 0/dir1/file1.2.txt = 20, 1/dir1/file1.2.txt = 25"]
+
+
+def test_exit_on_first_difference(comparison_of_folder_differences):
+    assert "Between 0/dir1/dir1.1 and 1/dir1/dir1.1, found orphan files/folders: ['file_orphan_1.1.1.txt', 'file_orphan_1.1.1b.txt']" in comparison_of_folder_differences(True)
+
+# def test_it_exit_on_first_issue_with_diffs():
+#     """
+# >>> test_it_exit_on_first_issue_with_diffs()
+# 3
+# Between 0/dir1/dir1.1 and 1/dir1/dir1.1, found orphan files/folders: ['file_orphan_1.1.1.txt', 'file_orphan_1.1.1b.txt']
+# * Size differs: 0/dir1/file1.2.txt != 1/dir1/file1.2.txt: 0/dir1/file1.2.txt = 20, 1/dir1/file1.2.txt = 25
+# * One file, one folder: file-dir-same-name-A in dirs 0/ and 1/
+# >>>
+#     """
+#     with Patcher() as patcher:
+#         fs = fake_file_system.make_fake_dirs_with_diff(patcher.fs)
+#         # fs = fake_file_system.make_fake_dirs_with_diff(patcher.fs)
+#         # print("compare_files result: (None = same) ", compare_files(f1, f2))
+#         differences = []
+#         compare_folders("0/", "1/", differences, True)
+#         pretty_print_differences(differences)
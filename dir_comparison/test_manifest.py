@@ -0,0 +1,38 @@
+import hashlib
+
+from dir_comparison.manifest import build_manifest, cached_manifest, compare_folder_to_manifest, load_manifest
+
+
+# as compare_folders, plus the difference in the middle of dir1/file1.3.txt (which its checksum sampling misses)
+def test_manifest_comparison_finds_same_differences_as_folder_comparison(fake_dirs_with_diffs):
+    differences = []
+    manifest = build_manifest("1/")
+    compare_folder_to_manifest("0", manifest, "1", differences)
+
+    assert differences == [
+        "Between 0/dir1/dir1.1 and 1/dir1/dir1.1, found orphan files/folders: ['file_orphan_1.1.1.txt', 'file_orphan_1.1.1b.txt']",
+        "* Size differs: 0/dir1/file1.2.txt != 1/dir1/file1.2.txt: 0/dir1/file1.2.txt = 20, 1/dir1/file1.2.txt = 25",
+        "* Full file checksum differs: 0/dir1/file1.3.txt != 1/dir1/file1.3.txt",
+        "* One file, one folder: file-dir-same-name-A in dirs 0 and 1",
+        "* One file, one folder: file-dir-same-name-B in dirs 0 and 1",
+        "* Full file checksum differs: 0/file1_long_diff_end.txt != 1/file1_long_diff_end.txt",
+        "* Full file checksum differs: 0/file1_long_diff_start.txt != 1/file1_long_diff_start.txt",
+        "* Full file checksum differs: 0/file1_short_diff.txt != 1/file1_short_diff.txt",
+    ]
+
+
+def test_manifest_comparison_no_diffs_when_same_contents(fake_dirs_same_contents):
+    differences = []
+    compare_folder_to_manifest("0", build_manifest("1"), "1", differences)
+    assert not differences
+
+
+def test_cached_manifest_only_rehashes_changed_files(fake_dirs_same_contents):
+    manifest = cached_manifest("1", "/cache/manifest.json")
+    assert load_manifest("/cache/manifest.json") == manifest
+
+    fake_dirs_same_contents.create_file("/1/new_file.txt", contents="New!\n")
+    updated_manifest = cached_manifest("1", "/cache/manifest.json")
+
+    assert updated_manifest['entries']['new_file.txt']['hash'] == hashlib.sha256(b"New!\n").hexdigest()
+    assert updated_manifest['entries']['aaa/file1.txt'] == manifest['entries']['aaa/file1.txt']
@@ -0,0 +1,225 @@
+import errno
+import fcntl
+import fnmatch
+import os
+import shutil
+import threading
+
+# Strategies for materializing a test's input/ tree as its working/ tree.
+#
+# copy: plain copy of every file.
+# reflink: copy-on-write clone of every file (FICLONE), where the filesystem supports it. Falls back to a copy.
+# hardlink: hard link files declared read-only by the test, copy everything else.
+# auto: hard link files declared read-only, reflink or copy everything else.
+#
+# Whatever the strategy, the working tree is isolated from the input: a reflinked file is a separate file that
+# shares storage until written to. The exception is hard linked files -- these are the same file as in input/,
+# so a test must only hard link files its command doesn't change. Their permissions are left alone (changing them
+# would change input/'s), but each hard link is noted, so that a command that writes to one can be caught after it
+# has run (see changed_hard_links).
+STRATEGY_AUTO = 'auto'
+STRATEGY_REFLINK = 'reflink'
+STRATEGY_HARDLINK = 'hardlink'
+STRATEGY_COPY = 'copy'
+
+STRATEGIES = [STRATEGY_AUTO, STRATEGY_REFLINK, STRATEGY_HARDLINK, STRATEGY_COPY]
+
+# an overlay file named this followed by a name removes that name from the tree it's applied to (see apply_overlay)
+WHITEOUT_PREFIX = '.wh.'
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+# Whether reflinks work between two filesystems, keyed by (source st_dev, destination st_dev).
+# Filled in the first time we try a reflink between them.
+reflink_supported_for_devices = {}
+
+
+# Counts of what was copied and what was shared (reflinked or hard linked) while materializing trees.
+class MaterializeStats:
+    def __init__(self):
+        self.files_copied = 0
+        self.files_reflinked = 0
+        self.files_hardlinked = 0
+        self.bytes_copied = 0
+        self.bytes_shared = 0
+        # (path, file_signature(path)) of each file that was hard linked, as it was when it was linked.
+        # Not added up by add, as it's only of use for the tree it was made for.
+        self.hard_links = []
+
+    # notes that path was hard linked into the tree (so is the same file as the one there)
+    def add_hard_link(self, path, size):
+        self.files_hardlinked += 1
+        self.bytes_shared += size
+        self.hard_links.append((path, file_signature(path)))
+
+    def add(self, other):
+        self.files_copied += other.files_copied
+        self.files_reflinked += other.files_reflinked
+        self.files_hardlinked += other.files_hardlinked
+        self.bytes_copied += other.bytes_copied
+        self.bytes_shared += other.bytes_shared
+
+    def __str__(self):
+        return (f"{self.bytes_copied} bytes copied ({self.files_copied} files), "
+                f"{self.bytes_shared} bytes shared ({self.files_reflinked} reflinked, {self.files_hardlinked} hard linked)")
+
+
+# what changes when a file is written to: its inode (if it's replaced), size and modification time (or None if it's gone)
+def file_signature(path):
+    try:
+        stats = os.stat(path)
+    except OSError:
+        return None
+
+    return stats.st_ino, stats.st_size, stats.st_mtime_ns
+
+
+# the files hard linked into a tree (see MaterializeStats.hard_links) that have been written to since
+def changed_hard_links(stats):
+    return [path for path, signature in stats.hard_links if file_signature(path) != signature]
+
+
+def reflink_file(src, dst):
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+
+# tries to reflink src to dst, returning False (and leaving no dst behind) if the filesystem doesn't support it.
+def try_reflink_file(src, dst):
+    devices = (os.stat(src).st_dev, os.stat(os.path.dirname(dst)).st_dev)
+
+    if reflink_supported_for_devices.get(devices) is False:
+        return False
+
+    try:
+        reflink_file(src, dst)
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.ENOSYS, errno.EPERM):
+            raise
+        reflink_supported_for_devices[devices] = False
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+
+    reflink_supported_for_devices[devices] = True
+    shutil.copystat(src, dst)
+    return True
+
+
+# True if the path (relative to the root of the tree being materialized) matches one of the glob patterns
+def matches_any(rel_path, patterns):
+    rel_path = rel_path.replace(os.path.sep, '/')
+    return any(fnmatch.fnmatch(rel_path, pattern) for pattern in patterns)
+
+
+# Returns a function copying a file (given by path) from the tree at src_dir using the given strategy, for
+# shutil.copytree. readonly_patterns are globs (relative to src_dir) for files that can be hard linked rather than
+# copied. Counts are added to stats.
+def tree_copy_function(src_dir, strategy, readonly_patterns, stats):
+    use_reflinks = strategy in (STRATEGY_AUTO, STRATEGY_REFLINK)
+    use_hardlinks = strategy in (STRATEGY_AUTO, STRATEGY_HARDLINK) and readonly_patterns
+
+    def copy_file(src, dst):
+        size = os.stat(src).st_size
+
+        if use_hardlinks and matches_any(os.path.relpath(src, src_dir), readonly_patterns):
+            try:
+                os.link(src, dst)
+                stats.add_hard_link(src, size)
+                return dst
+            except OSError:
+                pass
+
+        if use_reflinks and try_reflink_file(src, dst):
+            stats.files_reflinked += 1
+            stats.bytes_shared += size
+            return dst
+
+        shutil.copy2(src, dst)
+        stats.files_copied += 1
+        stats.bytes_copied += size
+        return dst
+
+    return copy_file
+
+
+# Copies the tree at src_dir to dst_dir (which mustn't exist) using the given strategy.
+# readonly_patterns are globs (relative to src_dir) for files that can be hard linked rather than copied.
+# Counts are added to stats, if given.
+def materialize_tree(src_dir, dst_dir, strategy=STRATEGY_AUTO, readonly_patterns=(), stats=None):
+    if stats is None:
+        stats = MaterializeStats()
+
+    shutil.copytree(src_dir, dst_dir, copy_function=tree_copy_function(src_dir, strategy, readonly_patterns, stats))
+
+    return stats
+
+
+# removes the file or dir at path, if there is one
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+# Applies the tree at overlay_dir to the tree at dst_dir: its files are copied (as materialize_tree would) over any
+# in dst_dir, and a file named WHITEOUT_PREFIX + name removes name (a file or dir) from dst_dir.
+def apply_overlay(overlay_dir, dst_dir, strategy=STRATEGY_AUTO, readonly_patterns=(), stats=None):
+    if stats is None:
+        stats = MaterializeStats()
+
+    copy_file = tree_copy_function(overlay_dir, strategy, readonly_patterns, stats)
+
+    for dir_path, dir_names, file_names in os.walk(overlay_dir):
+        rel_dir = os.path.relpath(dir_path, overlay_dir)
+        dst_rel_dir = os.path.normpath(os.path.join(dst_dir, rel_dir))
+
+        for file_name in file_names:
+            if file_name.startswith(WHITEOUT_PREFIX):
+                remove_path(os.path.join(dst_rel_dir, file_name[len(WHITEOUT_PREFIX):]))
+                continue
+
+            dst = os.path.join(dst_rel_dir, file_name)
+            # removed rather than written over, as it could be a hard link to a file in the base
+            remove_path(dst)
+            copy_file(os.path.join(dir_path, file_name), dst)
+
+        for dir_name in dir_names:
+            dst = os.path.join(dst_rel_dir, dir_name)
+            if not os.path.isdir(dst) or os.path.islink(dst):
+                remove_path(dst)
+                os.mkdir(dst)
+
+    return stats
+
+
+# The base trees tests can use as their input, with their own input/ as an overlay (see input_base in the readme).
+# Each base is found by name in bases_dir. If cache_dir is given, a base is copied there the first time a test
+# uses it (e.g. so working/ dirs in a scratch root can be made from a copy on the same filesystem), once per run.
+class InputBases:
+    def __init__(self, bases_dir, cache_dir=None):
+        self.bases_dir = bases_dir
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        # name -> the dir to materialize the base from
+        self.base_dirs = {}
+
+    # The dir of the base with the given name. Raises ValueError if there's no such base.
+    def base_dir(self, name):
+        with self.lock:
+            if name not in self.base_dirs:
+                src_dir = os.path.join(self.bases_dir, name)
+                if os.path.sep in name or name in ('', '.', '..') or not os.path.isdir(src_dir):
+                    raise ValueError(f"there's no input base '{name}' in {self.bases_dir}")
+
+                if self.cache_dir:
+                    cached_dir = os.path.join(self.cache_dir, name)
+                    shutil.rmtree(cached_dir, ignore_errors=True)
+                    materialize_tree(src_dir, cached_dir, STRATEGY_REFLINK)
+                    src_dir = cached_dir
+
+                self.base_dirs[name] = src_dir
+
+            return self.base_dirs[name]
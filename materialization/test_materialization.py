@@ -0,0 +1,108 @@
+import errno
+import os
+import shutil
+
+import pytest
+
+from materialization import materialization
+from materialization.materialization import STRATEGY_AUTO, STRATEGY_COPY, STRATEGY_HARDLINK, STRATEGY_REFLINK, \
+    WHITEOUT_PREFIX, apply_overlay, changed_hard_links, materialize_tree
+
+
+def make_input(input_dir):
+    (input_dir / 'data').mkdir(parents=True)
+    (input_dir / 'data' / 'a.txt').write_text("a")
+    (input_dir / 'big.bin').write_text("readonly")
+
+
+def is_same_file(path1, path2):
+    return os.stat(path1).st_ino == os.stat(path2).st_ino
+
+
+@pytest.fixture
+def reflinks(monkeypatch):
+    # whether reflinks work depends on the filesystem, so they're faked: a reflink is a copy
+    monkeypatch.setattr(materialization, 'reflink_supported_for_devices', {})
+    monkeypatch.setattr(materialization, 'reflink_file', shutil.copyfile)
+
+
+@pytest.mark.parametrize('strategy, copied, reflinked, hardlinked', [(STRATEGY_COPY, 2, 0, 0),
+                                                                      (STRATEGY_REFLINK, 0, 2, 0),
+                                                                      (STRATEGY_HARDLINK, 1, 0, 1),
+                                                                      (STRATEGY_AUTO, 0, 1, 1)])
+def test_each_strategy_copies_links_or_reflinks(tmp_path, reflinks, strategy, copied, reflinked, hardlinked):
+    make_input(tmp_path / 'input')
+
+    stats = materialize_tree(tmp_path / 'input', tmp_path / 'working', strategy, ['*.bin'])
+
+    assert (stats.files_copied, stats.files_reflinked, stats.files_hardlinked) == (copied, reflinked, hardlinked)
+    assert (tmp_path / 'working' / 'data' / 'a.txt').read_text() == "a"
+    assert not is_same_file(tmp_path / 'input' / 'data' / 'a.txt', tmp_path / 'working' / 'data' / 'a.txt')
+    assert is_same_file(tmp_path / 'input' / 'big.bin', tmp_path / 'working' / 'big.bin') == bool(hardlinked)
+
+
+def test_materializing_leaves_the_input_files_alone(tmp_path):
+    make_input(tmp_path / 'input')
+    modes = {path: os.stat(path).st_mode for path in (tmp_path / 'input').rglob('*')}
+
+    materialize_tree(tmp_path / 'input', tmp_path / 'working', STRATEGY_HARDLINK, ['*.bin'])
+
+    assert {path: os.stat(path).st_mode for path in (tmp_path / 'input').rglob('*')} == modes
+
+
+def test_writes_to_hard_linked_files_are_found(tmp_path):
+    make_input(tmp_path / 'input')
+    (tmp_path / 'input' / 'other.bin').write_text("readonly")
+    stats = materialize_tree(tmp_path / 'input', tmp_path / 'working', STRATEGY_HARDLINK, ['*.bin'])
+
+    assert changed_hard_links(stats) == []
+
+    (tmp_path / 'working' / 'big.bin').write_text("written to")
+    # replacing a hard linked file doesn't change input/
+    (tmp_path / 'working' / 'other.bin').unlink()
+    (tmp_path / 'working' / 'other.bin').write_text("replaced")
+
+    assert changed_hard_links(stats) == [os.path.join(tmp_path / 'input', 'big.bin')]
+
+
+def test_falls_back_to_copying(tmp_path, monkeypatch):
+    def unsupported(*args):
+        raise OSError(errno.EXDEV, "not supported here")
+
+    monkeypatch.setattr(materialization, 'reflink_supported_for_devices', {})
+    monkeypatch.setattr(materialization, 'reflink_file', unsupported)
+    monkeypatch.setattr(os, 'link', unsupported)
+    make_input(tmp_path / 'input')
+
+    stats = materialize_tree(tmp_path / 'input', tmp_path / 'working', STRATEGY_AUTO, ['*.bin'])
+
+    assert (stats.files_copied, stats.files_reflinked, stats.files_hardlinked) == (2, 0, 0)
+    assert (tmp_path / 'working' / 'big.bin').read_text() == "readonly"
+    # reflinks aren't tried again between the same filesystems
+    assert list(materialization.reflink_supported_for_devices.values()) == [False]
+
+
+def test_overlay_replaces_adds_and_whites_out_files(tmp_path):
+    base = tmp_path / 'base'
+    (base / 'data' / 'old').mkdir(parents=True)
+    (base / 'data' / 'a.txt').write_text("base a")
+    (base / 'data' / 'b.txt').write_text("base b")
+    (base / 'data' / 'old' / 'c.txt').write_text("base c")
+    (base / 'shared.bin').write_text("readonly")
+
+    overlay = tmp_path / 'overlay'
+    (overlay / 'data').mkdir(parents=True)
+    (overlay / 'data' / 'a.txt').write_text("overlay a")
+    (overlay / 'data' / f'{WHITEOUT_PREFIX}b.txt').write_text("")
+    (overlay / 'data' / f'{WHITEOUT_PREFIX}old').write_text("")
+    (overlay / 'new').mkdir()
+    (overlay / 'new' / 'd.txt').write_text("overlay d")
+
+    working = tmp_path / 'working'
+    materialize_tree(base, working, STRATEGY_AUTO, ['*.bin'])
+    apply_overlay(overlay, working)
+
+    files = sorted(str(path.relative_to(working)) for path in working.rglob('*') if path.is_file())
+    assert files == ['data/a.txt', 'new/d.txt', 'shared.bin']
+    assert (working / 'data' / 'a.txt').read_text() == "overlay a"
+    assert (base / 'data' / 'a.txt').read_text() == "base a"
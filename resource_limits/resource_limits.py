@@ -0,0 +1,162 @@
+import os
+import re
+import resource
+import signal
+import tempfile
+
+# Limits on the resources a test's command can use, so a hung or runaway command fails its test rather than
+# holding up (or taking down) the whole suite.
+#
+# max_memory, max_cpu_seconds and max_file_size are set with ulimit by the shell running the command, before the
+# command starts, so they apply to the shell and everything it starts. (They can't be set in the new process from
+# Python: Popen's preexec_fn isn't safe when BBT has threads, as it does with --jobs or the asyncio engine.) The
+# command is run in a process group of its own, so when a test hits its timeout (or max_stdout_bytes), the whole
+# group is killed.
+
+# results for tests that were stopped for taking too long, or for using too much of something else
+RESULT_TIMEOUT = 'TIMEOUT'
+RESULT_LIMIT = 'LIMIT'
+
+# what a command usually writes to stderr when it can't get more memory, and how much of the end of stderr is searched
+# for them
+OUT_OF_MEMORY_MARKERS = [b'MemoryError', b'ENOMEM', b'Cannot allocate memory', b'out of memory', b'bad_alloc']
+STDERR_TAIL_SIZE = 64 * 1024
+
+SIZE_SUFFIXES = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(value):
+    """
+    Number of bytes for a size given as a number, or a string with an optional K, M, G or T suffix (powers of 1024):
+
+        >>> parse_size(4096)
+        4096
+        >>> [parse_size(x) for x in ['100', '64K', '1.5M', '2GB', '1 GiB']]
+        [100, 65536, 1572864, 2147483648, 1073741824]
+        >>> parse_size('lots')
+        Traceback (most recent call last):
+        ...
+        ValueError: not a size: 'lots'
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*', str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"not a size: {value!r}")
+
+    return int(float(match.group(1)) * SIZE_SUFFIXES[match.group(2).upper()])
+
+
+# ulimit's option for each limit, and the size of the units it takes them in (for file sizes, 512 byte blocks,
+# as in both dash and bash when run as sh)
+ULIMIT_OPTIONS = {resource.RLIMIT_AS: ('-v', 1024), resource.RLIMIT_CPU: ('-t', 1), resource.RLIMIT_FSIZE: ('-f', 512)}
+
+
+# The ulimit commands setting the soft limit to value (and the hard limit to hard_value, or value), in bytes or
+# seconds. Values are rounded up to ulimit's units, without going over BBT's own hard limit, which the shell inherits
+# (ulimit fails if it's asked to raise it). The soft limit is set first, as it can't be more than the hard limit.
+def ulimit_commands(limit, value, hard_value=None):
+    option, unit = ULIMIT_OPTIONS[limit]
+    current_hard_value = resource.getrlimit(limit)[1]
+    hard_value = value if hard_value is None else hard_value
+
+    values = [-(-value // unit), -(-hard_value // unit)]
+    if current_hard_value != resource.RLIM_INFINITY:
+        values = [min(v, current_hard_value // unit) for v in values]
+
+    if values[0] == values[1]:
+        return [f"ulimit {option} {values[0]}"]
+
+    return [f"ulimit -S {option} {values[0]}", f"ulimit -H {option} {values[1]}"]
+
+
+class ResourceLimits:
+    def __init__(self, max_memory=None, max_cpu_seconds=None, max_file_size=None):
+        # bytes of address space
+        self.max_memory = max_memory
+        self.max_cpu_seconds = max_cpu_seconds
+        # bytes in any one file the command writes
+        self.max_file_size = max_file_size
+
+    def shell_prefix(self):
+        """
+        Shell commands setting the limits, to go in front of the command (or '' if there are no limits to set):
+
+            >>> ResourceLimits(max_cpu_seconds=5, max_file_size=1000).shell_prefix()
+            'ulimit -S -t 5; ulimit -H -t 6; ulimit -f 2; '
+        """
+        commands = []
+
+        if self.max_memory is not None:
+            commands += ulimit_commands(resource.RLIMIT_AS, self.max_memory)
+        if self.max_cpu_seconds is not None:
+            # SIGXCPU at the soft limit, SIGKILL a second later if that's ignored
+            commands += ulimit_commands(resource.RLIMIT_CPU, self.max_cpu_seconds, self.max_cpu_seconds + 1)
+        if self.max_file_size is not None:
+            commands += ulimit_commands(resource.RLIMIT_FSIZE, self.max_file_size)
+
+        return ''.join(f"{command}; " for command in commands)
+
+    # Where the command's stderr goes: nowhere (None), unless max_memory is set, when it's kept to look for signs of
+    # running out of memory. It's kept in a temporary file, so a command writing lots to it can't block on a full pipe.
+    def open_stderr(self):
+        return tempfile.TemporaryFile() if self.max_memory is not None else None
+
+    # If the command was killed for going over one of the limits, a description of what happened (or None).
+    # The signal can be in returncode as -signal (the command itself was killed) or as 128 + signal (the shell
+    # running the command passed on the exit status of something it ran that was killed).
+    # A command that goes over max_memory usually isn't killed, but fails when it can't get more memory, so it's only
+    # taken to have gone over it if it crashed, or said it was out of memory on stderr (of which stderr_tail is the end).
+    def exceeded_message(self, returncode, expected_return_code=0, stderr_tail=b''):
+        if self.max_cpu_seconds is not None and killed_by_signal(returncode, [signal.SIGXCPU, signal.SIGKILL]):
+            return f"* Used more than max_cpu_seconds ({self.max_cpu_seconds}s) of CPU time, so was killed"
+        if self.max_file_size is not None and killed_by_signal(returncode, [signal.SIGXFSZ]):
+            return f"* Wrote a file bigger than max_file_size ({self.max_file_size} bytes), so was killed"
+        if self.max_memory is not None and returncode != expected_return_code and \
+                (killed_by_signal(returncode, [signal.SIGKILL, signal.SIGSEGV]) or ran_out_of_memory(stderr_tail)):
+            return (f"* Ran out of memory (max_memory is {self.max_memory} bytes), returning status code {returncode} "
+                    f"when expected {expected_return_code}")
+
+        return None
+
+    # A line to add to the report of a command that failed without signs of going over max_memory (or None)
+    def failure_hint(self):
+        if self.max_memory is not None:
+            return f"  (max_memory is {self.max_memory} bytes: the command may have run out of memory)"
+
+        return None
+
+
+def ran_out_of_memory(stderr_tail):
+    """
+        >>> ran_out_of_memory(b'Traceback (most recent call last):\\nMemoryError\\n'), ran_out_of_memory(b'No such file\\n')
+        (True, False)
+    """
+    return any(marker in stderr_tail for marker in OUT_OF_MEMORY_MARKERS)
+
+
+# the end of the stderr kept in file (see ResourceLimits.open_stderr), which is closed
+def read_stderr_tail(file):
+    with file:
+        file.seek(max(0, file.seek(0, os.SEEK_END) - STDERR_TAIL_SIZE))
+        return file.read()
+
+
+def killed_by_signal(returncode, signals):
+    """
+        >>> killed_by_signal(-signal.SIGXCPU, [signal.SIGXCPU]), killed_by_signal(128 + signal.SIGXCPU, [signal.SIGXCPU])
+        (True, True)
+        >>> killed_by_signal(1, [signal.SIGXCPU])
+        False
+    """
+    return any(returncode in (-signal_number, 128 + signal_number) for signal_number in signals)
+
+
+# kills the process group led by pid (i.e. a command started with start_new_session=True, and anything it started)
+def kill_process_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        # it's already gone
+        pass
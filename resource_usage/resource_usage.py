@@ -0,0 +1,148 @@
+import os
+import re
+import sys
+import time
+
+# What a test's command used: wall time, CPU time, peak memory and block I/O, from the rusage the OS gives for the
+# command's process (and all the processes it waited for) when it exits.
+#
+# In record mode the usage is saved next to stdout.txt as a baseline. A test can then fail if its command uses more
+# than the baseline by more than a tolerance, e.g. max_wall_time_regression: 20%.
+#
+# asyncio and yaml are imported where they're used, as they're slow to import and often not needed.
+
+METRIC_WALL_TIME = 'wall_time'
+METRIC_USER_TIME = 'user_time'
+METRIC_SYSTEM_TIME = 'system_time'
+METRIC_MAX_RSS = 'max_rss'
+METRIC_BLOCK_INPUT = 'block_input'
+METRIC_BLOCK_OUTPUT = 'block_output'
+
+METRICS = [METRIC_WALL_TIME, METRIC_USER_TIME, METRIC_SYSTEM_TIME, METRIC_MAX_RSS, METRIC_BLOCK_INPUT, METRIC_BLOCK_OUTPUT]
+
+# how each metric is shown in messages
+METRIC_FORMATS = {
+    METRIC_WALL_TIME: '{:.3f}s',
+    METRIC_USER_TIME: '{:.3f}s',
+    METRIC_SYSTEM_TIME: '{:.3f}s',
+    METRIC_MAX_RSS: '{:,} bytes',
+    METRIC_BLOCK_INPUT: '{:,} blocks',
+    METRIC_BLOCK_OUTPUT: '{:,} blocks',
+}
+
+
+# the size of the units of ru_maxrss: bytes on macOS, kilobytes on Linux (and the other platforms BBT runs on)
+def max_rss_unit():
+    return 1 if sys.platform == 'darwin' else 1024
+
+
+def resource_usage(rusage, wall_time):
+    return {
+        METRIC_WALL_TIME: wall_time,
+        METRIC_USER_TIME: rusage.ru_utime,
+        METRIC_SYSTEM_TIME: rusage.ru_stime,
+        METRIC_MAX_RSS: rusage.ru_maxrss * max_rss_unit(),
+        METRIC_BLOCK_INPUT: rusage.ru_inblock,
+        METRIC_BLOCK_OUTPUT: rusage.ru_oublock,
+    }
+
+
+# Waits for the Popen process to exit (with os.wait4, to get its rusage, rather than Popen.wait).
+# Returns (returncode, resource usage), where the wall time is measured from start_time (a perf_counter time).
+# If given, on_exit is called once the process has exited but before it's reaped, while its pid can't be reused.
+def wait_for_process(process, start_time, on_exit=None):
+    if on_exit:
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        on_exit()
+
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    return process.returncode, resource_usage(rusage, time.perf_counter() - start_time)
+
+
+# As wait_for_process, without blocking the event loop. Where there are pidfds (Linux 5.3 and later), the loop
+# watches one for the process exiting; otherwise a thread waits for it.
+async def wait_for_process_async(process, start_time, on_exit=None):
+    import asyncio
+    loop = asyncio.get_running_loop()
+
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        return await loop.run_in_executor(None, wait_for_process, process, start_time, on_exit)
+
+    try:
+        exited = loop.create_future()
+        loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+    finally:
+        os.close(pidfd)
+
+    if on_exit:
+        on_exit()
+
+    return wait_for_process(process, start_time)
+
+
+# the baseline saved in filename, or None if there isn't one. open_file opens it for reading (e.g. from a suite archive).
+def load_baseline(filename, open_file=open):
+    import yaml
+
+    try:
+        with open_file(filename) as file:
+            return yaml.safe_load(file) or {}
+    except IOError:
+        return None
+
+
+def save_baseline(filename, usage):
+    import yaml
+
+    with open(filename, 'w') as file:
+        yaml.safe_dump(usage, file)
+
+
+def parse_tolerance(value):
+    """
+    A tolerance as a fraction of the baseline, from a percentage (the '%' is optional):
+
+        >>> [parse_tolerance(x) for x in ['20%', '150 %', 5, '2.5']]
+        [0.2, 1.5, 0.05, 0.025]
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*%?\s*', str(value))
+    if not match:
+        raise ValueError(f"not a percentage: {value!r}")
+
+    return float(match.group(1)) / 100
+
+
+def regressions(usage, baseline, tolerances):
+    """
+    Messages for the metrics in usage that are more than their baseline by more than their tolerance (a fraction,
+    keyed by metric):
+
+        >>> regressions({'wall_time': 1.3, 'max_rss': 1000}, {'wall_time': 1.0, 'max_rss': 900},
+        ...             {'wall_time': 0.2, 'max_rss': 0.2})
+        ['* wall_time regressed by 30%: measured 1.300s, baseline 1.000s (tolerance 20%)']
+    """
+    messages = []
+
+    for metric in METRICS:
+        if metric not in tolerances or metric not in baseline or metric not in usage:
+            continue
+
+        measured = usage[metric]
+        baseline_value = baseline[metric]
+        tolerance = tolerances[metric]
+
+        if measured > baseline_value * (1 + tolerance):
+            value_format = METRIC_FORMATS[metric]
+            change = f"by {(measured - baseline_value) / baseline_value:.0%}" if baseline_value else "from 0"
+            messages.append(f"* {metric} regressed {change}: measured {value_format.format(measured)}, "
+                            f"baseline {value_format.format(baseline_value)} (tolerance {tolerance:.0%})")
+
+    return messages
@@ -0,0 +1,66 @@
+import asyncio
+import resource
+import time
+
+import pytest
+
+from resource_usage.resource_usage import METRICS, METRIC_MAX_RSS, METRIC_WALL_TIME, resource_usage, \
+    wait_for_process, wait_for_process_async
+
+
+def test_wait_for_process_measures_the_command():
+    import subprocess
+
+    start_time = time.perf_counter()
+    process = subprocess.Popen("sleep 0.1; exit 3", shell=True)
+
+    returncode, usage = wait_for_process(process, start_time)
+
+    assert returncode == 3 and process.returncode == 3
+    assert usage[METRIC_WALL_TIME] >= 0.1
+    assert usage[METRIC_MAX_RSS] > 0
+
+
+def test_wait_for_process_async_measures_the_command():
+    import subprocess
+
+    async def run():
+        process = subprocess.Popen("exit 2", shell=True)
+        return await wait_for_process_async(process, time.perf_counter())
+
+    returncode, usage = asyncio.run(run())
+
+    assert returncode == 2
+    assert set(usage) == set(METRICS)
+
+
+@pytest.mark.parametrize('use_pidfd', [True, False])
+def test_on_exit_is_called_before_the_process_is_reaped(monkeypatch, use_pidfd):
+    import os
+    import subprocess
+
+    if not use_pidfd:
+        monkeypatch.delattr(os, 'pidfd_open', raising=False)
+
+    async def run():
+        process = subprocess.Popen("exit 4", shell=True)
+
+        def on_exit():
+            # still there to be reaped, so its pid can't have been reused
+            assert os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT | os.WNOHANG).si_pid == process.pid
+            exits.append(process.pid)
+
+        return await wait_for_process_async(process, time.perf_counter(), on_exit)
+
+    exits = []
+    returncode, _ = asyncio.run(run())
+
+    assert returncode == 4 and len(exits) == 1
+
+
+@pytest.mark.parametrize('platform, max_rss', [('linux', 2048 * 1024), ('darwin', 2048)])
+def test_max_rss_is_in_bytes(monkeypatch, platform, max_rss):
+    monkeypatch.setattr('sys.platform', platform)
+    rusage = resource.struct_rusage((0.5, 0.25, 2048) + (0,) * 13)
+
+    assert resource_usage(rusage, 1)[METRIC_MAX_RSS] == max_rss
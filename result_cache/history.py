@@ -0,0 +1,94 @@
+import json
+
+from dir_comparison.manifest import save_manifest
+
+# The history of a test suite: for each test (by name), how long it took and whether it passed when it was last run.
+# It's used to split a suite into shards that take about the same time to run, and to run the tests that failed
+# last time first (--failed-first).
+
+HISTORY_VERSION = 1
+
+
+class TestHistory:
+    # stop pytest trying to collect this class
+    __test__ = False
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        # test name -> {'duration': seconds, 'succeeded': bool}
+        self.tests = {}
+
+        if filename is None:
+            return
+
+        try:
+            with open(filename, 'r') as file:
+                history = json.load(file)
+        except (IOError, ValueError):
+            return
+
+        if history.get('version') == HISTORY_VERSION:
+            self.tests = history['tests']
+
+    def durations(self):
+        return {test_name: test['duration'] for test_name, test in self.tests.items()}
+
+    # the names of the tests that failed when they were last run
+    def failed(self):
+        return {test_name for test_name, test in self.tests.items() if not test['succeeded']}
+
+    def record(self, test_name, duration, succeeded):
+        self.tests[test_name] = {'duration': duration, 'succeeded': succeeded}
+
+    # written the same way as a manifest, so it's never seen half written
+    def save(self, filename=None):
+        save_manifest({'version': HISTORY_VERSION, 'tests': self.tests}, filename or self.filename)
+
+
+def failed_first(tests, failed):
+    """
+    Returns the tests (from the list tests, e.g. of names), with those in failed first. Otherwise they're kept in
+    the order given:
+
+        >>> failed_first(['a', 'b', 'c', 'd'], {'c', 'a'})
+        ['a', 'c', 'b', 'd']
+    """
+    return sorted(tests, key=lambda test: test not in failed)
+
+
+def shard_tests(test_names, shard_index, shard_count, durations={}):
+    """
+    Returns the names of the tests (from the list test_names) in shard shard_index (1 to shard_count). Every test is
+    in exactly one shard, and the split only depends on the arguments, so each machine running a shard gets the same split.
+
+    With no durations for any of the tests, they're dealt out in turn:
+
+        >>> [shard_tests(['a', 'b', 'c', 'd', 'e'], i, 2) for i in [1, 2]]
+        [['a', 'c', 'e'], ['b', 'd']]
+
+    Otherwise the longest tests are placed first, each in the shard with the least to do so far. Tests without
+    a duration are taken to be of average length:
+
+        >>> durations = {'a': 10, 'b': 1, 'c': 6, 'd': 5}
+        >>> [shard_tests(['a', 'b', 'c', 'd', 'e'], i, 2, durations) for i in [1, 2]]
+        [['a', 'd'], ['b', 'c', 'e']]
+    """
+    known_durations = [durations[name] for name in test_names if name in durations]
+
+    if not known_durations:
+        return [name for position, name in enumerate(test_names) if position % shard_count == shard_index - 1]
+
+    average_duration = sum(known_durations) / len(known_durations)
+    test_durations = {name: durations.get(name, average_duration) for name in test_names}
+
+    # longest first. Ties are placed in name order.
+    longest_first = sorted(test_names, key=lambda name: (-test_durations[name], name))
+
+    shard_totals = [0] * shard_count
+    shard_for_test = {}
+    for name in longest_first:
+        shard = min(range(shard_count), key=lambda i: (shard_totals[i], i))
+        shard_totals[shard] += test_durations[name]
+        shard_for_test[name] = shard
+
+    return [name for name in test_names if shard_for_test[name] == shard_index - 1]
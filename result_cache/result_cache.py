@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import stat
+
+from dir_comparison.manifest import ENTRY_TYPE_FILE, build_manifest, entry_is_current, hash_file_contents, save_manifest
+
+# A test's fingerprint is a hash of everything that could change its result: its config, its input/ and output/ trees,
+# stdout.txt, the command and any files it declares it depends on (e.g. the binary being tested). The result cache
+# remembers the fingerprints of tests that passed, so a test with the same fingerprint needn't be run again.
+#
+# Trees are fingerprinted from their manifests (see manifest.py), so only files that have changed are read.
+# Files outside a tree are hashed in the same way, with their hashes kept in the result cache.
+
+RESULT_CACHE_VERSION = 1
+
+# used in a fingerprint for a file that doesn't exist
+MISSING_FILE_DIGEST = 'missing'
+
+
+def fingerprint(parts):
+    """
+    Hash of parts, which can be anything that can be written as JSON. Dict keys can be in any order:
+
+        >>> fingerprint({'a': 1, 'b': [2, 3]}) == fingerprint({'b': [2, 3], 'a': 1})
+        True
+        >>> fingerprint({'a': 1, 'b': [2, 3]}) == fingerprint({'a': 1, 'b': [3, 2]})
+        False
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+# Hash of the contents of the tree described by manifest. When, and where, its files were written doesn't matter.
+def tree_digest(manifest):
+    return fingerprint({rel_path: [entry['type'], entry['mode'], entry.get('size'), entry.get('hash')]
+                        for rel_path, entry in manifest['entries'].items()})
+
+
+class ResultCache:
+    def __init__(self, filename):
+        self.filename = filename
+        # test name -> fingerprint when it last passed
+        self.passed_tests = {}
+        # abs path -> {size, mtime_ns, ino, hash}, for file_digest
+        self.file_hashes = {}
+
+        try:
+            with open(filename, 'r') as file:
+                cache = json.load(file)
+        except (IOError, ValueError):
+            return
+
+        if cache.get('version') == RESULT_CACHE_VERSION:
+            self.passed_tests = cache['passed_tests']
+            self.file_hashes = cache['file_hashes']
+
+    # True if the test passed when it last had this fingerprint
+    def passed(self, test_name, test_fingerprint):
+        return test_fingerprint is not None and self.passed_tests.get(test_name) == test_fingerprint
+
+    def record(self, test_name, test_fingerprint, succeeded):
+        if succeeded and test_fingerprint is not None:
+            self.passed_tests[test_name] = test_fingerprint
+        else:
+            self.passed_tests.pop(test_name, None)
+
+    # hash of the file's contents, only read if it's changed since it was last hashed. For a dir, a hash of
+    # the tree's contents.
+    def file_digest(self, filename):
+        filename = os.path.abspath(filename)
+
+        try:
+            stat_result = os.stat(filename)
+        except OSError:
+            self.file_hashes.pop(filename, None)
+            return MISSING_FILE_DIGEST
+
+        if stat.S_ISDIR(stat_result.st_mode):
+            return tree_digest(build_manifest(filename))
+
+        entry = self.file_hashes.get(filename)
+        if entry is None or not entry_is_current(entry, stat_result):
+            entry = {'type': ENTRY_TYPE_FILE, 'size': stat_result.st_size, 'mtime_ns': stat_result.st_mtime_ns,
+                     'ino': stat_result.st_ino, 'hash': hash_file_contents(filename)}
+            self.file_hashes[filename] = entry
+
+        return entry['hash']
+
+    # written the same way as a manifest, so it's never seen half written
+    def save(self):
+        save_manifest({'version': RESULT_CACHE_VERSION, 'passed_tests': self.passed_tests,
+                       'file_hashes': self.file_hashes}, self.filename)
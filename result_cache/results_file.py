@@ -0,0 +1,36 @@
+import json
+
+from dir_comparison.manifest import save_manifest
+
+# A results file records the results of a run (or of one shard of a run), so the results of a suite split over
+# several machines can be merged into one report.
+
+RESULTS_FILE_VERSION = 1
+
+
+def save_results_file(filename, suite_dir, shard, tests):
+    save_manifest({'version': RESULTS_FILE_VERSION, 'suite_dir': suite_dir, 'shard': shard, 'tests': tests}, filename)
+
+
+def load_results_file(filename):
+    with open(filename, 'r') as file:
+        results = json.load(file)
+
+    if results.get('version') != RESULTS_FILE_VERSION:
+        raise ValueError(f"{filename} isn't a results file BBT can read")
+
+    return results
+
+
+# Combines the tests from several results files, in test index order.
+# Raises ValueError if a test is in more than one of them.
+def merge_results(results_list):
+    tests_by_index = {}
+
+    for results in results_list:
+        for test in results['tests']:
+            if test['index'] in tests_by_index:
+                raise ValueError(f"Test {test['index']} ({test['name']}) is in more than one results file")
+            tests_by_index[test['index']] = test
+
+    return [tests_by_index[index] for index in sorted(tests_by_index)]
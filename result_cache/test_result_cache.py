@@ -0,0 +1,36 @@
+from result_cache.history import TestHistory
+from result_cache.result_cache import MISSING_FILE_DIGEST, ResultCache
+
+
+def test_result_cache_remembers_passing_fingerprints(fs):
+    result_cache = ResultCache("/cache/results.json")
+    result_cache.record("test_a", "fingerprint_a", succeeded=True)
+    result_cache.record("test_b", "fingerprint_b", succeeded=False)
+    result_cache.save()
+
+    result_cache = ResultCache("/cache/results.json")
+    assert result_cache.passed("test_a", "fingerprint_a")
+    assert not result_cache.passed("test_a", "fingerprint_changed")
+    assert not result_cache.passed("test_b", "fingerprint_b")
+
+
+def test_file_digest_changes_with_contents(fs):
+    result_cache = ResultCache("/cache/results.json")
+    assert result_cache.file_digest("/bin/tool") == MISSING_FILE_DIGEST
+
+    fs.create_file("/bin/tool", contents="version 1")
+    digest = result_cache.file_digest("/bin/tool")
+    assert digest == result_cache.file_digest("/bin/tool")
+
+    with open("/bin/tool", "w") as file:
+        file.write("version 2")
+    assert result_cache.file_digest("/bin/tool") != digest
+
+
+def test_history_remembers_failed_tests(fs):
+    history = TestHistory("/cache/history.json")
+    history.record("test_a", 1.5, succeeded=True)
+    history.record("test_b", 0.5, succeeded=False)
+    history.save()
+
+    assert TestHistory("/cache/history.json").failed() == {"test_b"}
@@ -0,0 +1,17 @@
+import pytest
+
+from result_cache.results_file import merge_results
+
+
+def test_merge_results_orders_tests_by_index():
+    shard_1 = {'tests': [{'index': 0, 'name': 'a'}, {'index': 2, 'name': 'c'}]}
+    shard_2 = {'tests': [{'index': 1, 'name': 'b'}]}
+
+    assert [test['name'] for test in merge_results([shard_2, shard_1])] == ['a', 'b', 'c']
+
+
+def test_merge_results_rejects_duplicate_tests():
+    shard = {'tests': [{'index': 0, 'name': 'a'}]}
+
+    with pytest.raises(ValueError, match=r"Test 0 \(a\)"):
+        merge_results([shard, shard])
@@ -0,0 +1,90 @@
+import os
+import tempfile
+
+import click
+
+from resource_limits.resource_limits import parse_size
+from self_benchmark.self_benchmark import run_self_benchmark, save_self_benchmark
+from self_benchmark.suite_generator import SuiteShape, generate_suite
+
+# Benchmarks BBT itself, on generated suites, e.g.
+#
+#     python -m self_benchmark generate /tmp/bbt_suite --tests 20 --files 500 --large-files 1 --large-file-size 100M
+#     python -m self_benchmark run /tmp/bbt_suite --repeat 5 --output before.json
+#
+# run without a suite generates one of the default shape in a temporary dir. Everything runs locally: nothing is
+# downloaded. Two result files can be compared by eye, or tracked over time.
+
+
+def size_option(ctx, param, value):
+    try:
+        return parse_size(value)
+    except ValueError as error:
+        raise click.BadParameter(str(error))
+
+
+def shape_options(function):
+    defaults = SuiteShape()
+    options = [
+        click.option('--tests', default=defaults.tests, show_default=True, type=click.IntRange(min=1)),
+        click.option('--files', default=defaults.files, show_default=True, type=click.IntRange(min=1),
+                     help='Files in each test\'s input/'),
+        click.option('--depth', default=defaults.depth, show_default=True, type=click.IntRange(min=0),
+                     help='Depth of the dirs in each input/'),
+        click.option('--fanout', default=defaults.fanout, show_default=True, type=click.IntRange(min=1),
+                     help='Dirs in each dir'),
+        click.option('--min-file-size', default=str(defaults.min_file_size), show_default=True, callback=size_option),
+        click.option('--max-file-size', default=str(defaults.max_file_size), show_default=True, callback=size_option,
+                     help='File sizes are spread evenly on a log scale from the min to the max'),
+        click.option('--large-files', default=defaults.large_files, show_default=True, type=click.IntRange(min=0),
+                     help='Extra large files in each test\'s input/'),
+        click.option('--large-file-size', default=str(defaults.large_file_size), show_default=True, callback=size_option),
+        click.option('--stdout-size', default=str(defaults.stdout_size), show_default=True, callback=size_option,
+                     help='Size of each test\'s stdout'),
+        click.option('--definitions', default=defaults.definitions, show_default=True, type=click.IntRange(min=0),
+                     help='Definitions in global.yaml'),
+        click.option('--seed', default=defaults.seed, show_default=True, type=int),
+    ]
+    for option in reversed(options):
+        function = option(function)
+    return function
+
+
+@click.group()
+def self_benchmark():
+    pass
+
+
+@self_benchmark.command()
+@click.argument('suite_dir', type=click.Path(exists=False))
+@shape_options
+def generate(suite_dir, **shape):
+    """Generates a test suite for benchmarking BBT in SUITE_DIR, which mustn't exist yet."""
+    if os.path.exists(suite_dir):
+        raise click.ClickException(f"{suite_dir} already exists")
+
+    generate_suite(suite_dir, SuiteShape(**shape))
+
+
+@self_benchmark.command()
+@click.argument('suite_dir', required=False, type=click.Path(exists=True, file_okay=False))
+@click.option('--repeat', default=5, show_default=True, type=click.IntRange(min=1), help='Times to time each hot path')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the results to this file as JSON')
+def run(suite_dir, repeat, output):
+    """Times BBT's hot paths on the suite in SUITE_DIR (or on a suite of the default shape)."""
+    with tempfile.TemporaryDirectory(prefix='bbt_self_benchmark_suite_') as temp_dir:
+        if suite_dir is None:
+            suite_dir = os.path.join(temp_dir, 'suite')
+            generate_suite(suite_dir, SuiteShape())
+
+        results = run_self_benchmark(suite_dir, repeat)
+
+    for name, summary in results['benchmarks'].items():
+        print(f"{name:32} min {summary['min']:9.4f}s  median {summary['median']:9.4f}s  stdev {summary['stdev']:9.4f}s")
+
+    if output:
+        save_self_benchmark(output, results)
+
+
+if __name__ == '__main__':
+    self_benchmark()
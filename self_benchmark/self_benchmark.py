@@ -0,0 +1,183 @@
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmark.benchmark import summarize
+from blackbox_tester import RunOptions, compile_suite_plan, run_suite
+from dir_comparison.dir_comparison import COMPARISON_MODE_EXACT, COMPARISON_MODE_FAST_SAMPLING, compare_files_f, \
+    compare_folders
+from materialization.materialization import STRATEGY_COPY, materialize_tree
+from self_benchmark.suite_generator import STDOUT_MARKER, load_suite_shape
+from stdout_comparison.stdout_comparison import STDOUT_CHUNK_SIZE, StdoutPipeline
+from stdout_filters.stdout_filters import StdoutFilters
+
+# Times BBT's hot paths on a generated suite (see suite_generator.py), to see whether a change to BBT makes it
+# faster or slower:
+#
+# compare_folders: comparing each test's input/ with its output/ (an identical tree, so every file is read)
+# compare_files_f: comparing the biggest file in a test's input/ with its copy in output/, in each comparison mode
+# materialize: copying each test's input/ tree (with the copy strategy, so the time doesn't depend on the filesystem)
+# trim_stdout: skipping each test's stdout.txt up to STDOUT_MARKER, as it's read (ignore_stdout_until_after_line_containing)
+# stdout_filters: filtering each test's stdout.txt with BENCHMARK_STDOUT_FILTERS, as it's read
+# compile_plan: loading and checking every test's config (see suite_plan.py), without the plan cache, and with it
+# run_suite: running the whole suite, end to end
+# cli_startup: starting blackbox_tester.py (with --help), which the self-tests do once per test
+#
+# Each is timed repeat times, and summarized as for --benchmark (see benchmark.py). The results are JSON, so they
+# can be kept and tracked over time.
+
+SELF_BENCHMARK_VERSION = 1
+
+# a filter of each kind that does something to the generated stdout (see stdout_filters.py)
+BENCHMARK_STDOUT_FILTERS = [{'mask': '[aeiou]+'}, {'replace': '([b-d])x', 'with': '\\1y'}, 'strip_trailing_whitespace',
+                            {'drop_before': STDOUT_MARKER}, {'sort_between': [STDOUT_MARKER, 'no end marker']}]
+
+
+def time_runs(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start_time)
+
+    return summarize(times)
+
+
+def suite_test_dirs(suite_dir):
+    return sorted(entry.path for entry in os.scandir(suite_dir) if entry.is_dir())
+
+
+def biggest_file(folder):
+    files = [os.path.join(dir_path, file_name) for dir_path, _, file_names in os.walk(folder) for file_name in file_names]
+    return max(files, key=os.path.getsize)
+
+
+def time_compare_folders(test_dirs, repeat):
+    def compare_all():
+        for test_dir in test_dirs:
+            differences = []
+            compare_folders(os.path.join(test_dir, 'input'), os.path.join(test_dir, 'output'), differences,
+                            section_size=1024 * 64, comparison_mode=COMPARISON_MODE_EXACT)
+            assert not differences, differences
+
+    return time_runs(compare_all, repeat)
+
+
+def time_compare_files(test_dir, comparison_mode, repeat):
+    file1 = biggest_file(os.path.join(test_dir, 'input'))
+    file2 = os.path.join(test_dir, 'output', os.path.relpath(file1, os.path.join(test_dir, 'input')))
+
+    def compare():
+        with open(file1, 'rb') as f1, open(file2, 'rb') as f2:
+            assert compare_files_f(file1, file2, f1, f2, 1024 * 64, comparison_mode) is None
+
+    return time_runs(compare, repeat)
+
+
+def time_materialize(test_dirs, scratch_dir, repeat):
+    def materialize_all():
+        for test_dir in test_dirs:
+            working_dir = os.path.join(scratch_dir, os.path.basename(test_dir))
+            materialize_tree(os.path.join(test_dir, 'input'), working_dir, STRATEGY_COPY)
+        for test_dir in test_dirs:
+            shutil.rmtree(os.path.join(scratch_dir, os.path.basename(test_dir)))
+
+    return time_runs(materialize_all, repeat)
+
+
+# a sink for StdoutPipeline that throws stdout away
+class NullSink:
+    def feed(self, data):
+        pass
+
+    def finish(self):
+        pass
+
+
+# times feeding each test's stdout.txt through a StdoutPipeline, a chunk at a time as it would be read
+def time_stdout_pipeline(test_dirs, repeat, ignore_until_after_line_containing=None, filters=None):
+    stdouts = []
+    for test_dir in test_dirs:
+        with open(os.path.join(test_dir, 'stdout.txt'), 'rb') as file:
+            stdouts.append(file.read())
+
+    def feed_all():
+        for stdout in stdouts:
+            pipeline = StdoutPipeline(NullSink(), ignore_until_after_line_containing, filters=filters)
+            for offset in range(0, len(stdout), STDOUT_CHUNK_SIZE):
+                pipeline.feed(stdout[offset:offset + STDOUT_CHUNK_SIZE])
+            pipeline.finish()
+
+    return time_runs(feed_all, repeat)
+
+
+def time_compile_plan(suite_dir, cache_dir, repeat):
+    def compile_plan():
+        suite_plan = compile_suite_plan(suite_dir, cache_dir=cache_dir)
+        assert suite_plan and not any(plan.errors for plan in suite_plan.tests.values())
+
+    return time_runs(compile_plan, repeat)
+
+
+def time_run_suite(suite_dir, cache_dir, repeat):
+    options = RunOptions(cache_dir=cache_dir)
+
+    def run_all():
+        suite_result = run_suite(suite_dir, options)
+        assert suite_result.succeeded, [result.report for result in suite_result.results if not result.succeeded]
+
+    return time_runs(run_all, repeat)
+
+
+def time_cli_startup(repeat):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                            'blackbox_tester.py'), '--help']
+
+    def start():
+        subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+
+    return time_runs(start, repeat)
+
+
+# Times each of the hot paths on the suite in suite_dir. Returns the results, ready to be written as JSON.
+def run_self_benchmark(suite_dir, repeat=5):
+    suite_dir = os.path.abspath(suite_dir)
+    test_dirs = suite_test_dirs(suite_dir)
+
+    if not test_dirs:
+        raise ValueError(f"There are no tests in {suite_dir}")
+
+    with tempfile.TemporaryDirectory(prefix='bbt_self_benchmark_') as scratch_dir:
+        benchmarks = {
+            'compare_folders': time_compare_folders(test_dirs, repeat),
+            'compare_files_f_exact': time_compare_files(test_dirs[0], COMPARISON_MODE_EXACT, repeat),
+            'compare_files_f_fast_sampling': time_compare_files(test_dirs[0], COMPARISON_MODE_FAST_SAMPLING, repeat),
+            'materialize': time_materialize(test_dirs, scratch_dir, repeat),
+            'trim_stdout': time_stdout_pipeline(test_dirs, repeat, ignore_until_after_line_containing=STDOUT_MARKER),
+            'stdout_filters': time_stdout_pipeline(test_dirs, repeat, filters=StdoutFilters(BENCHMARK_STDOUT_FILTERS)),
+            'compile_plan': time_compile_plan(suite_dir, None, repeat),
+            'compile_plan_cached': time_compile_plan(suite_dir, os.path.join(scratch_dir, 'plan_cache'), repeat),
+            'run_suite': time_run_suite(suite_dir, os.path.join(scratch_dir, 'cache'), repeat),
+            'cli_startup': time_cli_startup(repeat),
+        }
+
+    return {
+        'version': SELF_BENCHMARK_VERSION,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'suite_dir': suite_dir,
+        'suite_shape': load_suite_shape(suite_dir),
+        'repeat': repeat,
+        'benchmarks': benchmarks,
+    }
+
+
+def save_self_benchmark(filename, results):
+    with open(filename, 'w') as file:
+        json.dump(results, file, indent=2)
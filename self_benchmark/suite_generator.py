@@ -0,0 +1,146 @@
+import math
+import os
+import random
+import shutil
+from dataclasses import asdict, dataclass
+
+import yaml
+
+# Generates synthetic test suites for benchmarking BBT itself (see self_benchmark.py).
+#
+# Each test's input/ is a tree of files of random content, and its output/ is a copy of it, as the command doesn't
+# change working/. The command cats a file from input/ of stdout_size bytes, which is also the test's stdout.txt.
+# The content only depends on the seed, so a suite can be generated again exactly.
+#
+# global.yaml has the given number of definitions, and each test's description refers to one of them.
+
+# the file (in input/) the command cats to stdout
+STDOUT_SOURCE_FILE = 'stdout_source.txt'
+# line in the middle of the stdout, for timing ignore_stdout_until_after_line_containing
+STDOUT_MARKER = 'BBT_BENCHMARK_MARKER'
+
+STDOUT_LINE_LENGTH = 80
+
+
+# The shape of a generated suite
+@dataclass
+class SuiteShape:
+    tests: int = 10
+    # files in each test's input/ tree (not counting large files)
+    files: int = 100
+    # how deep the tree's dirs go. Files are spread over the dirs at all levels.
+    depth: int = 3
+    # dirs in each dir, down to depth
+    fanout: int = 3
+    # file sizes are spread evenly on a log scale between these, so there are many more small files than big ones
+    min_file_size: int = 16
+    max_file_size: int = 64 * 1024
+    # extra large files in each test's input/
+    large_files: int = 0
+    large_file_size: int = 16 * 1024 * 1024
+    stdout_size: int = 64 * 1024
+    # definitions in global.yaml
+    definitions: int = 0
+    seed: int = 0
+
+
+# the dirs of a tree of the given depth and fanout, as paths relative to its root ('' is the root)
+def tree_dirs(depth, fanout):
+    """
+        >>> tree_dirs(2, 2)
+        ['', 'd0', 'd0/d0', 'd0/d1', 'd1', 'd1/d0', 'd1/d1']
+    """
+    dirs = ['']
+
+    def add_children(parent, level):
+        if level == depth:
+            return
+        for i in range(fanout):
+            child = os.path.join(parent, f"d{i}")
+            dirs.append(child)
+            add_children(child, level + 1)
+
+    add_children('', 0)
+    return dirs
+
+
+def random_file_size(rng, min_size, max_size):
+    if max_size <= min_size:
+        return min_size
+    return int(math.exp(rng.uniform(math.log(max(min_size, 1)), math.log(max_size))))
+
+
+# writes size bytes of random content, a chunk at a time
+def write_random_file(filename, size, rng):
+    with open(filename, 'wb') as file:
+        while size > 0:
+            chunk_size = min(size, 1024 * 1024)
+            file.write(rng.randbytes(chunk_size))
+            size -= chunk_size
+
+
+# about size bytes of lines of text, with STDOUT_MARKER on a line about half way through
+def stdout_content(size, rng):
+    line_count = max(size // STDOUT_LINE_LENGTH, 1)
+    letters = 'abcdefghijklmnopqrstuvwxyz '
+    lines = [''.join(rng.choices(letters, k=STDOUT_LINE_LENGTH - 1)) for _ in range(line_count)]
+    lines[line_count // 2] = STDOUT_MARKER.ljust(STDOUT_LINE_LENGTH - 1)
+
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def generate_tree(root_dir, shape, rng):
+    dirs = tree_dirs(shape.depth, shape.fanout)
+
+    for rel_dir in dirs:
+        os.makedirs(os.path.join(root_dir, rel_dir), exist_ok=True)
+
+    for i in range(shape.files):
+        filename = os.path.join(root_dir, rng.choice(dirs), f"file_{i}.bin")
+        write_random_file(filename, random_file_size(rng, shape.min_file_size, shape.max_file_size), rng)
+
+    for i in range(shape.large_files):
+        write_random_file(os.path.join(root_dir, f"large_{i}.bin"), shape.large_file_size, rng)
+
+
+# Writes a suite of the given shape to suite_dir, which shouldn't exist yet
+def generate_suite(suite_dir, shape):
+    rng = random.Random(shape.seed)
+
+    os.makedirs(suite_dir)
+
+    with open(os.path.join(suite_dir, 'global.yaml'), 'w') as file:
+        yaml.safe_dump({'definitions': {f"definition_{i}": f"value {i}" for i in range(shape.definitions)}}, file)
+
+    # the shape the suite was generated with, for the benchmark results
+    with open(os.path.join(suite_dir, 'suite_shape.yaml'), 'w') as file:
+        yaml.safe_dump(asdict(shape), file)
+
+    for test_index in range(shape.tests):
+        test_dir = os.path.join(suite_dir, f"test_{test_index:04}")
+        input_dir = os.path.join(test_dir, 'input')
+
+        generate_tree(input_dir, shape, rng)
+
+        stdout = stdout_content(shape.stdout_size, rng)
+        with open(os.path.join(input_dir, STDOUT_SOURCE_FILE), 'wb') as file:
+            file.write(stdout)
+        with open(os.path.join(test_dir, 'stdout.txt'), 'wb') as file:
+            file.write(stdout)
+
+        # output/ is what working/ will be: the same as input/
+        shutil.copytree(input_dir, os.path.join(test_dir, 'output'))
+
+        with open(os.path.join(test_dir, 'config.yaml'), 'w') as file:
+            yaml.safe_dump({'command': f"cat {STDOUT_SOURCE_FILE}",
+                            'test_description': f"Generated test {test_index}" +
+                                                (f" {{definition_{test_index % shape.definitions}}}"
+                                                 if shape.definitions else '')}, file)
+
+
+def load_suite_shape(suite_dir):
+    try:
+        with open(os.path.join(suite_dir, 'suite_shape.yaml'), 'r') as file:
+            return yaml.safe_load(file)
+    except IOError:
+        return None
@@ -0,0 +1,16 @@
+from self_benchmark.self_benchmark import run_self_benchmark
+
+
+def test_self_benchmark_times_each_hot_path(tmp_path):
+    from self_benchmark.suite_generator import SuiteShape, generate_suite
+
+    generate_suite(tmp_path / 'suite', SuiteShape(tests=2, files=5, depth=1, fanout=2, max_file_size=4096,
+                                                  stdout_size=2000, definitions=3))
+
+    results = run_self_benchmark(tmp_path / 'suite', repeat=1)
+
+    assert set(results['benchmarks']) == {'compare_folders', 'compare_files_f_exact', 'compare_files_f_fast_sampling',
+                                          'materialize', 'trim_stdout', 'stdout_filters', 'compile_plan', 'compile_plan_cached',
+                                          'run_suite', 'cli_startup'}
+    assert results['suite_shape']['tests'] == 2
+    assert results['benchmarks']['run_suite']['runs'] == 1
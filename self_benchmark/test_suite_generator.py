@@ -0,0 +1,14 @@
+from self_benchmark.suite_generator import STDOUT_SOURCE_FILE, SuiteShape, generate_suite
+
+
+def test_generated_suite_is_repeatable(tmp_path):
+    shape = SuiteShape(tests=2, files=5, depth=1, fanout=2, max_file_size=1024, stdout_size=1000)
+
+    generate_suite(tmp_path / 'a', shape)
+    generate_suite(tmp_path / 'b', shape)
+
+    for test_dir in ['test_0000', 'test_0001']:
+        for rel_path in ['stdout.txt', f'input/{STDOUT_SOURCE_FILE}']:
+            assert (tmp_path / 'a' / test_dir / rel_path).read_bytes() == (tmp_path / 'b' / test_dir / rel_path).read_bytes()
+
+    assert len(list((tmp_path / 'a' / 'test_0000' / 'output').rglob('*.bin'))) == 5
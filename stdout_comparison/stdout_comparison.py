@@ -0,0 +1,208 @@
+import os
+import time
+
+from dir_comparison.dir_comparison import first_difference_index
+
+# stdout is read from the command, and compared, in chunks of this size -- so memory use doesn't depend on
+# how much a command outputs.
+STDOUT_CHUNK_SIZE = 64 * 1024
+
+
+class SkipUntilAfterLineContaining:
+    """
+    For ignore_stdout_until_after_line_containing: drops everything up to and including the first line
+    containing text_match (given as bytes). Data can be fed in chunks split anywhere, even inside
+    the match:
+
+        >>> skipper = SkipUntilAfterLineContaining(b"START")
+        >>> skipper.feed(b"noise\\nmore ST") + skipper.feed(b"ART here\\nkept 1\\n") + skipper.feed(b"kept 2")
+        b'kept 1\\nkept 2'
+
+    Nothing is kept if the match is never found, or is on the last line:
+
+        >>> skipper = SkipUntilAfterLineContaining(b"START")
+        >>> skipper.feed(b"noise\\nmore noise\\nSTART")
+        b''
+    """
+
+    def __init__(self, text_match):
+        self.text_match = text_match
+        # True once we're past the end of the line containing the match
+        self.found = False
+        self.match_in_current_line = False
+        # the end of the current line, in case the match is split across two chunks
+        self.tail = b''
+
+    def feed(self, data):
+        if self.found:
+            return data
+
+        while data:
+            newline_index = data.find(b'\n')
+            line_part = data if newline_index == -1 else data[:newline_index]
+
+            if not self.match_in_current_line:
+                searched = self.tail + line_part
+                if self.text_match in searched:
+                    self.match_in_current_line = True
+                elif len(self.text_match) > 1:
+                    self.tail = searched[-(len(self.text_match) - 1):]
+
+            if newline_index == -1:
+                return b''
+
+            data = data[newline_index + 1:]
+
+            if self.match_in_current_line:
+                self.found = True
+                return data
+
+            self.tail = b''
+
+        return b''
+
+
+# Compares stdout, as it's fed in, with the expected content in expected_file (an open binary file).
+# Only one chunk of each is held in memory. Records the byte offset and line of the first difference.
+# If there is a difference and spill_filename is given, the actual stdout is written to that file
+# (the part before the difference is copied from expected_file, as it's the same).
+class StdoutComparison:
+    def __init__(self, expected_file, spill_filename=None):
+        self.expected_file = expected_file
+        self.spill_filename = spill_filename
+        self.spill_file = None
+        # how much stdout has been fed in, and the (1-based) line number we're on
+        self.offset = 0
+        self.line = 1
+        self.mismatch_offset = None
+        self.mismatch_line = None
+
+    @property
+    def matched(self):
+        return self.mismatch_offset is None
+
+    def feed(self, data):
+        if not data:
+            return
+
+        if self.matched:
+            expected = self.expected_file.read(len(data))
+
+            if expected == data:
+                self.offset += len(data)
+                self.line += data.count(b'\n')
+                return
+
+            index = first_difference_index(data, expected)
+            self.mismatch_offset = self.offset + index
+            self.mismatch_line = self.line + data.count(b'\n', 0, index)
+            self.start_spill()
+
+        if self.spill_file:
+            self.spill_file.write(data)
+
+        self.offset += len(data)
+
+    def finish(self):
+        # expected content that's longer than stdout is a mismatch, at the end of stdout
+        if self.matched and self.expected_file.read(1):
+            self.mismatch_offset = self.offset
+            self.mismatch_line = self.line
+            self.start_spill()
+
+        if self.spill_file:
+            self.spill_file.close()
+            self.spill_file = None
+
+        self.expected_file.close()
+
+    # removes the spill file (e.g. when the test failed for another reason, so the stdout isn't of interest)
+    def discard(self):
+        if self.spill_filename and os.path.exists(self.spill_filename):
+            os.remove(self.spill_filename)
+
+    def start_spill(self):
+        if not self.spill_filename:
+            return
+
+        self.spill_file = open(self.spill_filename, 'wb')
+
+        # everything up to the current chunk matched, so take it from the expected content
+        self.expected_file.seek(0)
+        copy_bytes(self.expected_file, self.spill_file, self.offset)
+
+
+# copies count bytes from one open file to another, a chunk at a time
+def copy_bytes(from_file, to_file, count):
+    while count > 0:
+        data = from_file.read(min(count, STDOUT_CHUNK_SIZE))
+        if not data:
+            break
+        to_file.write(data)
+        count -= len(data)
+
+
+# Records stdout, as it's fed in, to filename. It's written to a temporary file until keep() is called.
+class StdoutRecording:
+    def __init__(self, filename):
+        self.filename = filename
+        self.recording_filename = f"{filename}.recording"
+        self.file = open(self.recording_filename, 'wb')
+
+    def feed(self, data):
+        self.file.write(data)
+
+    def finish(self):
+        self.file.close()
+
+    def keep(self):
+        os.replace(self.recording_filename, self.filename)
+
+    def discard(self):
+        if os.path.exists(self.recording_filename):
+            os.remove(self.recording_filename)
+
+
+# Takes a command's stdout chunk by chunk, optionally skips the start of it and filters the rest (with a
+# StdoutFilters, see stdout_filters.py), and passes it on to a sink (a StdoutComparison or StdoutRecording).
+# If sink is None, stdout is read and thrown away.
+class StdoutPipeline:
+    def __init__(self, sink=None, ignore_until_after_line_containing=None, encoding='utf-8', filters=None):
+        self.sink = sink
+        self.skipper = None
+        if ignore_until_after_line_containing:
+            self.skipper = SkipUntilAfterLineContaining(ignore_until_after_line_containing.encode(encoding))
+        self.filter_stream = filters.start() if filters else None
+        # total bytes of stdout read from the command
+        self.bytes_read = 0
+        # seconds spent trimming, filtering and comparing (or recording) stdout
+        self.time_spent = 0
+
+    def feed(self, chunk):
+        self.bytes_read += len(chunk)
+
+        if not self.sink:
+            return
+
+        start_time = time.perf_counter()
+
+        if self.skipper:
+            chunk = self.skipper.feed(chunk)
+        if self.filter_stream:
+            chunk = self.filter_stream.feed(chunk)
+
+        self.sink.feed(chunk)
+
+        self.time_spent += time.perf_counter() - start_time
+
+    def finish(self):
+        if self.sink:
+            start_time = time.perf_counter()
+            if self.filter_stream:
+                self.sink.feed(self.filter_stream.finish())
+            self.sink.finish()
+            self.time_spent += time.perf_counter() - start_time
+
+    def discard(self):
+        if self.sink:
+            self.sink.discard()
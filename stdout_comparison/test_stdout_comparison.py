@@ -0,0 +1,72 @@
+import io
+
+import pytest
+
+from stdout_comparison.stdout_comparison import STDOUT_CHUNK_SIZE, StdoutComparison, StdoutPipeline
+
+
+def compare(expected, chunks, spill_filename=None):
+    comparison = StdoutComparison(io.BytesIO(expected), spill_filename)
+    for chunk in chunks:
+        comparison.feed(chunk)
+    comparison.finish()
+
+    return comparison
+
+
+def in_chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 100])
+def test_first_difference_is_found_wherever_the_chunks_split(chunk_size):
+    comparison = compare(b"one\ntwo\nthree\n", in_chunks(b"one\ntwo\nthreX\n", chunk_size))
+
+    assert not comparison.matched
+    assert (comparison.mismatch_offset, comparison.mismatch_line) == (12, 3)
+
+
+@pytest.mark.parametrize('expected, actual, offset, line', [(b"one\ntwo\n", b"one\ntwo\n", None, None),
+                                                            (b"one\ntwo\n", b"one\n", 4, 2),
+                                                            (b"one\n", b"one\ntwo\n", 4, 2),
+                                                            (b"", b"one\n", 0, 1)])
+def test_stdout_shorter_or_longer_than_expected(expected, actual, offset, line):
+    comparison = compare(expected, [actual])
+
+    assert (comparison.mismatch_offset, comparison.mismatch_line) == (offset, line)
+
+
+def test_stdout_bigger_than_a_chunk_is_spilled_to_a_file_from_the_start(tmp_path):
+    expected = b''.join(b"line %d\n" % i for i in range(100000))
+    actual = bytearray(expected)
+    difference_offset = 3 * STDOUT_CHUNK_SIZE + 10
+    actual[difference_offset] = ord('X')
+    spill_filename = tmp_path / 'stdout_working.txt'
+
+    comparison = compare(expected, in_chunks(bytes(actual), STDOUT_CHUNK_SIZE), spill_filename)
+
+    assert comparison.mismatch_offset == difference_offset
+    assert comparison.mismatch_line == expected.count(b'\n', 0, difference_offset) + 1
+    assert spill_filename.read_bytes() == actual
+
+    comparison.discard()
+    assert not spill_filename.exists()
+
+
+def test_nothing_is_spilled_when_stdout_matches(tmp_path):
+    comparison = compare(b"same\n" * 50000, in_chunks(b"same\n" * 50000, STDOUT_CHUNK_SIZE), tmp_path / 'spill.txt')
+
+    assert comparison.matched and not (tmp_path / 'spill.txt').exists()
+
+
+@pytest.mark.parametrize('expected, matched', [(b"", True), (b"kept\n", False)])
+def test_all_stdout_is_ignored_if_the_marker_never_appears(expected, matched):
+    comparison = StdoutComparison(io.BytesIO(expected))
+    pipeline = StdoutPipeline(comparison, ignore_until_after_line_containing="START")
+
+    for chunk in [b"noise\nST", b"\nART is split by a newline\n", b"kept\n"]:
+        pipeline.feed(chunk)
+    pipeline.finish()
+
+    assert comparison.matched == matched
+    assert pipeline.bytes_read == 40
@@ -0,0 +1,270 @@
+import re
+
+# Filters normalize a command's stdout before it's compared with stdout.txt (or recorded), so output that changes from
+# run to run (times, PIDs, temp paths, lines in no particular order) can still be tested. They're given in the config
+# as stdout_filters, a list applied in order, each one of:
+#
+#   - replace: <regex>        replaces each match of the regex in a line with the text given as with (default
+#     with: <text>            nothing). The text can refer to groups in the regex, e.g. \1
+#   - mask: <regex>           replaces each match of the regex in a line with MASK_TEXT
+#   - drop_before: <text>     drops the lines before the first line containing the text
+#   - drop_after: <text>      drops the lines after the first line containing the text
+#   - strip_trailing_whitespace     strips whitespace (including '\r') from the end of each line
+#   - sort_between: [<start text>, <end text>]    sorts the lines between a line containing the start text and the
+#                                                 next line containing the end text (or the end of stdout)
+#
+# A list of filters is compiled once (see StdoutFilters), and applied to stdout as it's read (see StdoutFilterStream),
+# a chunk of whole lines at a time. Only the lines being sorted are held in memory beyond the current chunk.
+
+MASK_TEXT = '<masked>'
+
+FILTER_REPLACE = 'replace'
+FILTER_MASK = 'mask'
+FILTER_DROP_BEFORE = 'drop_before'
+FILTER_DROP_AFTER = 'drop_after'
+FILTER_STRIP_TRAILING_WHITESPACE = 'strip_trailing_whitespace'
+FILTER_SORT_BETWEEN = 'sort_between'
+
+FILTER_NAMES = [FILTER_REPLACE, FILTER_MASK, FILTER_DROP_BEFORE, FILTER_DROP_AFTER, FILTER_STRIP_TRAILING_WHITESPACE,
+                FILTER_SORT_BETWEEN]
+
+# the key for the replacement text of a replace filter
+REPLACE_WITH_KEY = 'with'
+
+
+# Each filter takes a list of lines (as bytes, without their newlines) and returns the lines to pass on. finish()
+# returns any lines held back, at the end of stdout. A filter keeps the state of one run through stdout.
+
+class ReplaceFilter:
+    def __init__(self, pattern, replacement):
+        self.pattern = pattern
+        self.replacement = replacement
+
+    def lines(self, lines):
+        sub = self.pattern.sub
+        return [sub(self.replacement, line) for line in lines]
+
+    def finish(self):
+        return []
+
+
+class StripTrailingWhitespaceFilter:
+    def lines(self, lines):
+        return [line.rstrip() for line in lines]
+
+    def finish(self):
+        return []
+
+
+class DropBeforeFilter:
+    def __init__(self, marker):
+        self.marker = marker
+        self.found = False
+
+    def lines(self, lines):
+        if self.found:
+            return lines
+
+        for index, line in enumerate(lines):
+            if self.marker in line:
+                self.found = True
+                return lines[index:]
+
+        return []
+
+    def finish(self):
+        return []
+
+
+class DropAfterFilter:
+    def __init__(self, marker):
+        self.marker = marker
+        self.found = False
+
+    def lines(self, lines):
+        if self.found:
+            return []
+
+        for index, line in enumerate(lines):
+            if self.marker in line:
+                self.found = True
+                return lines[:index + 1]
+
+        return lines
+
+    def finish(self):
+        return []
+
+
+class SortBetweenFilter:
+    def __init__(self, start_marker, end_marker):
+        self.start_marker = start_marker
+        self.end_marker = end_marker
+        # the lines of the block being sorted, or None if we're not in one
+        self.block = None
+
+    def lines(self, lines):
+        output = []
+
+        for line in lines:
+            if self.block is None:
+                output.append(line)
+                if self.start_marker in line:
+                    self.block = []
+            elif self.end_marker in line:
+                output += sorted(self.block)
+                output.append(line)
+                self.block = None
+            else:
+                self.block.append(line)
+
+        return output
+
+    def finish(self):
+        block, self.block = self.block, None
+        return sorted(block) if block else []
+
+
+def text_value(name, value, encoding):
+    if not isinstance(value, str) or not value:
+        raise ValueError(f"{name} must be given some text (not {value!r})")
+
+    return value.encode(encoding)
+
+
+def regex_value(name, value, encoding):
+    try:
+        return re.compile(text_value(name, value, encoding))
+    except re.error as error:
+        raise ValueError(f"{name} must be a regular expression ({error})")
+
+
+# the filter class for a filter as given in the config, and the arguments to make it with. Raises ValueError if the
+# filter isn't valid.
+def compile_filter(spec, encoding):
+    if spec == FILTER_STRIP_TRAILING_WHITESPACE:
+        return StripTrailingWhitespaceFilter, ()
+
+    # a single key, naming the filter, apart from a replace filter's replacement
+    names = [key for key in spec if key != REPLACE_WITH_KEY] if isinstance(spec, dict) else []
+    if len(names) != 1 or names[0] not in FILTER_NAMES or (REPLACE_WITH_KEY in spec and names[0] != FILTER_REPLACE):
+        raise ValueError(f"each of stdout_filters must be one of {FILTER_NAMES} (not {spec!r})")
+
+    name = names[0]
+    value = spec[name]
+
+    if name == FILTER_REPLACE:
+        pattern = regex_value(name, value, encoding)
+        replacement = str(spec.get(REPLACE_WITH_KEY) or '').encode(encoding)
+        try:
+            # checks the group references in the replacement
+            pattern.sub(replacement, b'')
+        except (re.error, IndexError) as error:
+            raise ValueError(f"{REPLACE_WITH_KEY} isn't a valid replacement for {value!r} ({error})")
+        return ReplaceFilter, (pattern, replacement)
+    if name == FILTER_MASK:
+        return ReplaceFilter, (regex_value(name, value, encoding), MASK_TEXT.encode(encoding))
+    if name == FILTER_DROP_BEFORE:
+        return DropBeforeFilter, (text_value(name, value, encoding),)
+    if name == FILTER_DROP_AFTER:
+        return DropAfterFilter, (text_value(name, value, encoding),)
+    if name == FILTER_STRIP_TRAILING_WHITESPACE:
+        return StripTrailingWhitespaceFilter, ()
+
+    if not isinstance(value, list) or len(value) != 2:
+        raise ValueError(f"{name} must be given [start text, end text] (not {value!r})")
+    return SortBetweenFilter, (text_value(name, value[0], encoding), text_value(name, value[1], encoding))
+
+
+class StdoutFilters:
+    """
+    A list of filters, as given in the config, compiled. Raises ValueError if any of them aren't valid.
+    Each run through stdout is a StdoutFilterStream, from start():
+
+        >>> filters = StdoutFilters([{'mask': 'pid [0-9]+'}, 'strip_trailing_whitespace'])
+        >>> stream = filters.start()
+        >>> stream.feed(b"started pid 12  \\r\\nlast li") + stream.feed(b"ne \\n") + stream.finish()
+        b'started <masked>\\nlast line\\n'
+    """
+
+    def __init__(self, specs, encoding='utf-8'):
+        if not isinstance(specs, list):
+            raise ValueError(f"stdout_filters must be a list of filters (not {specs!r})")
+
+        self.filters = [compile_filter(spec, encoding) for spec in specs]
+
+    def __bool__(self):
+        return bool(self.filters)
+
+    def start(self):
+        return StdoutFilterStream([filter_class(*args) for filter_class, args in self.filters])
+
+
+class StdoutFilterStream:
+    """
+    Applies filters to stdout as it's fed in, a chunk at a time. Chunks can be split anywhere, even inside a line:
+    each filter sees whole lines. Each line output ends with a newline, apart from stdout's last line if it doesn't
+    have one, so whether dropped lines ended with a newline makes no difference:
+
+        >>> stream = StdoutFilters([{'sort_between': ['BEGIN', 'END']}, {'drop_after': 'END'}]).start()
+        >>> stream.feed(b"BEGIN\\nc\\na\\n") + stream.feed(b"b\\nEND\\nnoise") + stream.finish()
+        b'BEGIN\\na\\nb\\nc\\nEND\\n'
+        >>> stream = StdoutFilters([{'mask': '[0-9]+'}]).start()
+        >>> stream.feed(b"took 12s\\nexit 0") + stream.finish()
+        b'took <masked>s\\nexit <masked>'
+    """
+
+    def __init__(self, filters):
+        self.filters = filters
+        # the start of a line whose end hasn't been fed in yet
+        self.partial_line = b''
+        # True once a line has been output, so the next one needs a newline before it
+        self.output_started = False
+
+    def feed(self, data):
+        if not data:
+            return b''
+
+        data = self.partial_line + data
+
+        end = data.rfind(b'\n')
+        if end == -1:
+            self.partial_line = data
+            return b''
+
+        self.partial_line = data[end + 1:]
+        return self.output(self.apply(data[:end].split(b'\n')))
+
+    # returns what's left of stdout, once it's all been fed in
+    def finish(self):
+        # stdout's last line, if it has no newline, goes through the filters before any lines they've held back are
+        # let out (as it would with them), so it's known whether it's the last line output
+        last_lines = self.apply([self.partial_line]) if self.partial_line else []
+        held_lines = self.apply([], finishing=True)
+        output = self.output(last_lines) + self.output(held_lines)
+
+        # the newline after the last line output, unless it's stdout's last line, without one
+        if self.output_started and (held_lines or not last_lines):
+            output += b'\n'
+
+        return output
+
+    def apply(self, lines, finishing=False):
+        for stdout_filter in self.filters:
+            lines = stdout_filter.lines(lines)
+            if finishing:
+                lines += stdout_filter.finish()
+
+        return lines
+
+    # newlines go between lines, so a newline can be left off the last line if stdout doesn't end with one
+    def output(self, lines):
+        if not lines:
+            return b''
+
+        text = b'\n'.join(lines)
+        if self.output_started:
+            text = b'\n' + text
+        self.output_started = True
+
+        return text
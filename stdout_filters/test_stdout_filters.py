@@ -0,0 +1,52 @@
+import pytest
+
+from stdout_filters.stdout_filters import StdoutFilters
+
+
+def filter_stdout(specs, stdout, chunk_size=None):
+    stream = StdoutFilters(specs).start()
+    chunk_size = chunk_size or max(len(stdout), 1)
+
+    output = b''.join(stream.feed(stdout[i:i + chunk_size]) for i in range(0, len(stdout), chunk_size))
+    return output + stream.finish()
+
+
+STDOUT = b"header\nSTART 12:30:01\nb  \na\t\nc\nEND\npid 4242 done\nfooter"
+
+FILTERS = [{'drop_before': 'START'}, {'drop_after': 'done'}, {'replace': r'(\d+):\d+:\d+', 'with': r'\1:MM:SS'},
+           {'mask': r'pid \d+'}, 'strip_trailing_whitespace', {'sort_between': ['START', 'END']}]
+
+
+def test_filters_are_applied_in_order():
+    assert filter_stdout(FILTERS, STDOUT) == b"START 12:MM:SS\na\nb\nc\nEND\n<masked> done\n"
+
+
+def test_output_is_the_same_however_stdout_is_split():
+    expected = filter_stdout(FILTERS, STDOUT)
+
+    for chunk_size in [1, 2, 3, 7, 16]:
+        assert filter_stdout(FILTERS, STDOUT, chunk_size) == expected
+
+
+@pytest.mark.parametrize('chunk_size', [None, 1])
+def test_a_newline_at_the_end_of_dropped_lines_makes_no_difference(chunk_size):
+    assert filter_stdout([{'drop_after': 'a'}], b"a\nnoise", chunk_size) == \
+           filter_stdout([{'drop_after': 'a'}], b"a\nnoise\n", chunk_size) == b"a\n"
+
+
+@pytest.mark.parametrize('stdout', [b'', b'\n', b'a', b'a\n', b'a\n\nb\n\n'])
+def test_filters_that_change_nothing_leave_stdout_as_it_is(stdout):
+    assert filter_stdout([{'mask': 'no match'}], stdout) == stdout
+    assert filter_stdout([{'mask': 'no match'}], stdout, chunk_size=1) == stdout
+
+
+def test_a_block_without_an_end_is_sorted_at_the_end_of_stdout():
+    assert filter_stdout([{'sort_between': ['[', ']']}], b"[\nb\na\n") == b"[\na\nb\n"
+
+
+@pytest.mark.parametrize('specs', ['mask', ['unknown_filter'], [{'mask': '('}], [{'drop_before': ''}],
+                                   [{'sort_between': 'START'}], [{'mask': 'a', 'with': 'b'}],
+                                   [{'replace': '(a)', 'with': r'\2'}]])
+def test_invalid_filters_raise_value_error(specs):
+    with pytest.raises(ValueError):
+        StdoutFilters(specs)
@@ -0,0 +1,218 @@
+import os
+import shutil
+import stat
+
+from dir_comparison.dir_comparison import compare_files_exact_f
+from dir_comparison.manifest import ENTRY_TYPE_DIR, ENTRY_TYPE_FILE, MANIFEST_VERSION
+from materialization.materialization import MaterializeStats
+
+# A suite archive is a whole test suite packed into a single zip file, which BBT can run without unpacking it.
+# A zip's central directory lists every member with its size and where it is in the file, so BBT reads just what
+# it needs, straight from the archive: global.yaml, and each test's config.yaml and stdout.txt (streamed as it's
+# compared with the command's stdout). A test's input/ is only extracted, into its working/ dir, when the test runs,
+# and working/ is compared with the output/ members as they're read, without extracting them.
+#
+# Members are named by their path in the suite dir, e.g. test_a/input/data.txt. Dirs have members of their own, so
+# empty dirs are kept, and each member keeps its file's mode.
+#
+# Paths in an archive are given as if the archive were the suite dir, e.g. <archive>/test_a/config.yaml, so the
+# code running a test can treat an archive like a dir.
+#
+# An archive BBT didn't make could have members named to be extracted outside the dir they're extracted into (e.g.
+# ../x, or /x), or links to files outside it. Such an archive isn't opened at all.
+
+# modes for members of archives made without them (e.g. on Windows)
+DEFAULT_FILE_MODE = 0o644
+DEFAULT_DIR_MODE = 0o755
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def is_safe_member_path(path):
+    """
+    True if the member path (or link target, relative to the link's dir) stays inside the dir it's extracted into:
+
+        >>> [is_safe_member_path(path) for path in ['test_a/input/x', 'test_a/../test_b/x', '../x', 'a/../../x', '/x']]
+        [True, True, False, False, False]
+    """
+    path = os.path.normpath(path)
+    return not os.path.isabs(path) and path != '..' and not path.startswith('..' + os.sep)
+
+
+# zipfile is imported where it's used, as it's slow to import, and most suites aren't archives
+def is_suite_archive(path):
+    if not os.path.isfile(path):
+        return False
+
+    import zipfile
+    return zipfile.is_zipfile(path)
+
+
+class SuiteArchive:
+    # Raises ValueError if any member could be extracted outside the dir it's extracted into (see is_safe_member_path)
+    def __init__(self, filename):
+        import zipfile
+
+        self.filename = os.path.abspath(filename)
+        # the zip file can be read by many threads at once: each open member keeps its own place in the file
+        self.zip_file = zipfile.ZipFile(self.filename)
+        self.members = {}
+        self.dirs = {''}
+
+        for info in self.zip_file.infolist():
+            path = info.filename.rstrip('/')
+            self.check_member(info, path)
+            self.members[path] = info
+            if info.is_dir():
+                self.dirs.add(path)
+
+            # a member's parent dirs don't have to have members of their own
+            while path := os.path.dirname(path):
+                self.dirs.add(path)
+
+    def close(self):
+        self.zip_file.close()
+
+    def check_member(self, info, path):
+        if not is_safe_member_path(path):
+            self.close()
+            raise ValueError(f"{self.filename} has a member outside the suite dir: {info.filename}")
+
+        # a link's target is its content
+        if stat.S_ISLNK(info.external_attr >> 16):
+            target = self.zip_file.read(info).decode('utf-8', errors='replace')
+            if not is_safe_member_path(os.path.join(os.path.dirname(path), target)):
+                self.close()
+                raise ValueError(f"{self.filename} has a link to outside the suite dir: {info.filename} -> {target}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # the name in the archive for a path in it, e.g. <archive>/test_a/config.yaml -> test_a/config.yaml
+    def member_path(self, path):
+        rel_path = os.path.relpath(path, self.filename)
+        return '' if rel_path == '.' else rel_path
+
+    def exists(self, path):
+        member_path = self.member_path(path)
+        return member_path in self.members or member_path in self.dirs
+
+    def isdir(self, path):
+        return self.member_path(path) in self.dirs
+
+    # the names of the dirs in the dir at path
+    def list_dirs(self, path):
+        member_path = self.member_path(path)
+        return sorted(os.path.basename(dir_path) for dir_path in self.dirs
+                      if dir_path and os.path.dirname(dir_path) == member_path)
+
+    # opens the file at path, for reading as bytes
+    def open(self, path):
+        info = self.members.get(self.member_path(path))
+        if info is None or info.is_dir():
+            raise FileNotFoundError(f"No file {self.member_path(path)} in {self.filename}")
+
+        return self.zip_file.open(info)
+
+    def mode(self, info):
+        mode = stat.S_IMODE(info.external_attr >> 16)
+        return mode or (DEFAULT_DIR_MODE if info.is_dir() else DEFAULT_FILE_MODE)
+
+    # A manifest of the tree at path (see manifest.py), with no hashes: the archive has no hashes of its members.
+    # Files can be compared with those in a folder with file_comparison().
+    def tree_manifest(self, path):
+        member_path = self.member_path(path)
+        prefix = f"{member_path}/" if member_path else ''
+        entries = {}
+
+        for dir_path in self.dirs:
+            if dir_path and dir_path.startswith(prefix):
+                info = self.members.get(dir_path)
+                entries[dir_path[len(prefix):]] = {'type': ENTRY_TYPE_DIR,
+                                                   'mode': self.mode(info) if info else DEFAULT_DIR_MODE}
+
+        for member_path, info in self.members.items():
+            if member_path.startswith(prefix) and not info.is_dir():
+                entries[member_path[len(prefix):]] = {'type': ENTRY_TYPE_FILE, 'size': info.file_size,
+                                                      'mode': self.mode(info)}
+
+        return {'version': MANIFEST_VERSION, 'entries': entries}
+
+    # For compare_folder_to_manifest with a manifest from tree_manifest(path): compares a file with its member in
+    # the tree, a chunk at a time, stopping at the first difference
+    def file_comparison(self, path):
+        def compare_file(filename, rel_path, file1, file2):
+            with open(filename, 'rb') as f1, self.open(os.path.join(path, rel_path)) as f2:
+                return compare_files_exact_f(file1, file2, f1, f2)
+
+        return compare_file
+
+    # Extracts the tree at path to dst_dir, which shouldn't exist yet, keeping the modes of its files and dirs
+    def extract_tree(self, path, dst_dir, stats=None):
+        if stats is None:
+            stats = MaterializeStats()
+
+        manifest = self.tree_manifest(path)
+        os.makedirs(dst_dir)
+
+        # sorted, so a dir comes before what's in it
+        for rel_path, entry in sorted(manifest['entries'].items()):
+            # members are checked when the archive is opened, but this is what would be written outside dst_dir
+            if not is_safe_member_path(rel_path):
+                raise ValueError(f"Won't extract {rel_path}, as it's outside {dst_dir}")
+            dst = os.path.join(dst_dir, rel_path)
+
+            if entry['type'] == ENTRY_TYPE_DIR:
+                os.mkdir(dst)
+                continue
+
+            with self.open(os.path.join(path, rel_path)) as member_file, open(dst, 'wb') as dst_file:
+                shutil.copyfileobj(member_file, dst_file, COPY_CHUNK_SIZE)
+            os.chmod(dst, entry['mode'])
+
+            stats.files_copied += 1
+            stats.bytes_copied += entry['size']
+
+        # dirs last, as a read-only dir couldn't be filled
+        for rel_path, entry in manifest['entries'].items():
+            if entry['type'] == ENTRY_TYPE_DIR:
+                os.chmod(os.path.join(dst_dir, rel_path), entry['mode'])
+
+        return stats
+
+
+# Packs the suite in suite_dir into a new archive. Deflated unless compress is False: a stored archive is bigger, but
+# its members are quicker to read. Returns the number of files packed.
+def pack_suite(suite_dir, archive_filename, compress=True):
+    import zipfile
+
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    file_count = 0
+
+    # files older than 1980 (which zip can't record) are given 1980 as their time
+    with zipfile.ZipFile(archive_filename, 'w', compression, strict_timestamps=False) as zip_file:
+        for dir_path, dir_names, file_names in os.walk(suite_dir):
+            dir_names.sort()
+
+            rel_dir = os.path.relpath(dir_path, suite_dir)
+            if rel_dir != '.':
+                zip_file.write(dir_path, rel_dir)
+
+            for file_name in sorted(file_names):
+                path = os.path.join(dir_path, file_name)
+                if os.path.abspath(path) == os.path.abspath(archive_filename):
+                    continue
+
+                zip_file.write(path, os.path.relpath(path, suite_dir))
+                file_count += 1
+
+    return file_count
+
+
+# Unpacks the archive into the suite dir dst_dir, which shouldn't exist yet
+def unpack_suite(archive_filename, dst_dir):
+    with SuiteArchive(archive_filename) as archive:
+        return archive.extract_tree(archive.filename, dst_dir)
@@ -0,0 +1,73 @@
+import os
+import stat
+import zipfile
+
+import pytest
+
+from dir_comparison.manifest import ENTRY_TYPE_FILE
+from suite_archive.suite_archive import SuiteArchive, pack_suite, unpack_suite
+
+
+def make_suite(suite_dir):
+    (suite_dir / 'test_a' / 'input' / 'empty_dir').mkdir(parents=True)
+    (suite_dir / 'test_a' / 'input' / 'run.sh').write_text("echo hi")
+    (suite_dir / 'test_a' / 'input' / 'run.sh').chmod(0o755)
+    (suite_dir / 'test_a' / 'output' / 'sub').mkdir(parents=True)
+    (suite_dir / 'test_a' / 'output' / 'sub' / 'result.txt').write_text("result")
+    (suite_dir / 'test_a' / 'config.yaml').write_text("command: sh run.sh\n")
+    (suite_dir / 'global.yaml').write_text("definitions: {}\n")
+
+
+def test_archive_reads_like_the_suite_dir(tmp_path):
+    make_suite(tmp_path / 'suite')
+    pack_suite(tmp_path / 'suite', tmp_path / 'suite.zip')
+
+    with SuiteArchive(tmp_path / 'suite.zip') as archive:
+        root = archive.filename
+
+        assert archive.list_dirs(root) == ['test_a']
+        assert archive.isdir(os.path.join(root, 'test_a', 'input', 'empty_dir'))
+        assert not archive.exists(os.path.join(root, 'test_a', 'stdout.txt'))
+        with archive.open(os.path.join(root, 'test_a', 'config.yaml')) as file:
+            assert file.read() == b"command: sh run.sh\n"
+
+        archive.extract_tree(os.path.join(root, 'test_a', 'input'), tmp_path / 'working')
+        assert (tmp_path / 'working' / 'empty_dir').is_dir()
+        assert stat.S_IMODE((tmp_path / 'working' / 'run.sh').stat().st_mode) == 0o755
+
+        manifest = archive.tree_manifest(os.path.join(root, 'test_a', 'output'))
+        assert manifest['entries']['sub/result.txt'] == {'type': ENTRY_TYPE_FILE, 'size': 6, 'mode': 0o644}
+
+        compare_file = archive.file_comparison(os.path.join(root, 'test_a', 'output'))
+        (tmp_path / 'result.txt').write_text("resulT")
+        assert compare_file(tmp_path / 'result.txt', 'sub/result.txt', 'A', 'B') == "* Content differs at byte 5: A != B"
+
+
+def test_unpacked_suite_is_the_same_as_the_packed_one(tmp_path):
+    from dir_comparison.dir_comparison import compare_folders
+
+    make_suite(tmp_path / 'suite')
+    pack_suite(tmp_path / 'suite', tmp_path / 'suite.zip', compress=False)
+    unpack_suite(tmp_path / 'suite.zip', tmp_path / 'unpacked')
+
+    differences = []
+    compare_folders(tmp_path / 'suite', tmp_path / 'unpacked', differences)
+    assert differences == []
+
+
+@pytest.mark.parametrize('member_name, link_target', [('../escaped.txt', None), ('/tmp/escaped.txt', None),
+                                                      ('test_a/input/../../../escaped.txt', None),
+                                                      ('test_a/input/link', '../../../escaped.txt'),
+                                                      ('test_a/input/link', '/etc/passwd')])
+def test_archive_with_members_outside_the_suite_isnt_extracted(tmp_path, member_name, link_target):
+    with zipfile.ZipFile(tmp_path / 'suite.zip', 'w') as zip_file:
+        zip_file.writestr('test_a/config.yaml', "command: echo hi\n")
+        info = zipfile.ZipInfo(member_name)
+        if link_target:
+            info.external_attr = (stat.S_IFLNK | 0o777) << 16
+        zip_file.writestr(info, link_target or "escaped")
+
+    with pytest.raises(ValueError, match="outside the suite dir"):
+        unpack_suite(tmp_path / 'suite.zip', tmp_path / 'unpacked' / 'suite')
+
+    assert not (tmp_path / 'unpacked').exists() and not (tmp_path / 'escaped.txt').exists()
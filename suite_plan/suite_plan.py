@@ -0,0 +1,133 @@
+import json
+import os
+import re
+
+# A suite's plan is what its global.yaml and each test's config.yaml say, worked out once before any test is run:
+# each config loaded, with global.yaml's values for anything it doesn't give, definitions substituted, and checked.
+# Running a test then only reads its plan.
+#
+# The plans of a suite's tests are cached between runs, in a JSON file in the suite's cache dir. A test's plan is
+# used again if its stamp (e.g. the size, mtime and inode of its config.yaml, and which of input/, output/ and
+# stdout.txt it has) is the same as when it was cached, and global.yaml's is too.
+
+PLAN_CACHE_VERSION = 1
+
+# a reference to a definition in a value, e.g. {output_dir}
+DEFINITION_REFERENCE_PATTERN = re.compile(r'\{([^{}]*)\}')
+
+
+# yaml is imported here, as it's slow to import. libyaml's loader is used where PyYAML has it, as it's much faster.
+# Raises ValueError if the file isn't valid YAML.
+def load_yaml(file):
+    import yaml
+
+    try:
+        return yaml.load(file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+    except yaml.YAMLError as error:
+        raise ValueError(f"Not valid YAML: {error}") from error
+
+
+class Definitions:
+    """
+    Substitutes definitions (a dict of name to text) for references to them in values: {name} in a string, or in a
+    string in a list. Each value is scanned once, whatever the number of definitions, and text substituted for a
+    reference isn't scanned again. References to names that aren't defined are left as they are.
+
+        >>> definitions = Definitions({'tool': 'bin/tool', 'mode': 'fast'})
+        >>> definitions.substitute('{tool} --{mode} {WORKING_PATH}')
+        'bin/tool --fast {WORKING_PATH}'
+        >>> definitions.substitute(['{tool}', 3])
+        ['bin/tool', 3]
+    """
+
+    def __init__(self, definitions):
+        self.definitions = {str(name): '' if text is None else str(text) for name, text in (definitions or {}).items()}
+
+    def replacement(self, match):
+        return self.definitions.get(match.group(1), match.group(0))
+
+    def substitute(self, value):
+        if not self.definitions:
+            return value
+
+        if isinstance(value, str):
+            return DEFINITION_REFERENCE_PATTERN.sub(self.replacement, value) if '{' in value else value
+        if isinstance(value, list):
+            return [self.substitute(v) if isinstance(v, str) else v for v in value]
+
+        return value
+
+
+def resolve_config(config, global_config, definitions, ignore_keys=()):
+    """
+    The values a test sees: for each key in config or global_config (other than ignore_keys), its value in config,
+    or in global_config if config doesn't give it (or gives an empty value), with definitions substituted.
+
+        >>> resolve_config({'command': 'echo {text}', 'tags': []}, {'tags': ['slow'], 'definitions': {}},
+        ...                Definitions({'text': 'hello'}), ignore_keys=['definitions'])
+        {'command': 'echo hello', 'tags': ['slow']}
+    """
+    values = {}
+
+    for key in [*config, *(key for key in global_config if key not in config)]:
+        if key not in ignore_keys:
+            values[key] = definitions.substitute(config.get(key) or global_config.get(key))
+
+    return values
+
+
+# The stamp of a file or dir, or None if there isn't one: if it's the same later on, the file hasn't been changed
+# (or for a dir, nothing has been added to or removed from it)
+def path_stamp(path):
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        return None
+
+    return [stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino]
+
+
+class PlanCache:
+    # global_stamp is that of the files every test's plan depends on (e.g. global.yaml): if it's changed since the
+    # cache was saved, none of the cached plans are used
+    def __init__(self, filename, global_stamp):
+        self.filename = filename
+        self.global_stamp = global_stamp
+        # test name -> {stamp, plan}
+        self.tests = {}
+        self.changed = False
+
+        try:
+            with open(filename, 'r') as file:
+                cache = json.load(file)
+        except (IOError, ValueError):
+            return
+
+        if cache.get('version') == PLAN_CACHE_VERSION and cache.get('global_stamp') == global_stamp:
+            self.tests = cache['tests']
+
+    # the plan cached for the test, or None if there isn't one or the test's stamp has changed since
+    def plan(self, test_name, stamp):
+        entry = self.tests.get(test_name)
+        return entry['plan'] if entry and entry['stamp'] == stamp else None
+
+    def add(self, test_name, stamp, plan):
+        self.tests[test_name] = {'stamp': stamp, 'plan': plan}
+        self.changed = True
+
+    # Only saved if a plan has been added. Values JSON can't hold (e.g. dates) are saved as strings, as they would
+    # be printed. It's only a cache, so if it can't be saved, it isn't.
+    def save(self):
+        if not self.changed:
+            return
+
+        # write then rename, so a reader never sees a half written cache (as save_manifest)
+        temp_filename = f"{self.filename}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            with open(temp_filename, 'w') as file:
+                json.dump({'version': PLAN_CACHE_VERSION, 'global_stamp': self.global_stamp, 'tests': self.tests},
+                          file, default=str)
+            os.replace(temp_filename, self.filename)
+        except OSError:
+            pass
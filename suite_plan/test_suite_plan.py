@@ -0,0 +1,41 @@
+import io
+
+import pytest
+
+from suite_plan.suite_plan import Definitions, PlanCache, load_yaml, path_stamp
+
+
+def test_definitions_are_substituted_in_a_single_pass():
+    definitions = Definitions({'a': '{b}', 'b': 'text', 'n': 5})
+
+    assert definitions.substitute('{a} {b} {n} {c} {{b}}') == '{b} text 5 {c} {text}'
+    assert definitions.substitute({'a': '{a}'}) == {'a': '{a}'}
+
+
+def test_many_definitions():
+    definitions = Definitions({f"name_{i}": f"value_{i}" for i in range(10000)})
+
+    assert definitions.substitute('{name_0} {name_9999}') == 'value_0 value_9999'
+
+
+def test_load_yaml_raises_value_error_for_invalid_yaml():
+    assert load_yaml(io.StringIO("command: echo\n")) == {'command': 'echo'}
+
+    with pytest.raises(ValueError):
+        load_yaml(io.StringIO("command: [echo\n"))
+
+
+def test_plan_cache_only_has_plans_for_the_same_stamps(tmp_path):
+    config_file = tmp_path / 'config.yaml'
+    config_file.write_text("command: echo\n")
+    stamp = path_stamp(config_file)
+
+    plan_cache = PlanCache(tmp_path / 'cache' / 'plan.json', 'global stamp')
+    plan_cache.add('test_a', stamp, {'command': 'echo'})
+    plan_cache.save()
+
+    assert PlanCache(tmp_path / 'cache' / 'plan.json', 'global stamp').plan('test_a', stamp) == {'command': 'echo'}
+    assert PlanCache(tmp_path / 'cache' / 'plan.json', 'global changed').plan('test_a', stamp) is None
+
+    config_file.write_text("command: echo changed\n")
+    assert PlanCache(tmp_path / 'cache' / 'plan.json', 'global stamp').plan('test_a', path_stamp(config_file)) is None
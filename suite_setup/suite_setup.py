@@ -0,0 +1,84 @@
+import os
+import shutil
+import subprocess
+
+from result_cache.result_cache import ResultCache, fingerprint
+
+# A suite's setup command runs once, before its tests, to do the work the tests share (e.g. building the tool being
+# tested). It can write files to a shared dir, which a test's command can refer to as {SHARED_PATH}. The teardown
+# command runs once, after the tests.
+#
+# The shared dir is kept between runs, in the cache dir, keyed by the setup command and the contents of the setup's
+# declared input files. If none of them have changed since the setup last succeeded, the setup isn't run again.
+# Without declared inputs, the setup runs every time, as BBT can't tell what it depends on.
+
+# in the cache dir: a dir for each shared dir, named by its key
+SHARED_DIRS_CACHE_DIR = 'shared'
+# hashes of the setup's input files, so they're only read when they change
+SHARED_FILE_HASHES_FILE = 'shared_file_hashes.json'
+# written to a shared dir once the setup has succeeded, so a dir left by a failed (or interrupted) setup isn't used
+SETUP_DONE_FILE = '.bbt_setup_done'
+# name of the shared dir for a setup without declared inputs, which is made afresh on every run
+UNCACHED_SHARED_DIR = 'uncached'
+
+
+class SetupError(Exception):
+    pass
+
+
+# The key for the shared dir, from the setup command and its input files or dirs (relative to root_dir)
+def shared_dir_key(setup_command, input_paths, root_dir, cache_dir):
+    file_hashes = ResultCache(os.path.join(cache_dir, SHARED_FILE_HASHES_FILE))
+
+    key = fingerprint({
+        'setup': setup_command,
+        'inputs': {path: file_hashes.file_digest(os.path.join(root_dir, path)) for path in input_paths},
+    })
+
+    try:
+        file_hashes.save()
+    except OSError:
+        pass
+
+    return key
+
+
+# runs command (in a shell, in cwd). Its output is only shown if it fails, as part of the SetupError.
+def run_suite_command(name, command, cwd):
+    completed = subprocess.run(command, shell=True, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+
+    if completed.returncode != 0:
+        output = completed.stdout.decode('utf-8', errors='replace').rstrip()
+        raise SetupError(f"The suite's {name} command returned status code {completed.returncode}: {command}\n{output}")
+
+
+# Runs the setup command, unless the shared dir for its key is already there. {SHARED_PATH} in the command is replaced
+# with the shared dir. Returns (shared dir, whether the setup ran). Raises SetupError if the setup fails.
+def run_setup(setup_command, input_paths, root_dir, cache_dir):
+    shared_dirs_root = os.path.join(cache_dir, SHARED_DIRS_CACHE_DIR)
+
+    if input_paths:
+        dir_name = shared_dir_key(setup_command, input_paths, root_dir, cache_dir)[:32]
+    else:
+        dir_name = UNCACHED_SHARED_DIR
+
+    shared_dir = os.path.join(shared_dirs_root, dir_name)
+
+    if input_paths and os.path.exists(os.path.join(shared_dir, SETUP_DONE_FILE)):
+        return shared_dir, False
+
+    # only the current shared dir is kept
+    shutil.rmtree(shared_dirs_root, ignore_errors=True)
+    os.makedirs(shared_dir)
+
+    run_suite_command('setup', setup_command.replace("{SHARED_PATH}", shared_dir), root_dir)
+
+    with open(os.path.join(shared_dir, SETUP_DONE_FILE), 'w'):
+        pass
+
+    return shared_dir, True
+
+
+def run_teardown(teardown_command, root_dir, shared_dir):
+    run_suite_command('teardown', teardown_command.replace("{SHARED_PATH}", shared_dir or ''), root_dir)
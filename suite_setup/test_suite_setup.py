@@ -0,0 +1,30 @@
+import os
+
+import pytest
+
+from suite_setup.suite_setup import SetupError, run_setup
+
+
+def test_setup_is_skipped_until_an_input_changes(tmp_path):
+    (tmp_path / 'suite').mkdir()
+    (tmp_path / 'suite' / 'tool.c').write_text("version 1")
+    setup = "echo built >> {SHARED_PATH}/log"
+
+    shared_dir, ran = run_setup(setup, ['tool.c'], tmp_path / 'suite', tmp_path / 'cache')
+    assert ran
+    assert not run_setup(setup, ['tool.c'], tmp_path / 'suite', tmp_path / 'cache')[1]
+
+    (tmp_path / 'suite' / 'tool.c').write_text("version 2")
+    new_shared_dir, ran = run_setup(setup, ['tool.c'], tmp_path / 'suite', tmp_path / 'cache')
+    assert ran and new_shared_dir != shared_dir
+    assert not os.path.exists(shared_dir)
+    assert open(os.path.join(new_shared_dir, 'log')).read() == "built\n"
+
+
+def test_failed_setup_raises_with_its_output(tmp_path):
+    with pytest.raises(SetupError) as error:
+        run_setup("echo oops; exit 3", ['missing'], tmp_path, tmp_path / 'cache')
+    assert "status code 3" in str(error.value) and "oops" in str(error.value)
+
+    # the next run tries again
+    assert run_setup("true", ['missing'], tmp_path, tmp_path / 'cache')[1]
@@ -0,0 +1,384 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import blackbox_tester
+from blackbox_tester import RunOptions, SuiteError, compile_suite_plan, run_suite
+from timing.timing import slowest_tests_table
+
+
+def make_test(suite_dir, name, command, stdout):
+    test_dir = suite_dir / name
+    (test_dir / 'input').mkdir(parents=True)
+    (test_dir / 'config.yaml').write_text(f"command: {command}\ntest_description: {name}\n")
+    (test_dir / 'stdout.txt').write_text(stdout)
+
+
+def test_run_suite_returns_results_without_printing(tmp_path, capsys):
+    make_test(tmp_path / 'suite', 'test_a', 'echo hello', "hello\n")
+    make_test(tmp_path / 'suite', 'test_b', 'echo goodbye', "hello\n")
+
+    suite_result = run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache'))
+
+    assert suite_result.test_count == 2
+    assert [result.status for result in suite_result.results] == ['SUCCESS', 'FAILED']
+    assert suite_result.failed_count == 1 and not suite_result.succeeded
+    assert capsys.readouterr() == ('', '')
+
+
+def test_parallel_results_are_reported_in_suite_order(tmp_path):
+    # each test takes less time than the one before
+    for name, delay in [('test_a', 0.6), ('test_b', 0.3), ('test_c', 0)]:
+        make_test(tmp_path / 'suite', name, f"sleep {delay}; echo {name}", f"{name}\n")
+    reported = []
+
+    suite_result = run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache', jobs=3),
+                             lambda result: reported.append(result.test_index))
+
+    assert reported == [0, 1, 2] and [result.test_index for result in suite_result.results] == [0, 1, 2]
+    assert suite_result.succeeded
+    # they ran at the same time
+    assert suite_result.elapsed_time < 0.9
+
+
+@pytest.mark.parametrize('failing', [False, True])
+def test_asyncio_engine_gives_the_same_results_as_threads(tmp_path, failing):
+    make_test(tmp_path / 'suite', 'test_a', 'echo hello', "hello\n")
+    make_test(tmp_path / 'suite', 'test_b', 'printf "one\\ntwo\\n" > out.txt; sleep 0.1', "")
+    (tmp_path / 'suite' / 'test_b' / 'output').mkdir()
+    (tmp_path / 'suite' / 'test_b' / 'output' / 'out.txt').write_text("one\ntwo\n")
+    make_test(tmp_path / 'suite', 'test_c', 'cat', "from stdin\n")
+    add_config(tmp_path / 'suite' / 'test_c', "text_input: ['from stdin']\n")
+    if failing:
+        make_test(tmp_path / 'suite', 'test_d', 'echo goodbye; exit 3', "hello\n")
+
+    def results(engine):
+        suite_result = run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache', engine=engine, jobs=2))
+        return [(result.test_index, result.status, result.succeeded, result.report) for result in suite_result.results]
+
+    assert results('asyncio') == results('threads')
+    assert [status for _, status, _, _ in results('asyncio')] == ['SUCCESS'] * 3 + ['FAILED'] * failing
+
+
+def test_parallel_runs_exit_with_the_same_status_as_serial_runs(tmp_path):
+    make_test(tmp_path / 'suite', 'test_a', 'echo hello', "hello\n")
+    make_test(tmp_path / 'suite', 'test_b', 'echo goodbye', "hello\n")
+
+    def exit_status(*flags):
+        return subprocess.run([sys.executable, blackbox_tester.__file__, str(tmp_path / 'suite'), *flags,
+                               '--cache-dir', str(tmp_path / 'cache')], capture_output=True).returncode
+
+    assert exit_status() == exit_status('--jobs', '2') == exit_status('--jobs', '2', '--engine', 'asyncio')
+
+
+@pytest.mark.parametrize('flags, stats_printed', [([], False), (['--verbose'], True), (['--timing-report', 't.json'], True)])
+def test_run_stats_are_only_printed_when_asked_for(tmp_path, flags, stats_printed):
+    make_test(tmp_path / 'suite', 'test_a', 'echo hello', "hello\n")
+
+    stderr = subprocess.run([sys.executable, blackbox_tester.__file__, str(tmp_path / 'suite'), '--cache-dir',
+                             str(tmp_path / 'cache'), *flags], capture_output=True, text=True, cwd=tmp_path).stderr
+
+    assert ('Ran 1 tests in' in stderr) == stats_printed
+    assert ('Materialized working dirs' in stderr) == stats_printed
+
+
+def test_trace_has_a_lane_per_worker(tmp_path):
+    for name in ['test_a', 'test_b', 'test_c', 'test_d']:
+        make_test(tmp_path / 'suite', name, 'sleep 0.2', "")
+
+    run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache', jobs=2, trace=tmp_path / 'trace.json'))
+
+    events = json.loads((tmp_path / 'trace.json').read_text())['traceEvents']
+    test_events = [event for event in events if event.get('cat') == 'test']
+    assert sorted(event['name'] for event in test_events) == ['test_a', 'test_b', 'test_c', 'test_d']
+    assert sorted(event['tid'] for event in test_events) == [0, 0, 1, 1]
+    assert {event['args']['name'] for event in events if event['ph'] == 'M'} == {'lane 0', 'lane 1'}
+    assert all(event['dur'] >= 0 and event['ts'] >= 0 for event in events if event['ph'] == 'X')
+
+
+def test_slowest_lists_the_n_slowest_tests(tmp_path):
+    make_test(tmp_path / 'suite', 'test_a', 'sleep 0.3', "")
+    make_test(tmp_path / 'suite', 'test_b', 'sleep 0', "")
+    make_test(tmp_path / 'suite', 'test_c', 'sleep 0.2', "")
+
+    suite_result = run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache', slowest=2))
+
+    table = slowest_tests_table(suite_result.timing_report, 2).splitlines()
+    assert [line.split()[0] for line in table[1:]] == ['test_a', 'test_c']
+
+    stderr = subprocess.run([sys.executable, blackbox_tester.__file__, str(tmp_path / 'suite'), '--cache-dir',
+                             str(tmp_path / 'cache'), '--slowest', '2'], capture_output=True, text=True).stderr
+    listed = stderr.split("Slowest tests (seconds):\n")[1].strip().splitlines()
+    assert [line.split()[0] for line in listed[1:]] == ['test_a', 'test_c']
+
+
+def test_run_suite_raises_if_the_suite_cant_be_run(tmp_path):
+    with pytest.raises(SuiteError):
+        run_suite(tmp_path / 'missing', RunOptions(cache_dir=tmp_path / 'cache'))
+
+    (tmp_path / 'suite').mkdir()
+    (tmp_path / 'suite' / 'global.yaml').write_text("setup: exit 1\n")
+    with pytest.raises(SuiteError, match="setup failed"):
+        run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache'))
+
+
+def test_every_test_is_checked_before_any_are_run(tmp_path):
+    make_test(tmp_path / 'suite', 'test_a', f"touch {tmp_path / 'ran'}", "")
+    make_test(tmp_path / 'suite', 'test_b', 'echo hello', "hello\n")
+    with open(tmp_path / 'suite' / 'test_b' / 'config.yaml', 'a') as file:
+        file.write("timeout: soon\n")
+
+    with pytest.raises(SuiteError, match="timeout must be a number"):
+        run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache'))
+
+    assert not (tmp_path / 'ran').exists()
+
+
+def test_definitions_are_substituted_in_commands(tmp_path):
+    make_test(tmp_path / 'suite', 'test_a', "echo {greeting} {name}", "hello {name}\n")
+    (tmp_path / 'suite' / 'global.yaml').write_text("definitions:\n  greeting: hello\n")
+
+    assert run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache')).succeeded
+
+
+def test_stdout_is_filtered_before_its_compared(tmp_path):
+    make_test(tmp_path / 'suite', 'test_a', "echo run at $(date +%s%N) by $$", "run at <masked> by <masked>\n")
+    (tmp_path / 'suite' / 'global.yaml').write_text("stdout_filters:\n  - mask: '[0-9]+'\n")
+
+    assert run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache')).succeeded
+
+    (tmp_path / 'suite' / 'global.yaml').write_text("stdout_filters:\n  - mask: '('\n")
+    with pytest.raises(SuiteError, match="mask must be a regular expression"):
+        run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache'))
+
+
+def test_failed_first_runs_last_runs_failures_first(tmp_path):
+    make_test(tmp_path / 'suite', 'test_a', 'echo hello', "hello\n")
+    make_test(tmp_path / 'suite', 'test_b', 'echo goodbye', "hello\n")
+    options = RunOptions(cache_dir=tmp_path / 'cache', failed_first=True)
+
+    assert [result.test_index for result in run_suite(tmp_path / 'suite', options).results] == [0, 1]
+    assert [result.test_index for result in run_suite(tmp_path / 'suite', options).results] == [1, 0]
+
+
+def test_history_is_only_written_when_asked_for(tmp_path):
+    make_test(tmp_path / 'suite', 'test_a', 'echo hello', "hello\n")
+
+    assert run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache')).succeeded
+    assert not list((tmp_path / 'cache').glob('**/history.json'))
+
+    run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache', history_file=tmp_path / 'history.json'))
+    assert (tmp_path / 'history.json').exists()
+
+
+def test_a_cache_dir_that_cant_be_written_is_ignored(tmp_path):
+    make_test(tmp_path / 'suite', 'test_a', 'echo hello', "hello\n")
+    (tmp_path / 'cache').write_text("not a dir")
+
+    suite_result = run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache'))
+
+    assert suite_result.succeeded and suite_result.diagnostics == []
+
+
+@pytest.mark.parametrize('engine, jobs', [('threads', 1), ('threads', 3), ('asyncio', 3)])
+def test_max_failures_stops_the_run(tmp_path, engine, jobs):
+    make_test(tmp_path / 'suite', 'test_a', 'echo goodbye', "hello\n")
+    make_test(tmp_path / 'suite', 'test_b', 'sleep 30', "")
+    make_test(tmp_path / 'suite', 'test_c', 'echo goodbye', "hello\n")
+
+    start_time = time.perf_counter()
+    suite_result = run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache', max_failures=1,
+                                                            engine=engine, jobs=jobs))
+
+    # test_b isn't started, or with more than one job, is cancelled (as test_c may be)
+    assert time.perf_counter() - start_time < 10
+    test_indexes = [result.test_index for result in suite_result.results]
+    assert test_indexes == [0] or (jobs > 1 and test_indexes == [0, 2])
+    assert suite_result.not_run_count == 3 - len(test_indexes)
+    assert not (tmp_path / 'suite' / 'test_b' / 'working').exists()
+
+
+def test_exit_on_first_difference_reports_only_the_first(tmp_path):
+    make_test(tmp_path / 'suite', 'test_a', 'echo a > a.txt; echo b > b.txt', "")
+    (tmp_path / 'suite' / 'test_a' / 'output').mkdir()
+    (tmp_path / 'suite' / 'test_a' / 'output' / 'a.txt').write_text("x\n")
+    (tmp_path / 'suite' / 'test_a' / 'output' / 'b.txt').write_text("y\n")
+
+    def report(options):
+        return '\n'.join(run_suite(tmp_path / 'suite', options).results[0].report)
+
+    assert 'a.txt' in report(RunOptions(cache_dir=tmp_path / 'cache')) and \
+           'b.txt' in report(RunOptions(cache_dir=tmp_path / 'cache'))
+    first_difference_report = report(RunOptions(cache_dir=tmp_path / 'cache', exit_on_first_difference=True))
+    assert ('a.txt' in first_difference_report) != ('b.txt' in first_difference_report)
+
+
+@pytest.mark.parametrize('debug_artifacts', [False, True])
+def test_working_dirs_go_in_the_scratch_root(tmp_path, debug_artifacts):
+    make_test(tmp_path / 'suite', 'test_a', f"pwd > {tmp_path / 'pwd_a'}; echo a > a.txt", "")
+    make_test(tmp_path / 'suite', 'test_b', f"pwd > {tmp_path / 'pwd_b'}; echo b > b.txt", "")
+    for name, expected in [('a', "a\n"), ('b', "not b\n")]:
+        (tmp_path / 'suite' / f'test_{name}' / 'output').mkdir()
+        (tmp_path / 'suite' / f'test_{name}' / 'output' / f'{name}.txt').write_text(expected)
+    (tmp_path / 'suite' / 'global.yaml').write_text(f"scratch_root: {tmp_path / 'scratch'}\n")
+
+    suite_result = run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache',
+                                                            debug_artifacts=debug_artifacts))
+
+    assert [result.succeeded for result in suite_result.results] == [True, False]
+    for name in ['a', 'b']:
+        assert (tmp_path / f'pwd_{name}').read_text().startswith(str(tmp_path / 'scratch' / 'bbt_run_'))
+    # the run's scratch dir is removed at the end of the run
+    assert list((tmp_path / 'scratch').iterdir()) == []
+    assert not (tmp_path / 'suite' / 'test_a' / 'working').exists()
+    # the failed test's working/ is moved into the suite with --debug-artifacts
+    assert (tmp_path / 'suite' / 'test_b' / 'working' / 'b.txt').exists() == debug_artifacts
+
+
+def test_scratch_root_option_overrides_global_yaml(tmp_path):
+    make_test(tmp_path / 'suite', 'test_a', f"pwd > {tmp_path / 'pwd'}", "")
+    (tmp_path / 'suite' / 'global.yaml').write_text(f"scratch_root: {tmp_path / 'unused'}\n")
+
+    assert run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache',
+                                                    scratch_root=tmp_path / 'scratch')).succeeded
+
+    assert (tmp_path / 'pwd').read_text().startswith(str(tmp_path / 'scratch'))
+    assert not (tmp_path / 'unused').exists()
+
+
+def test_benchmark_with_a_scratch_root(tmp_path):
+    make_test(tmp_path / 'suite', 'test_a', 'echo hello', "hello\n")
+
+    suite_result = run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache', benchmark=2,
+                                                            scratch_root=tmp_path / 'scratch'))
+
+    assert suite_result.succeeded and list(suite_result.benchmarks) == ['test_a']
+    assert suite_result.diagnostics == []
+
+
+def add_config(test_dir, text):
+    with open(test_dir / 'config.yaml', 'a') as file:
+        file.write(text)
+
+
+# the command lines of the running processes, as far as they can be read
+def running_commands():
+    commands = []
+
+    for pid in filter(str.isdigit, os.listdir('/proc')):
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as file:
+                commands.append(file.read().replace(b'\0', b' ').decode(errors='replace'))
+        except OSError:
+            pass
+
+    return commands
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc'), reason="needs /proc to find the command's processes")
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_a_command_that_times_out_is_killed_with_its_children(tmp_path, engine):
+    make_test(tmp_path / 'suite', 'test_a', "sh -c 'sleep 47.25' & sleep 47.25", "")
+    add_config(tmp_path / 'suite' / 'test_a', "timeout: 0.5\n")
+
+    start_time = time.perf_counter()
+    result = run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache', engine=engine)).results[0]
+
+    assert result.status == 'TIMEOUT' and time.perf_counter() - start_time < 10
+    assert not [command for command in running_commands() if command.strip().endswith('sleep 47.25')]
+
+
+def test_a_command_that_goes_over_a_limit_is_reported(tmp_path):
+    make_test(tmp_path / 'suite', 'test_memory', f"{sys.executable} -c 'bytearray(1024 ** 3)'", "")
+    add_config(tmp_path / 'suite' / 'test_memory', "max_memory: 200M\n")
+    make_test(tmp_path / 'suite', 'test_file_size', "head -c 10000 /dev/zero > big", "")
+    add_config(tmp_path / 'suite' / 'test_file_size', "max_file_size: 4K\n")
+    make_test(tmp_path / 'suite', 'test_within_limits', "head -c 1000 /dev/zero > small", "")
+    add_config(tmp_path / 'suite' / 'test_within_limits', "max_memory: 1G\nmax_file_size: 4K\n")
+
+    results = run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache')).results
+
+    assert [result.status for result in results] == ['LIMIT', 'LIMIT', 'SUCCESS']
+    assert 'max_file_size' in results[0].report[1] and 'max_memory' in results[1].report[1]
+
+
+def test_a_command_that_writes_to_a_hard_linked_file_fails(tmp_path):
+    make_test(tmp_path / 'suite', 'test_a', "echo changed >> shared.txt", "")
+    (tmp_path / 'suite' / 'test_a' / 'input' / 'shared.txt').write_text("shared\n")
+    add_config(tmp_path / 'suite' / 'test_a', "readonly_input_files: ['*.txt']\n")
+
+    result = run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache')).results[0]
+
+    assert result.status == 'FAILED'
+    assert any('input/shared.txt' in line for line in result.report)
+
+
+def test_a_command_that_has_exited_isnt_killed(monkeypatch):
+    killed = []
+    monkeypatch.setattr(blackbox_tester, 'kill_process_group', killed.append)
+    run = blackbox_tester.TestRun(blackbox_tester.TestResult(0, 'test_a'), RunOptions())
+
+    blackbox_tester.command_exited(run)
+    blackbox_tester.stop_command(run, 12345, 'TIMEOUT', "* Timed out")
+
+    assert killed == [] and run.limit_status is None
+
+
+def test_a_command_that_fails_with_max_memory_set_is_reported_as_failed(tmp_path):
+    make_test(tmp_path / 'suite', 'test_a', "exit 1", "")
+    add_config(tmp_path / 'suite' / 'test_a', "max_memory: 1G\n")
+
+    result = run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache')).results[0]
+
+    assert result.status == 'FAILED'
+    assert any('max_memory' in line for line in result.report)
+
+
+def test_plans_are_cached_until_a_config_changes(tmp_path, monkeypatch):
+    make_test(tmp_path / 'suite', 'test_a', "echo hello", "hello\n")
+    compile_suite_plan(tmp_path / 'suite', cache_dir=tmp_path / 'cache')
+
+    def compile_test_plan(*args):
+        raise AssertionError("the cached plan should have been used")
+
+    real_compile_test_plan = blackbox_tester.compile_test_plan
+    monkeypatch.setattr(blackbox_tester, 'compile_test_plan', compile_test_plan)
+    assert run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache')).succeeded
+
+    monkeypatch.setattr(blackbox_tester, 'compile_test_plan', real_compile_test_plan)
+    (tmp_path / 'suite' / 'test_a' / 'config.yaml').write_text("command: echo goodbye\n")
+    assert not run_suite(tmp_path / 'suite', RunOptions(cache_dir=tmp_path / 'cache')).succeeded
+
+
+def test_clean_only_reads_global_yaml(tmp_path):
+    make_test(tmp_path / 'suite', 'test_a', "echo hello", "hello\n")
+    add_config(tmp_path / 'suite' / 'test_a', "timeout: soon\n")
+    (tmp_path / 'suite' / 'test_a' / 'working').mkdir()
+    (tmp_path / 'suite' / 'global.yaml').write_text(f"definitions:\n  tmp: {tmp_path}\nscratch_root: '{{tmp}}/scratch'\n")
+    run_dir = tmp_path / 'scratch' / 'bbt_run_left_behind'
+    run_dir.mkdir(parents=True)
+    (run_dir / 'bbt_test_suite_dir.txt').write_text(str(tmp_path / 'suite'))
+
+    subprocess.run([sys.executable, blackbox_tester.__file__, str(tmp_path / 'suite'), '--clean',
+                    '--cache-dir', str(tmp_path / 'cache')], capture_output=True, check=True)
+
+    assert not (tmp_path / 'suite' / 'test_a' / 'working').exists() and not run_dir.exists()
+    # the tests' configs weren't compiled into a plan
+    assert not (tmp_path / 'cache').exists()
+
+
+# BBT is started once per test by its self-tests, so the modules that are slow to import must only be imported
+# when they're needed (see python3 -m self_benchmark for how long startup takes)
+def test_startup_doesnt_import_slow_modules():
+    slow_modules = ['asyncio', 'concurrent.futures', 'pytest', 'statistics', 'yaml', 'zipfile']
+
+    imported = subprocess.run([sys.executable, '-c', f"import sys, blackbox_tester; "
+                                                     f"print([m for m in {slow_modules} if m in sys.modules])"],
+                              capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+
+    assert imported == '[]'
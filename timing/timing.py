@@ -0,0 +1,157 @@
+import json
+import time
+
+# Timings for the phases of a test, for finding out where a suite's time goes.
+#
+# config: validating the test dir, loading its config and setting up its command
+# copy: copying input/ to working/ (see materialization.py)
+# subprocess: running the command, less the time spent on its stdout
+# stdout: trimming and comparing (or recording) stdout. This happens while the command runs, as stdout is read.
+# compare: comparing working/ with output/ (or recording output/)
+# cleanup: removing working/, or keeping it for debugging
+PHASE_CONFIG = 'config'
+PHASE_COPY = 'copy'
+PHASE_SUBPROCESS = 'subprocess'
+PHASE_STDOUT = 'stdout'
+PHASE_COMPARE = 'compare'
+PHASE_CLEANUP = 'cleanup'
+
+PHASES = [PHASE_CONFIG, PHASE_COPY, PHASE_SUBPROCESS, PHASE_STDOUT, PHASE_COMPARE, PHASE_CLEANUP]
+
+
+class PhaseTimings:
+    """
+    The phases a test went through, as (phase, start, end) spans with perf_counter times. A phase is started with
+    start(), which also ends the current phase, if any. A phase can have more than one span.
+
+    Time spent on one phase inside another (stdout, inside subprocess) is added with add_nested(), and taken
+    off the other phase's total:
+
+        >>> timings = PhaseTimings()
+        >>> timings.spans = [(PHASE_CONFIG, 0.0, 1.0), (PHASE_SUBPROCESS, 1.0, 5.0), (PHASE_CONFIG, 5.0, 5.5)]
+        >>> timings.add_nested(PHASE_STDOUT, 1.5, PHASE_SUBPROCESS)
+        >>> timings.totals()
+        {'config': 1.5, 'subprocess': 2.5, 'stdout': 1.5}
+    """
+
+    def __init__(self):
+        self.spans = []
+        # phase -> (seconds, phase it was spent in)
+        self.nested = {}
+        self.current_phase = None
+        self.current_start = None
+
+    def start(self, phase):
+        self.stop()
+        self.current_phase = phase
+        self.current_start = time.perf_counter()
+
+    def stop(self):
+        if self.current_phase:
+            self.spans.append((self.current_phase, self.current_start, time.perf_counter()))
+            self.current_phase = None
+
+    def add_nested(self, phase, seconds, within_phase):
+        self.nested[phase] = (seconds, within_phase)
+
+    # seconds spent in each phase, in PHASES order
+    def totals(self):
+        totals = {}
+
+        for phase, start, end in self.spans:
+            totals[phase] = totals.get(phase, 0) + end - start
+
+        for phase, (seconds, within_phase) in self.nested.items():
+            totals[phase] = seconds
+            if within_phase in totals:
+                totals[within_phase] -= seconds
+
+        return {phase: totals[phase] for phase in PHASES if phase in totals}
+
+
+# A report of the timings of the tests, given as (name, duration, timings) where timings is a PhaseTimings
+def make_timing_report(tests, total_time):
+    report_tests = []
+    phase_totals = {}
+
+    for name, duration, timings in tests:
+        totals = timings.totals()
+        report_tests.append({'name': name, 'duration': duration, 'phases': totals})
+
+        for phase, seconds in totals.items():
+            phase_totals[phase] = phase_totals.get(phase, 0) + seconds
+
+    return {'total_time': total_time, 'phase_totals': phase_totals, 'tests': report_tests}
+
+
+def save_timing_report(filename, report):
+    with open(filename, 'w') as file:
+        json.dump(report, file, indent=2)
+
+
+# Table of the slowest tests in a timing report, with their phase timings
+def slowest_tests_table(report, count):
+    slowest = sorted(report['tests'], key=lambda test: -(test['duration'] or 0))[:count]
+
+    lines = [f"{'test':40} {'total':>8} " + ' '.join(f"{phase:>10}" for phase in PHASES)]
+    for test in slowest:
+        phases = ' '.join(f"{test['phases'].get(phase, 0):10.3f}" for phase in PHASES)
+        lines.append(f"{test['name'][:40]:40} {test['duration'] or 0:8.3f} {phases}")
+
+    return '\n'.join(lines)
+
+
+def assign_lanes(intervals):
+    """
+    Assigns each (start, end) interval a lane, so intervals in a lane don't overlap, using as few lanes as
+    possible. With tests as the intervals, a lane is roughly a worker:
+
+        >>> assign_lanes([(0, 10), (1, 3), (4, 6), (5, 12), (11, 13)])
+        [0, 1, 1, 2, 0]
+    """
+    lane_ends = []
+    lanes = [None] * len(intervals)
+
+    for i in sorted(range(len(intervals)), key=lambda i: intervals[i][0]):
+        start, end = intervals[i]
+        free_lanes = [lane for lane, lane_end in enumerate(lane_ends) if lane_end <= start]
+
+        if free_lanes:
+            lanes[i] = free_lanes[0]
+            lane_ends[free_lanes[0]] = end
+        else:
+            lanes[i] = len(lane_ends)
+            lane_ends.append(end)
+
+    return lanes
+
+
+# Chrome trace events (for chrome://tracing or https://ui.perfetto.dev) for the tests, given as (name, timings).
+# Each test, and each of its phases, is a slice, in lanes so that concurrent tests are side by side.
+# Times are relative to epoch (a perf_counter time).
+def chrome_trace(tests, epoch):
+    def microseconds(seconds):
+        return round((seconds - epoch) * 1_000_000)
+
+    tests = [(name, timings) for name, timings in tests if timings.spans]
+    intervals = [(timings.spans[0][1], timings.spans[-1][2]) for _, timings in tests]
+    lanes = assign_lanes(intervals)
+
+    events = [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': lane, 'args': {'name': f"lane {lane}"}}
+              for lane in sorted(set(lanes))]
+
+    for (name, timings), (start, end), lane in zip(tests, intervals, lanes):
+        events.append({'name': name, 'cat': 'test', 'ph': 'X', 'pid': 1, 'tid': lane,
+                       'ts': microseconds(start), 'dur': microseconds(end) - microseconds(start),
+                       'args': {phase: round(seconds, 6) for phase, seconds in timings.totals().items()}})
+
+        for phase, phase_start, phase_end in timings.spans:
+            events.append({'name': phase, 'cat': 'phase', 'ph': 'X', 'pid': 1, 'tid': lane,
+                           'ts': microseconds(phase_start), 'dur': microseconds(phase_end) - microseconds(phase_start)})
+
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def save_chrome_trace(filename, trace):
+    with open(filename, 'w') as file:
+        json.dump(trace, file)